@@ -824,6 +824,8 @@ class DomainSettingAdmin(admin.ModelAdmin):
         "documents",
         "browse_mode",
         "ignore_robots",
+        "requests_per_sec",
+        "max_concurrency",
         "robots_status",
         "robots_allow",
         "robots_disallow",
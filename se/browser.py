@@ -76,6 +76,15 @@ class Browser:
         cls._destroy()
         cls.inited = False
 
+    @classmethod
+    def recycle(cls):
+        # Replaces the current instance, a new one is started on next use
+        cls.destroy()
+
+    @classmethod
+    def has_spare(cls):
+        return False
+
     @classmethod
     def _init(cls):
         raise NotImplementedError()
@@ -99,8 +108,10 @@ def retry(f):
                 crawl_logger.error(f"Selenium returned an exception:\n{exc}")
 
                 cls = args[0]
-                cls.destroy()
-                sleep(settings.SOSSE_BROWSER_CRASH_SLEEP)
+                cls.recycle()
+                # A spare instance can be used right away
+                if not cls.has_spare():
+                    sleep(settings.SOSSE_BROWSER_CRASH_SLEEP)
                 cls.init()
 
                 if count == settings.SOSSE_BROWSER_CRASH_RETRY:
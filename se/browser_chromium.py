@@ -13,6 +13,7 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import base64
 import json
 import os
 
@@ -89,6 +90,18 @@ class BrowserChromium(BrowserSelenium):
         cls.driver.get(url)
         cls.page_change_wait(dl_dir_files)
 
+    @classmethod
+    def _full_page_screenshot(cls, width, height):
+        screenshot = cls.driver.execute_cdp_cmd(
+            "Page.captureScreenshot",
+            {
+                "format": "png",
+                "captureBeyondViewport": True,
+                "clip": {"x": 0, "y": 0, "width": width, "height": height, "scale": 1},
+            },
+        )
+        return base64.b64decode(screenshot["data"])
+
     @classmethod
     def _get_download_file(cls):
         d = os.listdir(cls._get_download_dir())
@@ -117,13 +117,21 @@ class BrowserFirefox(BrowserSelenium):
         cls.page_change_wait(dl_dir_files)
 
     @classmethod
-    def _destroy(cls):
+    def _full_page_screenshot(cls, width, height):
+        return cls.driver.get_full_page_screenshot_as_png()
+
+    @classmethod
+    def _quit_driver(cls, driver):
         # Kill firefox, otherwise it can get stuck on a confirmation dialog
         # (ie, when a download is still running)
-        gecko_pid = cls._driver.service.process.pid
-        p = psutil.Process(gecko_pid)
-        p.children()[0].kill()
-        super()._destroy()
+        try:
+            gecko_pid = driver.service.process.pid
+            p = psutil.Process(gecko_pid)
+            p.children()[0].kill()
+        except (psutil.Error, IndexError):
+            # Firefox already exited
+            pass
+        super()._quit_driver(driver)
 
     @classmethod
     def _get_download_dir(cls):
@@ -14,6 +14,11 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+from collections import OrderedDict
+from hashlib import md5
+from http.cookiejar import DefaultCookiePolicy
+from tempfile import TemporaryFile
+from threading import Lock
 
 import requests
 from django.conf import settings
@@ -22,7 +27,7 @@ from .browser import AuthElemFailed, Browser, PageTooBig, TooManyRedirects
 from .cookie import Cookie
 from .domain_setting import user_agent
 from .page import Page
-from .url import absolutize_url, url_remove_fragment
+from .url import absolutize_url, url_remove_fragment, urlparse
 
 crawl_logger = logging.getLogger("crawler")
 
@@ -36,23 +41,71 @@ def dict_merge(a, b):
     return a
 
 
+class RejectCookiePolicy(DefaultCookiePolicy):
+    # Cookies are stored in the Cookie model and merged to each request, pooled sessions must not keep them
+    def set_ok(self, cookie, request):
+        return False
+
+
 class BrowserRequest(Browser):
+    # Sessions are kept between requests to reuse connections
+    MAX_SESSIONS = 32
+    POOL_SIZE = 8
+    _sessions = OrderedDict()
+    _sessions_lock = Lock()
+
     @classmethod
     def _init(cls):
         pass
 
     @classmethod
     def _destroy(cls):
-        pass
+        cls.close_sessions()
 
     @classmethod
-    def _page_from_request(cls, r):
-        content = r._content
-        page = Page(r.url, content, cls, r.headers, r.status_code)
+    def close_sessions(cls):
+        with cls._sessions_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+
+    @classmethod
+    def _get_session(cls, url):
+        parsed = urlparse(url)
+        key = (settings.SOSSE_PROXY, parsed.scheme, parsed.netloc)
+
+        with cls._sessions_lock:
+            session = cls._sessions.get(key)
+            if session is not None:
+                cls._sessions.move_to_end(key)
+                return session
+
+            session = requests.Session()
+            session.cookies = requests.cookies.RequestsCookieJar(policy=RejectCookiePolicy())
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=cls.POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            cls._sessions[key] = session
+
+            if len(cls._sessions) > cls.MAX_SESSIONS:
+                _, oldest = cls._sessions.popitem(last=False)
+                oldest.close()
+            return session
 
-        soup = page.get_soup()
-        if soup:
-            page.title = soup.title and soup.title.string
+    @classmethod
+    def _page_from_request(cls, r):
+        page = Page(
+            r.url,
+            r._content,
+            cls,
+            r.headers,
+            r.status_code,
+            content_file=getattr(r, "_content_file", None),
+            content_md5=getattr(r, "_content_md5", None),
+        )
+
+        if page.get_soup():
+            page.title = page.analysis().title
         return page
 
     @classmethod
@@ -100,34 +153,59 @@ class BrowserRequest(Browser):
         return params
 
     @classmethod
-    def _requests_query(cls, method, url, max_file_size, **kwargs):
-        jar = cls._get_cookies(url)
+    def _requests_query(cls, method, url, max_file_size, cookie_jar=None, **kwargs):
+        # When a cookie jar is provided, the cookies received are only added to it, without database access
+        jar = cookie_jar if cookie_jar is not None else cls._get_cookies(url)
         crawl_logger.debug(f"from the jar: {jar}")
-        s = requests.Session()
-        s.cookies = jar
+        s = cls._get_session(url)
 
         func = getattr(s, method)
         kwargs = dict_merge(cls._requests_params(), kwargs)
-        r = func(url, **kwargs)
-        Cookie.set_from_jar(url, s.cookies)
+        r = func(url, cookies=jar, **kwargs)
+        requests.cookies.extract_cookies_to_jar(jar, r.request, r.raw)
+        if cookie_jar is None:
+            Cookie.set_from_jar(url, jar)
 
         content_length = int(r.headers.get("content-length", 0))
         if content_length / 1024 > max_file_size:
             r.close()
             raise PageTooBig(content_length, max_file_size)
 
-        content = b""
+        # The content is hashed while downloading, and moved to a temporary file when it gets too big
+        content = bytearray()
+        content_file = None
+        content_md5 = md5(usedforsecurity=False)
+        size = 0
         for chunk in r.iter_content(chunk_size=1024 * 1024):
-            content += chunk
-            if len(content) / 1024 >= max_file_size:
+            size += len(chunk)
+            content_md5.update(chunk)
+
+            if content_file is None and size / 1024 > settings.SOSSE_DOWNLOAD_MEMORY_SIZE:
+                content_file = TemporaryFile()
+                content_file.write(content)
+                content = None
+
+            if content_file is None:
+                content += chunk
+            else:
+                content_file.write(chunk)
+
+            if size / 1024 >= max_file_size:
                 break
         r.close()
 
-        if len(content) / 1024 > max_file_size:
-            raise PageTooBig(len(content), max_file_size)
+        if size / 1024 > max_file_size:
+            if content_file:
+                content_file.close()
+            raise PageTooBig(size, max_file_size)
 
-        r._content = content
-        crawl_logger.debug(f"after request jar: {s.cookies}")
+        if content_file is None:
+            r._content = bytes(content)
+        else:
+            r._content = None
+            r._content_file = content_file
+        r._content_md5 = content_md5.hexdigest()
+        crawl_logger.debug(f"after request jar: {jar}")
         return r
 
     @classmethod
@@ -136,6 +214,7 @@ class BrowserRequest(Browser):
         url,
         check_status=False,
         max_file_size=settings.SOSSE_MAX_FILE_SIZE,
+        cookie_jar=None,
         **kwargs,
     ) -> Page:
         REDIRECT_CODE = (301, 302, 307, 308)
@@ -143,7 +222,7 @@ class BrowserRequest(Browser):
         redirect_count = 0
 
         while redirect_count <= settings.SOSSE_MAX_REDIRECTS:
-            r = cls._requests_query("get", url, max_file_size, **kwargs)
+            r = cls._requests_query("get", url, max_file_size, cookie_jar, **kwargs)
 
             if check_status:
                 r.raise_for_status()
@@ -163,24 +242,19 @@ class BrowserRequest(Browser):
             page = cls._page_from_request(r)
 
             # Check for an HTML / meta redirect
-            soup = page.get_soup()
-            if soup:
-                for meta in page.get_soup().find_all("meta"):
-                    if meta.get("http-equiv", "").lower() == "refresh" and meta.get("content", ""):
-                        # handle redirect
-                        dest = meta.get("content")
-
-                        if ";" in dest:
-                            dest = dest.split(";", 1)[1]
-
-                        if dest.startswith("url="):
-                            dest = dest[4:]
-
-                        url = absolutize_url(url, dest)
-                        url = url_remove_fragment(url)
-                        redirect_count += 1
-                        crawl_logger.debug(f"{url}: html redirected")
-                        continue
+            if page.get_soup():
+                for dest in page.analysis().meta_refresh:
+                    # handle redirect
+                    if ";" in dest:
+                        dest = dest.split(";", 1)[1]
+
+                    if dest.startswith("url="):
+                        dest = dest[4:]
+
+                    url = absolutize_url(url, dest)
+                    url = url_remove_fragment(url)
+                    redirect_count += 1
+                    crawl_logger.debug(f"{url}: html redirected")
             break
 
         if redirect_count > settings.SOSSE_MAX_REDIRECTS:
@@ -18,14 +18,17 @@ import logging
 import os
 import re
 import shlex
+import traceback
 from datetime import datetime
 from io import BytesIO
+from threading import Thread
 from time import sleep
 
 import psutil
 import pytz
 from django.conf import settings
 from PIL import Image
+from selenium.common.exceptions import WebDriverException
 
 from .browser import (
     AuthElemFailed,
@@ -38,14 +41,99 @@ from .browser import (
 from .browser_request import BrowserRequest
 from .cookie import Cookie
 from .page import NAV_ELEMENTS, Page
+from .screenshot_encoder import ScreenshotEncoder
 from .url import has_browsable_scheme, sanitize_url, urlparse
+from .utils import human_filesize
 
 crawl_logger = logging.getLogger("crawler")
 
+# Returns [left, top, right, bottom] for each XPath selector, or null when the element is not displayed
+LINKS_POS_SCRIPT = """
+const [selectors, pageWidth] = arguments;
+return selectors.map((selector) => {
+    let el = null;
+    try {
+        el = document.evaluate(selector, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    } catch (e) {
+        return null;
+    }
+    if (el === null) {
+        return null;
+    }
+    if (el.children.length === 1 && el.children[0].tagName === 'IMG') {
+        el = el.children[0];
+    }
+    const elemRect = el.getBoundingClientRect();
+    if (elemRect.left >= pageWidth) {
+        return null;
+    }
+    return [elemRect.left, elemRect.top, Math.min(pageWidth, elemRect.right), elemRect.bottom];
+});
+"""
+
+# Maximum texture size of browsers, taller pages are captured by scrolling
+FULL_PAGE_MAX_HEIGHT = 16384
+
+# Resolves once the DOM had no mutation and no request was in flight for quietTime ms, or after maxTime ms
+JS_STABLE_SCRIPT = """
+const [quietTime, maxTime] = arguments;
+const done = arguments[arguments.length - 1];
+const start = performance.now();
+let lastActivity = start;
+let pending = 0;
+
+const activity = () => {
+    lastActivity = performance.now();
+};
+const observer = new MutationObserver(activity);
+observer.observe(document, { subtree: true, childList: true, attributes: true, characterData: true });
+const perfObserver = new PerformanceObserver(activity);
+perfObserver.observe({ type: "resource" });
+
+const origFetch = window.fetch;
+window.fetch = function () {
+    pending++;
+    activity();
+    return origFetch.apply(this, arguments).finally(() => {
+        pending--;
+        activity();
+    });
+};
+const origSend = XMLHttpRequest.prototype.send;
+XMLHttpRequest.prototype.send = function () {
+    pending++;
+    activity();
+    this.addEventListener("loadend", () => {
+        pending--;
+        activity();
+    });
+    return origSend.apply(this, arguments);
+};
+
+const check = () => {
+    const now = performance.now();
+    const stable = document.readyState === "complete" && pending <= 0 && now - lastActivity >= quietTime;
+    if (stable || now - start >= maxTime) {
+        observer.disconnect();
+        perfObserver.disconnect();
+        window.fetch = origFetch;
+        XMLHttpRequest.prototype.send = origSend;
+        done(stable);
+    } else {
+        setTimeout(check, Math.min(50, quietTime));
+    }
+};
+setTimeout(check, Math.min(50, quietTime));
+"""
+
 
 class BrowserSelenium(Browser):
     _worker_no = 0
     _driver = None
+    _spare = None
+    _spare_thread = None
+    _page_count = 0
+    _tabs = {}
     cookie_loaded = []
     COOKIE_LOADED_SIZE = 1024
     first_init = True
@@ -78,6 +166,13 @@ class BrowserSelenium(Browser):
         config_dir = settings.SOSSE_BROWSER_CONFIG_DIR
         os.environ["XDG_CONFIG_HOME"] = config_dir
 
+        cls._driver = cls._take_spare() or cls._new_driver()
+        cls._page_count = 0
+        cls._tabs = {}
+        cls._start_spare()
+
+    @classmethod
+    def _new_driver(cls):
         opt_key = f"SOSSE_{cls.name.upper()}_OPTIONS"
         opts = shlex.split(getattr(settings, opt_key))
         w, h = cls.screen_size()
@@ -98,22 +193,108 @@ class BrowserSelenium(Browser):
             crawl_logger.warning("Passing --incognito breaks file downloads on some versions of Chromium")
 
         cls.first_init = False
-        cls._driver = cls._get_driver(options)
-        cls._driver.delete_all_cookies()
+        driver = cls._get_driver(options)
+        driver.delete_all_cookies()
+        driver.set_script_timeout(settings.SOSSE_JS_STABLE_TIME * settings.SOSSE_JS_STABLE_RETRY + 10)
+        return driver
+
+    @classmethod
+    def _start_spare(cls):
+        # A spare browser is started in the background, to replace the current one without waiting
+        if not settings.SOSSE_BROWSER_SPARE or cls.has_spare():
+            return
+        cls._spare_thread = Thread(target=cls._warm_spare, daemon=True)
+        cls._spare_thread.start()
+
+    @classmethod
+    def _warm_spare(cls):
+        try:
+            cls._spare = cls._new_driver()
+            crawl_logger.debug(f"Spare {cls.name} browser ready")
+        except Exception:
+            crawl_logger.error(f"Failed to start a spare {cls.name} browser:\n{traceback.format_exc()}")
+
+    @classmethod
+    def has_spare(cls):
+        return cls._spare is not None or (cls._spare_thread is not None and cls._spare_thread.is_alive())
+
+    @classmethod
+    def _take_spare(cls):
+        if cls._spare_thread:
+            cls._spare_thread.join()
+            cls._spare_thread = None
+
+        spare, cls._spare = cls._spare, None
+        if spare is None:
+            return None
+
+        # The spare may have crashed while waiting
+        try:
+            spare.current_url
+        except WebDriverException:
+            cls._quit_driver(spare)
+            return None
+        crawl_logger.debug(f"Using spare {cls.name} browser")
+        return spare
+
+    @classmethod
+    def recycle(cls):
+        # Drop the current browser only, the spare is kept to replace it
+        if not cls.inited:
+            return
+        crawl_logger.debug(f"Browser {cls.__name__} recycle")
+        cls._quit_driver(cls._driver)
+        cls._driver = None
+        cls._tabs = {}
+        cls.inited = False
+
+    @classmethod
+    def _should_recycle(cls):
+        if settings.SOSSE_BROWSER_RECYCLE_PAGES and cls._page_count >= settings.SOSSE_BROWSER_RECYCLE_PAGES:
+            crawl_logger.debug(f"{cls.name} browser loaded {cls._page_count} pages, recycling")
+            return True
+
+        if settings.SOSSE_BROWSER_RECYCLE_RSS:
+            rss = 0
+            try:
+                proc = psutil.Process(cls._driver.service.process.pid)
+                for p in [proc] + proc.children(recursive=True):
+                    rss += p.memory_info().rss
+            except psutil.Error:
+                return False
+
+            if rss > settings.SOSSE_BROWSER_RECYCLE_RSS * 1024 * 1024:
+                crawl_logger.debug(f"{cls.name} browser uses {human_filesize(rss)}, recycling")
+                return True
+        return False
+
+    @classmethod
+    def destroy(cls):
+        super().destroy()
+        # The spare is kept when the browser is recycled or closed by an idle crawler, even if not inited
+        spare = cls._take_spare()
+        if spare:
+            cls._quit_driver(spare)
 
     @classmethod
     def _destroy(cls):
         if cls._driver:
-            # Ignore errors in case the browser crashed
-            try:
-                cls._driver.close()
-            except:  # noqa # nosec B110
-                pass
+            cls._quit_driver(cls._driver)
+            cls._driver = None
+        cls._tabs = {}
 
-            try:
-                cls._driver.quit()
-            except:  # noqa # nosec B110
-                pass
+    @classmethod
+    def _quit_driver(cls, driver):
+        # Ignore errors in case the browser crashed
+        try:
+            driver.close()
+        except:  # noqa # nosec B110
+            pass
+
+        try:
+            driver.quit()
+        except:  # noqa # nosec B110
+            pass
 
     @classmethod
     def _current_url(cls):
@@ -149,20 +330,7 @@ class BrowserSelenium(Browser):
                 continue
 
             crawl_logger.debug(f"js stabilization start {url}")
-            # Wait for page content to be stable
-            retry = settings.SOSSE_JS_STABLE_RETRY
-            previous_content = None
-            content = None
-
-            while retry > 0 and cls._current_url() == url:
-                retry -= 1
-                content = cls.driver.page_source
-
-                if content == previous_content:
-                    break
-                previous_content = content
-                sleep(settings.SOSSE_JS_STABLE_TIME)
-                crawl_logger.debug(f"js changed {url}")
+            cls._wait_for_stable(url)
 
             if cls._current_url() != url:
                 redirect_count += 1
@@ -177,6 +345,36 @@ class BrowserSelenium(Browser):
 
         return redirect_count
 
+    @classmethod
+    def _wait_for_stable(cls, url):
+        if settings.SOSSE_JS_STABLE_MODE == "observer":
+            quiet_time = settings.SOSSE_JS_STABLE_TIME * 1000
+            max_time = quiet_time * settings.SOSSE_JS_STABLE_RETRY
+            try:
+                if not cls.driver.execute_async_script(JS_STABLE_SCRIPT, quiet_time, max_time):
+                    crawl_logger.debug(f"js did not stabilize {url}")
+                return
+            except WebDriverException as e:
+                # The script is interrupted when the page navigates away
+                if cls._current_url() != url:
+                    return
+                crawl_logger.debug(f"js stabilization script failed on {url}, polling the DOM: {e}")
+
+        # Wait for page content to be stable
+        retry = settings.SOSSE_JS_STABLE_RETRY
+        previous_content = None
+        content = None
+
+        while retry > 0 and cls._current_url() == url:
+            retry -= 1
+            content = cls.driver.page_source
+
+            if content == previous_content:
+                break
+            previous_content = content
+            sleep(settings.SOSSE_JS_STABLE_TIME)
+            crawl_logger.debug(f"js changed {url}")
+
     @classmethod
     def remove_nav_elements(cls):
         nav_elements = json.dumps(NAV_ELEMENTS)
@@ -305,21 +503,127 @@ class BrowserSelenium(Browser):
                 raise Exception(f"{cookie}\n{cls.driver.current_url}")
 
     @classmethod
-    @retry
-    def get(cls, url):
-        current_url = cls.driver.current_url
-        crawl_logger.debug(f"get on {url}, current {current_url}")
+    def preload(cls, urls):
+        # Start loading the upcoming urls in background tabs, their network waits then overlap
+        # with the processing of the current page
+        if not cls.inited:
+            return
+
+        try:
+            for url, handle in list(cls._tabs.items()):
+                if url not in urls:
+                    crawl_logger.debug(f"closing stale tab for {url}")
+                    cls._close_tab(handle)
+                    del cls._tabs[url]
+
+            main_handle = cls._driver.current_window_handle
+            for url in urls:
+                if len(cls._tabs) >= settings.SOSSE_BROWSER_TABS - 1:
+                    break
+                if url in cls._tabs or not has_browsable_scheme(url):
+                    continue
+
+                crawl_logger.debug(f"preloading {url}")
+                cls._driver.switch_to.new_window("tab")
+                cls._tabs[url] = cls._driver.current_window_handle
+                # Unlike driver.get(), this does not wait for the page load
+                cls._driver.execute_script("window.location.href = arguments[0];", url)
+                cls._driver.switch_to.window(main_handle)
+        except WebDriverException:
+            crawl_logger.warning(f"Preloading failed:\n{traceback.format_exc()}")
+            cls.recycle()
+
+    @classmethod
+    def _close_tab(cls, handle):
+        main_handle = cls._driver.current_window_handle
+        cls._driver.switch_to.window(handle)
+        cls._driver.close()
+        cls._driver.switch_to.window(main_handle)
 
-        # Clear the download dir
+    @classmethod
+    def _close_preloads(cls):
+        if not cls._tabs:
+            return False
+
+        crawl_logger.debug(f"closing {len(cls._tabs)} preloaded tabs")
+        for handle in cls._tabs.values():
+            cls._close_tab(handle)
+        cls._tabs = {}
+
+        # Wait for the downloads started by the closed tabs to settle
+        files = None
+        for _ in range(settings.SOSSE_DL_CHECK_RETRY):
+            try:
+                _files = sorted(
+                    (f, os.path.getsize(os.path.join(cls._get_download_dir(), f)))
+                    for f in os.listdir(cls._get_download_dir())
+                )
+            except FileNotFoundError:
+                # A partial download got renamed while listing
+                _files = None
+            if _files == files:
+                break
+            files = _files
+            sleep(settings.SOSSE_DL_CHECK_TIME)
+        return True
+
+    @classmethod
+    def _clear_download_dir(cls, warn=True):
         crawl_logger.debug(f"clearing {cls._get_download_dir()}")
         for f in os.listdir(cls._get_download_dir()):
             f = os.path.join(cls._get_download_dir(), f)
             if os.path.isfile(f):
-                crawl_logger.warning(
-                    f'Deleting stale download file {f} (you may fix the issue by adjusting "dl_check_*" variables in the conf)'
-                )
+                if warn:
+                    crawl_logger.warning(
+                        f'Deleting stale download file {f} (you may fix the issue by adjusting "dl_check_*" variables in the conf)'
+                    )
                 os.unlink(f)
 
+    @classmethod
+    def _get_preloaded(cls, url):
+        handle = cls._tabs.pop(url)
+        main_handle = cls._driver.current_window_handle
+        cls._driver.switch_to.window(handle)
+
+        if cls._driver.current_url in ("about:blank", "data:,"):
+            # The load did not start or turned into a download, fall back to a regular load
+            crawl_logger.debug(f"preloaded tab for {url} is not usable")
+            cls._driver.close()
+            cls._driver.switch_to.window(main_handle)
+            return None
+
+        # The preloaded tab replaces the main one
+        crawl_logger.debug(f"using preloaded tab for {url}")
+        cls._driver.switch_to.window(main_handle)
+        cls._driver.close()
+        cls._driver.switch_to.window(handle)
+        return cls._get_page(url)
+
+    @classmethod
+    @retry
+    def get(cls, url):
+        if cls.inited and cls._should_recycle():
+            cls.recycle()
+        # Counted once the browser is started, a new browser resets the count
+        cls.init()
+        cls._page_count += 1
+
+        if url in cls._tabs:
+            page = cls._get_preloaded(url)
+            if page:
+                cls._save_cookies(url)
+                return page
+
+        current_url = cls.driver.current_url
+        crawl_logger.debug(f"get on {url}, current {current_url}")
+
+        if cls._tabs and os.listdir(cls._get_download_dir()):
+            # Files from preloaded tabs that turned into downloads, they are fetched again when crawled
+            cls._close_preloads()
+            cls._clear_download_dir(warn=False)
+        else:
+            cls._clear_download_dir()
+
         crawl_logger.debug("loading cookies")
         cls._load_cookies(url)
         crawl_logger.debug("driver get")
@@ -334,6 +638,10 @@ class BrowserSelenium(Browser):
             or cls.driver.current_url == "data:,"
         ):  # The url can be "data:," during a few milliseconds when the download starts
             crawl_logger.debug(f"download starting ({cls.driver.current_url})")
+            if cls._close_preloads():
+                # The download dir is shared with the preloaded tabs, restart the download once they are closed
+                cls._clear_download_dir(warn=False)
+                cls._driver_get(url, force_reload=True)
             page = cls._handle_download(url)
             if page:
                 return page
@@ -387,7 +695,7 @@ class BrowserSelenium(Browser):
                     retry = settings.SOSSE_DL_CHECK_RETRY
 
                 if size / 1024 > settings.SOSSE_MAX_FILE_SIZE:
-                    cls.destroy()  # cancel the download
+                    cls.recycle()  # cancel the download
                     raise PageTooBig(size, settings.SOSSE_MAX_FILE_SIZE)
 
                 if not cls._download_in_progress(filename):
@@ -428,22 +736,20 @@ class BrowserSelenium(Browser):
         base_name = os.path.join(settings.SOSSE_THUMBNAILS_DIR, image_name)
         dir_name = os.path.dirname(base_name)
         os.makedirs(dir_name, exist_ok=True)
-        thumb_png = base_name + ".png"
-        thumb_jpg = base_name + ".jpg"
 
-        try:
-            cls.driver.get_screenshot_as_file(thumb_png)
-            with Image.open(thumb_png) as img:
-                img = img.convert("RGB")  # Remove alpha channel from the png
-                img.thumbnail((160, 100))
-                img.save(thumb_jpg, "jpeg")
-        finally:
-            if os.path.exists(thumb_png):
-                os.unlink(thumb_png)
+        with Image.open(BytesIO(cls.driver.get_screenshot_as_png())) as img:
+            img = img.convert("RGB")  # Remove alpha channel from the png
+            img.thumbnail((160, 100))
+            img.save(base_name + ".jpg", "jpeg")
+
+    @classmethod
+    def _full_page_screenshot(cls, width, height):
+        # Returns the png of the whole page, or None when the browser cannot capture it
+        return None
 
     @classmethod
     @retry
-    def take_screenshots(cls, url, image_name):
+    def take_screenshots(cls, url, image_name, img_format):
         from .crawl_policy import CrawlPolicy
 
         crawl_policy = CrawlPolicy.get_from_url(url)
@@ -460,44 +766,55 @@ class BrowserSelenium(Browser):
         screen_width, screen_height = cls.screen_size()
         cls.driver.set_window_rect(0, 0, screen_width, screen_height)
         cls.driver.execute_script('document.body.style.overflow = "hidden"')
-        doc_height = cls.driver.execute_script(
+        doc_width, doc_height, viewport_height = cls.driver.execute_script(
             """
             window.scroll(0, 0);
             const body = document.body;
             const html = document.documentElement;
-            return Math.max(body.scrollHeight, body.offsetHeight,
-                            html.clientHeight, html.scrollHeight, html.offsetHeight);
+            return [html.clientWidth,
+                    Math.max(body.scrollHeight, body.offsetHeight,
+                             html.clientHeight, html.scrollHeight, html.offsetHeight),
+                    window.innerHeight];
             """
         )
 
-        img_no = 0
-        top_offset = 0
-        remainging_height = doc_height
-        while remainging_height > 0:
-            missing_height = cls.scroll_to_page(top_offset)
-            crawl_logger.debug(f"Scrolling to {top_offset} (missing {missing_height} / {remainging_height})")
-            screenshot_file = f"{base_name}_{img_no}.png"
-            screenshot = cls.driver.get_screenshot_as_png()
-
-            # Compute the height of the image, this is required because
-            # the size of the viewport is different from the size of the window
-            img = Image.open(BytesIO(screenshot))
-            img_width, img_height = img.size
-
-            top_offset += img_height
-            remainging_height -= img_height
-            img_no += 1
-
-            # For the last screenshot, we cannot scroll past the bottom
-            # of the page, so we need to remove extra content from the screenshot
-            if missing_height > 0 and missing_height < img_height:
-                cropped_img = img.crop((0, missing_height, img_width, img_height))
-                cropped_img.save(screenshot_file, "PNG")
-            else:
-                with open(screenshot_file, "wb") as f:
-                    f.write(screenshot)
+        captures = []
+        png = None
+        if settings.SOSSE_SCREENSHOTS_FULL_PAGE and 0 < doc_height <= FULL_PAGE_MAX_HEIGHT:
+            try:
+                png = cls._full_page_screenshot(doc_width, doc_height)
+            except WebDriverException:
+                crawl_logger.debug(f"Full page screenshot failed on {url}, capturing by scrolling")
 
-        return img_no
+        if png:
+            crawl_logger.debug(f"Full page screenshot of {url} ({doc_width}x{doc_height})")
+            captures.append((png, 0))
+        else:
+            top_offset = 0
+            remainging_height = doc_height
+            while remainging_height > 0:
+                missing_height = cls.scroll_to_page(top_offset)
+                crawl_logger.debug(f"Scrolling to {top_offset} (missing {missing_height} / {remainging_height})")
+                screenshot = cls.driver.get_screenshot_as_png()
+
+                # Compute the height of the image, this is required because
+                # the size of the viewport is different from the size of the window
+                with Image.open(BytesIO(screenshot)) as img:
+                    img_height = img.size[1]
+                viewport_height = img_height
+
+                top_offset += img_height
+                remainging_height -= img_height
+
+                # For the last screenshot, we cannot scroll past the bottom
+                # of the page, so we need to remove extra content from the screenshot
+                crop_top = 0
+                if missing_height > 0 and missing_height < img_height:
+                    crop_top = missing_height
+                captures.append((screenshot, crop_top))
+
+        # The tile count and the future of the encoding
+        return ScreenshotEncoder.submit(captures, base_name, img_format, viewport_height)
 
     @classmethod
     def scroll_to_page(cls, height):
@@ -517,35 +834,9 @@ class BrowserSelenium(Browser):
         )
 
     @classmethod
-    def get_link_pos_abs(cls, selector):
-        return cls.driver.execute_script(
-            f"""
-            const e = document.evaluate('{selector}', document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null);
-
-            if (e === null) {{
-                return {{}}
-            }};
-            let el = e.singleNodeValue;
-            if (el === null) {{
-                return {{}}
-            }};
-            if (el.children.length === 1 && el.children[0].tagName === 'IMG') {{
-                el = el.children[0];
-            }}
-            const bodyRect = document.body.getBoundingClientRect();
-            const elemRect = el.getBoundingClientRect();
-            const pageWidth = {cls.screen_size()[0]};
-            if (elemRect.left >= pageWidth) {{
-                return {{}};
-            }}
-            return {{
-                elemLeft: elemRect.left,
-                elemTop: elemRect.top,
-                elemRight: Math.min(pageWidth, elemRect.right),
-                elemBottom: elemRect.bottom,
-            }}
-        """
-        )
+    def get_links_pos_abs(cls, selectors):
+        # Positions of all links are resolved in a single round trip
+        return cls.driver.execute_script(LINKS_POS_SCRIPT, selectors, cls.screen_size()[0])
 
     @classmethod
     def _find_elements_by_selector(cls, obj, selector):
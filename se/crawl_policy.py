@@ -15,7 +15,10 @@
 
 import logging
 import re
+from copy import copy
 from datetime import timedelta
+from threading import Lock
+from time import monotonic
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
@@ -27,7 +30,7 @@ from .browser_firefox import BrowserFirefox
 from .browser_request import BrowserRequest
 from .document import Document
 from .domain_setting import DomainSetting
-from .utils import plural
+from .utils import plural, table_version
 
 crawl_logger = logging.getLogger("crawler")
 BROWSER_MAP = {
@@ -58,6 +61,136 @@ def validate_url_regexp(val):
             raise ValidationError(error)
 
 
+# Syntax that Python compiles but matches differently from Postgresql AREs: POSIX bracket expressions,
+# back-references, non-greedy quantifiers, and alternations (longest match in AREs, first match in Python)
+PG_ONLY_SYNTAX = re.compile(r"\[\[[:.=]|\\[1-9]|[*+?}]\?|(?<!\\)\||^\*\*\*")
+
+
+class CrawlPolicyMatcher:
+    # In-process copy of the enabled policies with their regexps compiled. The copy is reloaded
+    # when the version of the se_crawlpolicy table is updated
+    CHECK_INTERVAL = 1.0
+
+    def __init__(self):
+        self.version = None
+        self.checked = 0
+        # (policies, default policy, policies matched by SQL), replaced as a whole since asset threads
+        # match concurrently
+        self.state = ([], None, {})
+        self.lock = Lock()
+
+    @property
+    def pg_policies(self):
+        return self.state[2]
+
+    def invalidate(self):
+        self.version = None
+
+    @staticmethod
+    def _compile(url_regex):
+        regexs = []
+        for line in CrawlPolicy.url_regex_lines(url_regex):
+            if PG_ONLY_SYNTAX.search(line):
+                raise re.error(f"{line} uses Postgresql specific syntax")
+            regexs.append(re.compile(line))
+        return regexs
+
+    def _reload(self):
+        if self.version is not None and monotonic() - self.checked < self.CHECK_INTERVAL:
+            return
+
+        with self.lock:
+            n = monotonic()
+            if self.version is not None and n - self.checked < self.CHECK_INTERVAL:
+                # Reloaded by another thread meanwhile
+                return
+
+            version = table_version("se_crawlpolicy")
+            if version != self.version:
+                policies = []
+                default = None
+                pg_policies = {}
+                for policy in CrawlPolicy.objects.filter(enabled=True).order_by("id"):
+                    if policy.url_regex == "(default)":
+                        default = policy
+                        continue
+                    try:
+                        regexs = self._compile(policy.url_regex)
+                    except re.error:
+                        # Postgresql specific syntax, the policy is matched by the database
+                        crawl_logger.debug(f"{policy.url_regex} cannot be compiled, falling back to SQL matching")
+                        if policy.url_regex_pg:
+                            pg_policies[policy.id] = policy
+                        continue
+                    if regexs:
+                        policies.append((policy, regexs))
+                self.state = (policies, default, pg_policies)
+                self.version = version
+            self.checked = n
+
+    @staticmethod
+    def _match(url, policies):
+        best = None
+        best_len = 0
+        for policy, regexs in policies:
+            # Same as REGEXP_SUBSTR on the alternation of the regexps: the leftmost match, then the longest
+            match_start = None
+            match_len = 0
+            for regex in regexs:
+                m = regex.search(url)
+                if m is None:
+                    continue
+                if match_start is None or m.start() < match_start:
+                    match_start = m.start()
+                    match_len = m.end() - m.start()
+                elif m.start() == match_start:
+                    match_len = max(match_len, m.end() - m.start())
+
+            if match_len > best_len:
+                best = policy
+                best_len = match_len
+        return best, best_len
+
+    @staticmethod
+    def _match_pg(urls, pg_policies):
+        # Longest match of the policies that can only be matched by the database, for each url
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """SELECT DISTINCT ON (u.url) u.url, p.id, LENGTH(REGEXP_SUBSTR(u.url, p.url_regex_pg)) AS match_len
+                FROM unnest(%s::text[]) AS u(url)
+                JOIN se_crawlpolicy p ON LENGTH(REGEXP_SUBSTR(u.url, p.url_regex_pg)) > 0
+                WHERE p.id = ANY(%s)
+                ORDER BY u.url, match_len DESC, p.id""",
+                [urls, list(pg_policies.keys())],
+            )
+            return {url: (pg_policies[policy_id], match_len) for url, policy_id, match_len in cursor.fetchall()}
+
+    def get_from_urls(self, urls):
+        self._reload()
+        policies, default, pg_policies = self.state
+        matches = {url: self._match(url, policies) for url in urls}
+
+        if pg_policies:
+            for url, (policy, match_len) in self._match_pg(list(matches.keys()), pg_policies).items():
+                if match_len > matches[url][1]:
+                    matches[url] = (policy, match_len)
+
+        result = {}
+        for url, (best, _) in matches.items():
+            if best is None:
+                # The default policy is picked up by the next reload once created
+                default = default or CrawlPolicy.create_default()
+                best = default
+            result[url] = copy(best)
+        return result
+
+    def get_from_url(self, url):
+        return self.get_from_urls([url])[url]
+
+
+CRAWL_POLICY_MATCHER = CrawlPolicyMatcher()
+
+
 class CrawlPolicy(models.Model):
     RECRAWL_NONE = "none"
     RECRAWL_CONSTANT = "constant"
@@ -239,13 +372,17 @@ class CrawlPolicy(models.Model):
                 return f"「{url_regexs[0]} (and {others})」"
         return "「<empty>」"
 
+    @staticmethod
+    def url_regex_lines(url_regex):
+        url_regexs = [line.strip() for line in url_regex.splitlines()]
+        return [line for line in url_regexs if not line.startswith("#") and line]
+
     def save(self, *args, **kwargs):
         if self.url_regex == "(default)":
             self.url_regex_pg = ".*"
             self.enabled = True
         else:
-            url_regexs = [line.strip() for line in self.url_regex.splitlines()]
-            url_regexs = [line for line in url_regexs if not line.startswith("#") and line]
+            url_regexs = self.url_regex_lines(self.url_regex)
             match len(url_regexs):
                 case 0:
                     self.url_regex_pg = ""
@@ -253,7 +390,14 @@ class CrawlPolicy(models.Model):
                     self.url_regex_pg = url_regexs[0]
                 case _:
                     self.url_regex_pg = "(" + "|".join(url_regexs) + ")"
-        return super().save(*args, **kwargs)
+        ret = super().save(*args, **kwargs)
+        CRAWL_POLICY_MATCHER.invalidate()
+        return ret
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        CRAWL_POLICY_MATCHER.invalidate()
+        return ret
 
     @staticmethod
     def create_default():
@@ -266,7 +410,7 @@ class CrawlPolicy(models.Model):
     @staticmethod
     def get_from_url(url, queryset=None):
         if queryset is None:
-            queryset = CrawlPolicy.objects.all()
+            return CRAWL_POLICY_MATCHER.get_from_url(url)
         queryset = queryset.filter(enabled=True)
         queryset = queryset.exclude(url_regex="(default)")
         queryset = queryset.exclude(url_regex_pg="")
@@ -292,6 +436,11 @@ class CrawlPolicy(models.Model):
 
         return policy
 
+    @staticmethod
+    def get_from_urls(urls):
+        # Same as get_from_url() for several urls, with a single query for the policies matched by the database
+        return CRAWL_POLICY_MATCHER.get_from_urls(sorted(set(urls)))
+
     @staticmethod
     def _default_browser():
         if settings.SOSSE_DEFAULT_BROWSER == "chromium":
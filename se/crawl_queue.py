@@ -42,7 +42,14 @@ class CrawlQueueContentView(AdminView):
         ).count()
 
         QUEUE_SIZE = 10
-        queue = list(Document.objects.filter(worker_no__isnull=False).order_by("id")[:QUEUE_SIZE])
+        # Crawlers claim documents in batches, only the current document of each worker is being crawled
+        crawling = set(WorkerStats.objects.filter(current_doc__isnull=False).values_list("current_doc_id", flat=True))
+        queue = list(Document.objects.filter(id__in=crawling, worker_no__isnull=False).order_by("id")[:QUEUE_SIZE])
+        queue = queue + list(
+            Document.objects.filter(worker_no__isnull=False)
+            .exclude(id__in=crawling)
+            .order_by("id")[: QUEUE_SIZE - len(queue)]
+        )
         if len(queue) < QUEUE_SIZE:
             queue = queue + list(
                 Document.objects.filter(crawl_last__isnull=True)
@@ -57,6 +64,7 @@ class CrawlQueueContentView(AdminView):
             )
         for doc in queue:
             doc.pending = True
+            doc.in_progress = doc.id in crawling and doc.worker_no is not None
 
         queue.reverse()
 
@@ -14,24 +14,27 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import mimetypes
 import os
 import re
 import unicodedata
+from bisect import bisect_right
+from collections import deque
 from datetime import datetime
 from hashlib import md5
-from time import mktime, sleep
+from itertools import islice
+from time import mktime
 from traceback import format_exc
 
 import feedparser
 from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
-from django.db import connection, models
+from django.db import connection, models, transaction
 from django.template.loader import get_template
 from django.utils.html import format_html
 from django.utils.timezone import now
-from langdetect import DetectorFactory, detect
-from langdetect.lang_detect_exception import LangDetectException
 from PIL import Image
 
 from .browser import AuthElemFailed, SkipIndexing
@@ -39,18 +42,75 @@ from .document_meta import DocumentMeta
 from .domain_setting import DomainSetting
 from .html_cache import HTMLAsset, HTMLCache
 from .html_snapshot import HTMLSnapshot
-from .url import url_beautify, validate_url
+from .lang_detect import LangDetector
+from .screenshot_encoder import ScreenshotEncoder
+from .snapshot_queue import SnapshotTask
+from .url import url_beautify, urlparse, validate_url
 from .utils import reverse_no_escape
 
 crawl_logger = logging.getLogger("crawler")
 
-DetectorFactory.seed = 0
+# Documents of domains that reached their rate limit or their concurrency limit
+# Documents of busy domains a worker steps over before waiting, when looking for a document to crawl
+BUSY_SKIP_MAX = 100
+
+
+class AccentTable(dict):
+    # str.translate table removing accents, characters are normalized on their first use
+    def __missing__(self, key):
+        # https://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-normalize-in-a-python-unicode-string
+        value = "".join(c for c in unicodedata.normalize("NFD", chr(key)) if unicodedata.category(c) != "Mn")
+        self[key] = value
+        return value
+
+
+class AccentLengthTable(dict):
+    # str.translate table replacing each character by the length of its normalized form
+    def __missing__(self, key):
+        value = chr(len(ACCENT_TABLE[key]))
+        self[key] = value
+        return value
+
+
+ACCENT_TABLE = AccentTable()
+ACCENT_LENGTH_TABLE = AccentLengthTable()
 
 
 def remove_accent(s):
     # append an ascii version to match on non-accented letters
-    # https://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-normalize-in-a-python-unicode-string
-    return "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
+    if s.isascii():
+        return s
+    return s.translate(ACCENT_TABLE)
+
+
+def remove_accent_offsets(s):
+    # Returns the normalized string, and the offsets mapping its positions to the original string
+    # The offsets are a flat list of (normalized position, delta) pairs, only characters with a normalized form of a
+    # different length change the delta
+    normalized = remove_accent(s)
+    offsets = []
+    if s.isascii():
+        return normalized, offsets
+
+    delta = 0
+    for match in re.finditer("[^\x01]", s.translate(ACCENT_LENGTH_TABLE), re.DOTALL):
+        length = ord(match.group())
+        norm_pos = match.start() - delta + length
+        delta += 1 - length
+        if offsets and offsets[-2] == norm_pos:
+            offsets[-1] = delta
+        else:
+            offsets += [norm_pos, delta]
+    return normalized, offsets
+
+
+def normalized_to_content_pos(offsets, pos):
+    if not offsets:
+        return pos
+    idx = bisect_right(offsets[::2], pos)
+    if idx == 0:
+        return pos
+    return pos + offsets[idx * 2 - 1]
 
 
 class RegConfigField(models.Field):
@@ -83,8 +143,11 @@ class Document(models.Model):
     normalized_title = models.TextField()
     content = models.TextField()
     normalized_content = models.TextField()
+    normalized_content_offsets = ArrayField(models.IntegerField(), default=list, blank=True)
     content_hash = models.TextField(null=True, blank=True)
     vector = SearchVectorField(null=True, blank=True)
+    # Weighted text of the links pointing to the document, maintained by database triggers
+    anchor_vector = SearchVectorField(null=True, blank=True)
     lang_iso_639_1 = models.CharField(max_length=6, null=True, blank=True, verbose_name="Language")
     vector_lang = RegConfigField(default="simple")
     mimetype = models.CharField(max_length=64, null=True, blank=True)
@@ -120,9 +183,19 @@ class Document(models.Model):
 
     supported_langs = None
 
+    # Documents claimed from the crawl queue by the workers of the current process
+    _claimed = {}
+
     class Meta:
         indexes = [
             GinIndex(fields=(("vector",))),
+            # Crawl queue order, new documents by id then documents to recrawl by crawl date
+            models.Index(fields=("id",), condition=models.Q(crawl_last__isnull=True), name="se_document_queue_new"),
+            models.Index(
+                fields=("crawl_next", "id"),
+                condition=models.Q(crawl_last__isnull=False),
+                name="se_document_queue_recrawl",
+            ),
             # models.Index(models.F('show_on_homepage') == models.Value(True),
             #             models.F('title').asc(), name='home_idx')
         ]
@@ -130,6 +203,7 @@ class Document(models.Model):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._image_name = None
+        self._domain_slot = None
 
     def __str__(self):
         return self.url
@@ -190,12 +264,7 @@ class Document(models.Model):
         return langs
 
     @classmethod
-    def _get_lang(cls, text):
-        try:
-            lang_iso = detect(text)
-        except LangDetectException:
-            lang_iso = None
-
+    def _get_lang(cls, lang_iso):
         lang_pg = settings.SOSSE_LANGDETECT_TO_POSTGRES.get(lang_iso, {}).get("name")
         if lang_pg not in cls.get_supported_langs():
             lang_pg = settings.SOSSE_FAIL_OVER_LANG
@@ -246,6 +315,7 @@ class Document(models.Model):
         self.content = ""
         self.content_hash = ""
         self.normalized_content = ""
+        self.normalized_content_offsets = []
         self.title = ""
         self.normalized_title = ""
         self.robotstxt_rejected = False
@@ -253,6 +323,11 @@ class Document(models.Model):
         Link.objects.filter(doc_from=self).delete()
 
     def _clear_dump_content(self):
+        if settings.SOSSE_SNAPSHOT_WORKERS:
+            SnapshotTask.supersede(self)
+            # A snapshot worker may have written the snapshot since the document was loaded,
+            # its task is deleted once done
+            self.has_html_snapshot = Document.objects.filter(id=self.id, has_html_snapshot=True).exists()
         self.delete_html()
         self.delete_screenshot()
         self.delete_thumbnail()
@@ -273,7 +348,6 @@ class Document(models.Model):
         template = get_template("se/feed.html")
         context = {"feed": parsed}
         page.content = template.render(context).encode("utf-8")
-        page.soup = None
 
         crawl_logger.debug(f"{self.url} is a rss/atom feed with {len(parsed['entries'])} items")
 
@@ -285,22 +359,32 @@ class Document(models.Model):
         self._index_log(f"text / {len(links['links'])} links extraction", stats, verbose)
 
         self.content = text
-        self.normalized_content = remove_accent(text)
-        self.lang_iso_639_1, self.vector_lang = self._get_lang((page.title or "") + "\n" + text)
+        self.normalized_content, self.normalized_content_offsets = remove_accent_offsets(text)
         self._index_log("remove accent", stats, verbose)
 
-        # The bulk request triggers a deadlock: Link.objects.bulk_create(links['links'])
-        for link in links["links"]:
-            link.save()
+        # The language is set when the page has been processed
+        self._lang_future = LangDetector.submit((page.title or "") + "\n" + text)
+
+        from .models import Link
+
+        # The vectors of the target documents are refreshed once by a statement trigger
+        Link.objects.bulk_create(links["links"])
         self._index_log("bulk", stats, verbose)
         return links
 
     def index(self, page, crawl_policy, verbose=False, force=False):
-        from .crawl_policy import CrawlPolicy
-
         n = now()
         stats = {"prev": n}
         self._index_log("start", stats, verbose)
+        try:
+            self._index(page, crawl_policy, n, stats, verbose, force)
+        finally:
+            # The language is applied even if indexing fails, since the new content is saved anyway
+            self._set_lang(stats, verbose)
+        self._index_log("done", stats, verbose)
+
+    def _index(self, page, crawl_policy, n, stats, verbose, force):
+        from .crawl_policy import CrawlPolicy
 
         current_hash = self.content_hash
         self._clear_base_content()
@@ -376,18 +460,32 @@ class Document(models.Model):
                 if crawl_policy.remove_nav_elements == CrawlPolicy.REMOVE_NAV_FROM_ALL:
                     page.remove_nav_elements()
                 snapshot = HTMLSnapshot(page, crawl_policy)
-                snapshot.snapshot()
-                self.has_html_snapshot = True
+                if settings.SOSSE_SNAPSHOT_WORKERS:
+                    # Assets are downloaded by the snapshot workers, so that the browser is not kept idle.
+                    # The worker sets has_html_snapshot once the snapshot is written
+                    if snapshot.prepare():
+                        SnapshotTask.queue(self, page, crawl_policy)
+                    else:
+                        self.has_html_snapshot = True
+                else:
+                    snapshot.snapshot()
+                    self.has_html_snapshot = True
         else:
             if crawl_policy.snapshot_html:
-                HTMLCache.write_asset(self.url, page.content, page, mimetype=self.mimetype)
+                HTMLCache.write_page_asset(self.url, page, mimetype=self.mimetype)
                 self.has_html_snapshot = True
 
         if self.mimetype.startswith("text/"):
             if crawl_policy.take_screenshots:
                 self.screenshot_index(links["links"], crawl_policy)
 
-        self._index_log("done", stats, verbose)
+    def _set_lang(self, stats, verbose):
+        lang_future = getattr(self, "_lang_future", None)
+        if lang_future is None:
+            return
+        self._lang_future = None
+        self.lang_iso_639_1, self.vector_lang = self._get_lang(LangDetector.result(lang_future))
+        self._index_log("language detection", stats, verbose)
 
     def convert_to_jpg(self):
         d = os.path.join(settings.SOSSE_SCREENSHOTS_DIR, self.image_name())
@@ -404,6 +502,7 @@ class Document(models.Model):
 
     def screenshot_index(self, links, crawl_policy):
         from .crawl_policy import CrawlPolicy
+        from .models import Link
 
         if crawl_policy.remove_nav_elements in (
             CrawlPolicy.REMOVE_NAV_FROM_ALL,
@@ -413,34 +512,27 @@ class Document(models.Model):
             browser.remove_nav_elements()
 
         browser = crawl_policy.get_browser(url=self.url)
-        img_count = browser.take_screenshots(self.url, self.image_name())
+        img_count, future = browser.take_screenshots(self.url, self.image_name(), crawl_policy.screenshot_format)
+        ScreenshotEncoder.track(future, (self.id, self.crawl_last))
         crawl_logger.debug(f"took {img_count} screenshots for {self.url} with {browser}")
         self.screenshot_count = img_count
         self.screenshot_format = crawl_policy.screenshot_format
         w, h = browser.screen_size()
         self.screenshot_size = f"{w}x{h}"
 
-        if crawl_policy.screenshot_format == Document.SCREENSHOT_JPG:
-            self.convert_to_jpg()
+        if not links:
+            return
 
         browser.scroll_to_page(0)
-        for i, link in enumerate(links):
-            loc = browser.get_link_pos_abs(link.css_selector)
-            if loc == {}:
+        positions = browser.get_links_pos_abs([link.css_selector for link in links])
+        located = []
+        for link, pos in zip(links, positions):
+            if not pos or not all(isinstance(v, (int, float)) for v in pos):
                 continue
-            for attr in ("elemLeft", "elemTop", "elemRight", "elemBottom"):
-                if not isinstance(loc[attr], (int, float)):
-                    break
-            else:
-                link.screen_pos = ",".join(
-                    [
-                        str(int(loc["elemLeft"])),
-                        str(int(loc["elemTop"])),
-                        str(int(loc["elemRight"] - loc["elemLeft"])),
-                        str(int(loc["elemBottom"] - loc["elemTop"])),
-                    ]
-                )
-                link.save()
+            left, top, right, bottom = pos
+            link.screen_pos = ",".join(str(int(v)) for v in (left, top, right - left, bottom - top))
+            located.append(link)
+        Link.objects.bulk_update(located, ["screen_pos"], batch_size=1000)
 
     def set_error(self, err):
         self.error = err
@@ -451,48 +543,64 @@ class Document(models.Model):
 
     @staticmethod
     def queue(url, parent_policy, parent):
+        return Document.queue_bulk([url], parent_policy, parent).get(url)
+
+    @staticmethod
+    def _recurse_depth(parent_policy, parent):
         from .crawl_policy import CrawlPolicy
-        from .models import ExcludedUrl
 
-        if ExcludedUrl.objects.filter(url=url, starting_with=False).first():
-            crawl_logger.debug(f"skipping ExcludedUrl {url}")
-            return None
+        if parent_policy.recursion == CrawlPolicy.CRAWL_ALL and parent_policy.recursion_depth > 0:
+            return parent_policy.recursion_depth
+        if parent_policy.recursion == CrawlPolicy.CRAWL_ON_DEPTH and parent.crawl_recurse > 1:
+            return parent.crawl_recurse - 1
+        return None
 
-        if ExcludedUrl.objects.filter(starting_with=True).extra(where=["starts_with(%s, url)"], params=[url]).first():
-            crawl_logger.debug(f"skipping ExcludedUrl {url}")
-            return None
+    @staticmethod
+    def queue_bulk(urls, parent_policy, parent):
+        # Returns a dict mapping the urls to their document, urls that were not queued are missing
+        from .crawl_policy import CrawlPolicy
+        from .models import ExcludedUrl
 
-        crawl_policy = CrawlPolicy.get_from_url(url)
-        crawl_logger.debug(f"{url} matched {crawl_policy.url_regex}, {crawl_policy.recursion}")
+        # Sorted to insert rows in the same order in all crawlers
+        urls = sorted(set(urls))
+        queued = ExcludedUrl.filter_urls(urls)
+        for url in set(urls) - set(queued):
+            crawl_logger.debug(f"skipping ExcludedUrl {url}")
 
-        if crawl_policy.recursion == CrawlPolicy.CRAWL_ALL or parent is None:
-            crawl_logger.debug(f"{url} -> always crawl")
-            return Document.objects.get_or_create(url=url, hidden=crawl_policy.hide_documents)[0]
+        policies = CrawlPolicy.get_from_urls(queued)
+        url_depth = None
+        created = []
+        recursed = []
+        for url in queued:
+            crawl_policy = policies[url]
+            crawl_logger.debug(f"{url} matched {crawl_policy.url_regex}, {crawl_policy.recursion}")
+
+            if crawl_policy.recursion == CrawlPolicy.CRAWL_ALL or parent is None:
+                crawl_logger.debug(f"{url} -> always crawl")
+                created.append(Document(url=url, hidden=crawl_policy.hide_documents))
+                continue
 
-        if crawl_policy.recursion == CrawlPolicy.CRAWL_NEVER:
-            crawl_logger.debug(f"{url} -> never crawl")
-            return Document.objects.filter(url=url).first()
+            if crawl_policy.recursion == CrawlPolicy.CRAWL_NEVER:
+                crawl_logger.debug(f"{url} -> never crawl")
+                continue
 
-        doc = None
-        url_depth = None
+            # The depth only depends on the parent, it is the same for all urls
+            if url_depth is None:
+                url_depth = Document._recurse_depth(parent_policy, parent) or 0
 
-        if parent_policy.recursion == CrawlPolicy.CRAWL_ALL and parent_policy.recursion_depth > 0:
-            doc = Document.objects.get_or_create(url=url, hidden=crawl_policy.hide_documents)[0]
-            url_depth = max(parent_policy.recursion_depth, doc.crawl_recurse)
-            crawl_logger.debug(f"{url} -> recurse for {url_depth}")
-        elif parent_policy.recursion == CrawlPolicy.CRAWL_ON_DEPTH and parent.crawl_recurse > 1:
-            doc = Document.objects.get_or_create(url=url, hidden=crawl_policy.hide_documents)[0]
-            url_depth = max(parent.crawl_recurse - 1, doc.crawl_recurse)
-            crawl_logger.debug(f"{url} -> recurse at {url_depth}")
-        else:
-            crawl_logger.debug(f"{url} -> no recurse (from parent {parent_policy.recursion})")
+            if url_depth:
+                crawl_logger.debug(f"{url} -> recurse at {url_depth}")
+                created.append(Document(url=url, hidden=crawl_policy.hide_documents))
+                recursed.append(url)
+            else:
+                crawl_logger.debug(f"{url} -> no recurse (from parent {parent_policy.recursion})")
 
-        if doc and url_depth != doc.crawl_recurse:
-            doc.crawl_recurse = url_depth
-            doc.save()
+        if created:
+            Document.objects.bulk_create(created, ignore_conflicts=True)
+        if recursed:
+            Document.objects.filter(url__in=recursed, crawl_recurse__lt=url_depth).update(crawl_recurse=url_depth)
 
-        doc = doc or Document.objects.filter(url=url).first()
-        return doc
+        return Document.objects.in_bulk(queued, field_name="url")
 
     def _schedule_next(self, changed, crawl_policy):
         from .crawl_policy import CrawlPolicy
@@ -519,14 +627,96 @@ class Document(models.Model):
             self.crawl_next = self.crawl_last + self.crawl_dt
 
     @staticmethod
-    def crawl(worker_no):
-        from .crawl_policy import CrawlPolicy
-        from .models import Link, WorkerStats
+    def reset_failed_screenshots():
+        # The documents are saved before their screenshots are encoded, the count is reset when encoding failed
+        for doc_id, crawl_last in ScreenshotEncoder.failures():
+            Document.objects.filter(id=doc_id, crawl_last=crawl_last).update(screenshot_count=0)
 
+    @staticmethod
+    def crawl(worker_no):
+        Document.reset_failed_screenshots()
         doc = Document.pick_queued(worker_no)
         if doc is None:
             return False
 
+        from .models import WorkerStats
+
+        domain_slot = doc._domain_slot
+        try:
+            Document._preload_next(worker_no)
+            Document._crawl(doc, worker_no)
+        finally:
+            if domain_slot:
+                domain_slot.release_slot()
+            WorkerStats.objects.filter(worker_no=worker_no).update(current_doc=None)
+        return True
+
+    @staticmethod
+    def _preload_next(worker_no):
+        # Let the browsers load the next claimed documents in background tabs
+        from .browser_selenium import BrowserSelenium
+        from .cookie import Cookie
+        from .crawl_policy import BROWSER_MAP, CrawlPolicy
+
+        if settings.SOSSE_BROWSER_TABS <= 1:
+            return
+
+        next_ids = list(islice(Document._claimed.get(worker_no, ()), settings.SOSSE_BROWSER_TABS - 1))
+        docs = {
+            doc_id: (url, mimetype)
+            for doc_id, url, mimetype in Document.objects.filter(id__in=next_ids, worker_no=worker_no).values_list(
+                "id", "url", "mimetype"
+            )
+        }
+        preloads = {browser: [] for browser in BROWSER_MAP.values() if issubclass(browser, BrowserSelenium)}
+
+        for doc_id in next_ids:
+            url, mimetype = docs.get(doc_id, (None, None))
+            if url is None or not (url.startswith("http://") or url.startswith("https://")):
+                continue
+
+            # Downloads would land in the download dir shared with the current page
+            if mimetype and mimetype != "text/html":
+                continue
+            guessed_mimetype = mimetypes.guess_type(urlparse(url).path)[0]
+            if guessed_mimetype and guessed_mimetype not in ("text/html", "application/xhtml+xml"):
+                continue
+
+            # The page must be loaded exactly as the crawl would: the browser is known, no cookie
+            # needs to be loaded first and fetching it early cannot break the domain limits
+            domain_setting = DomainSetting.objects.filter(domain=urlparse(url).netloc).first()
+            if (
+                domain_setting is None
+                or domain_setting.requests_per_sec
+                or domain_setting.max_concurrency
+                or Cookie.get_from_url(url)
+            ):
+                continue
+
+            crawl_policy = CrawlPolicy.get_from_url(url)
+            try:
+                browser = crawl_policy.get_browser(domain_setting=domain_setting)
+            except Exception:
+                continue
+
+            # robots.txt is not fetched from here, robots_authorized() would load it when unknown or outdated
+            if not domain_setting.ignore_robots and (
+                domain_setting.robots_status == DomainSetting.ROBOTS_UNKNOWN
+                or domain_setting.ua_hash() != domain_setting.robots_ua_hash
+            ):
+                continue
+
+            if browser in preloads and domain_setting.robots_authorized(url):
+                preloads[browser].append(url)
+
+        for browser, browser_urls in preloads.items():
+            browser.preload(browser_urls)
+
+    @staticmethod
+    def _crawl(doc, worker_no):
+        from .crawl_policy import CrawlPolicy
+        from .models import Link, WorkerStats
+
         worker_stats = WorkerStats.get_worker(worker_no)
         if worker_stats.state != "running":
             worker_stats.update_state("running")
@@ -543,7 +733,9 @@ class Document(models.Model):
             crawl_policy = CrawlPolicy.get_from_url(doc.url)
             crawl_logger.debug(f"Crawling {doc.url} with policy {crawl_policy}")
             try:
-                WorkerStats.objects.filter(id=worker_stats.id).update(doc_processed=models.F("doc_processed") + 1)
+                WorkerStats.objects.filter(id=worker_stats.id).update(
+                    doc_processed=models.F("doc_processed") + 1, current_doc=doc
+                )
                 doc.worker_no = None
                 doc.crawl_last = now()
 
@@ -621,40 +813,76 @@ class Document(models.Model):
             if worker_stats.state == "paused":
                 doc.worker_no = None
                 doc.save()
+                Document.release_claims(worker_no)
                 break
 
-        return True
-
     @staticmethod
-    def pick_queued(worker_no):
-        while True:
-            doc = Document.objects.filter(worker_no__isnull=True, crawl_last__isnull=True).order_by("id").first()
-            if doc is None:
-                doc = (
-                    Document.objects.filter(
-                        worker_no__isnull=True,
-                        crawl_last__isnull=False,
-                        crawl_next__lte=now(),
-                    )
+    def claim_queued(worker_no, batch_size):
+        # Rows locked by other workers are skipped, so that concurrent workers
+        # claim distinct batches instead of competing for the same documents
+        n = now()
+        with transaction.atomic():
+            queued = Document.objects.select_for_update(skip_locked=True).filter(worker_no__isnull=True)
+
+            # New documents are crawled first, by id, then documents to recrawl by crawl date
+            doc_ids = list(
+                queued.filter(crawl_last__isnull=True).order_by("id").values_list("id", flat=True)[:batch_size]
+            )
+            if len(doc_ids) < batch_size:
+                doc_ids += list(
+                    queued.filter(crawl_last__isnull=False, crawl_next__lte=n)
                     .order_by("crawl_next", "id")
-                    .first()
+                    .values_list("id", flat=True)[: batch_size - len(doc_ids)]
                 )
-                if doc is None:
-                    return None
-
-            updated = Document.objects.filter(id=doc.id, worker_no__isnull=True).update(worker_no=worker_no)
-
-            if updated == 0:
-                sleep(0.1)
-                continue
+            if doc_ids:
+                Document.objects.filter(id__in=doc_ids).update(worker_no=worker_no)
+        return doc_ids
 
-            try:
-                doc.refresh_from_db()
-            except Document.DoesNotExist:
-                sleep(0.1)
-                continue
+    @staticmethod
+    def pick_queued(worker_no):
+        claimed = Document._claimed.setdefault(worker_no, deque())
+        # Documents of busy domains stay claimed until a document is picked, so that the next
+        # claims step over them, then they are released to be picked later
+        busy_ids = []
+        busy_domains = set()
+        try:
+            while True:
+                if not claimed:
+                    if len(busy_ids) >= BUSY_SKIP_MAX:
+                        return None
+                    claimed.extend(Document.claim_queued(worker_no, settings.SOSSE_CRAWLER_BATCH_SIZE))
+                    if not claimed:
+                        return None
+
+                doc_id = claimed.popleft()
+                doc = Document.objects.filter(id=doc_id, worker_no=worker_no).first()
+                if doc is None:
+                    # The document was deleted, or released, since it was claimed
+                    continue
+
+                domain = urlparse(doc.url).netloc
+                if domain in busy_domains:
+                    busy_ids.append(doc.id)
+                    continue
+
+                domain_setting = DomainSetting.objects.filter(domain=domain).first()
+                if domain_setting and not domain_setting.acquire_slot():
+                    busy_ids.append(doc.id)
+                    busy_domains.add(domain)
+                    continue
+
+                doc._domain_slot = domain_setting
+                return doc
+        finally:
+            if busy_ids:
+                Document.objects.filter(id__in=busy_ids, worker_no=worker_no).update(worker_no=None)
 
-            return doc
+    @staticmethod
+    def release_claims(worker_no):
+        claimed = Document._claimed.pop(worker_no, None)
+        if claimed:
+            crawl_logger.debug(f"Worker:{worker_no} releasing {len(claimed)} claimed documents")
+            Document.objects.filter(id__in=claimed, worker_no=worker_no).update(worker_no=None)
 
     @staticmethod
     def pick_or_create(url, worker_no):
@@ -15,13 +15,17 @@
 
 import logging
 import re
+from datetime import timedelta
 from hashlib import md5
 from urllib.parse import urlparse
 
 import fake_useragent
 import requests
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.utils.timezone import now
 
 from .browser import TooManyRedirects
 
@@ -50,6 +54,12 @@ def user_agent():
     return UA_STR
 
 
+def validate_requests_per_sec(val):
+    # 0 would mean no limit, which is expressed by leaving the field empty
+    if val is not None and val <= 0:
+        raise ValidationError("The number of requests per second must be greater than 0")
+
+
 class DomainSetting(models.Model):
     BROWSE_DETECT = "detect"
     BROWSE_CHROMIUM = "selenium"
@@ -93,6 +103,24 @@ class DomainSetting(models.Model):
     robots_disallow = models.TextField(default="", blank=True, verbose_name="robots.txt disallow rules")
     ignore_robots = models.BooleanField(default=False, verbose_name="Ignore robots.txt")
 
+    requests_per_sec = models.FloatField(
+        null=True,
+        blank=True,
+        validators=[validate_requests_per_sec],
+        verbose_name="Max. requests per second",
+        help_text="Maximum number of pages fetched per second from this domain by all crawlers, leave empty for no limit",
+    )
+    max_concurrency = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        validators=[MinValueValidator(1)],
+        verbose_name="Max. concurrent crawlers",
+        help_text="Maximum number of crawlers fetching pages from this domain at the same time, leave empty for no limit",
+    )
+    # Scheduling state, shared by all crawlers
+    active_crawlers = models.PositiveIntegerField(default=0)
+    next_request = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return self.domain
 
@@ -227,6 +255,29 @@ class DomainSetting(models.Model):
         crawl_logger.debug(f"{url}: robots.txt denied")
         return False
 
+    def acquire_slot(self):
+        # Reserve the right to fetch a page from the domain, the conditions are checked
+        # by the UPDATE statement so that concurrent crawlers cannot exceed the limits
+        n = now()
+        next_request = None
+        if self.requests_per_sec:
+            next_request = n + timedelta(seconds=1 / self.requests_per_sec)
+
+        acquired = (
+            DomainSetting.objects.filter(id=self.id)
+            .filter(models.Q(next_request__isnull=True) | models.Q(next_request__lte=n))
+            .filter(models.Q(max_concurrency__isnull=True) | models.Q(active_crawlers__lt=models.F("max_concurrency")))
+            .update(active_crawlers=models.F("active_crawlers") + 1, next_request=next_request)
+        )
+        if not acquired:
+            crawl_logger.debug(f"{self.domain}: rate limit or concurrency limit reached")
+        return bool(acquired)
+
+    def release_slot(self):
+        DomainSetting.objects.filter(id=self.id, active_crawlers__gt=0).update(
+            active_crawlers=models.F("active_crawlers") - 1
+        )
+
     @classmethod
     def get_from_url(cls, url, default_browse_mode=None):
         from .crawl_policy import CrawlPolicy
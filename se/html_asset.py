@@ -117,7 +117,8 @@ class HTMLAsset(models.Model):
         from .html_snapshot import css_parser
 
         assets = set()
-        soup = BeautifulSoup(content, "html5lib")
+        # Snapshots are serialized by BeautifulSoup, lxml is enough to read their attributes back
+        soup = BeautifulSoup(content, "lxml")
         for elem in soup.find_all(True):
             if elem.name == "style":
                 if elem.string:
@@ -56,7 +56,7 @@ class CacheRefresh(Exception):
 class HTMLCache:
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Caching#expires_or_max-age
     @staticmethod
-    def _max_age_check(asset, max_file_size):
+    def _max_age_check(asset, max_file_size, **kwargs):
         if (asset.max_age and asset.last_modified) or asset.etag:
             if (
                 asset.max_age
@@ -86,6 +86,7 @@ class HTMLCache:
                     check_status=True,
                     max_file_size=max_file_size,
                     headers=headers,
+                    **kwargs,
                 )
 
                 if page.status_code == 304:
@@ -114,8 +115,10 @@ class HTMLCache:
 
     @staticmethod
     def _cache_check(url, max_file_size):
-        asset = HTMLAsset.objects.filter(url=url).order_by("download_date").last()
+        HTMLCache._asset_check(HTMLCache.cached_asset(url), max_file_size)
 
+    @staticmethod
+    def _asset_check(asset, max_file_size, **kwargs):
         if not asset:
             logger.debug("cache miss, asset does not exist")
             raise CacheMiss()
@@ -124,18 +127,21 @@ class HTMLCache:
             logger.debug("cache miss, force refresh")
             raise CacheMiss()
 
-        HTMLCache._max_age_check(asset, max_file_size)
+        HTMLCache._max_age_check(asset, max_file_size, **kwargs)
         HTMLCache._heuristic_check(asset)
         logger.debug("cache miss, cache outdated")
         raise CacheMiss()
 
     @staticmethod
-    def download(url, max_file_size):
+    def cached_asset(url):
+        return HTMLAsset.objects.filter(url=url).order_by("download_date").last()
+
+    @staticmethod
+    def fetch(url, asset, max_file_size, **kwargs):
+        # Same as download() without database access, so that it can run in a thread. The cached asset is
+        # looked up by the caller, which takes the reference on the asset of a CacheHit
         try:
-            HTMLCache._cache_check(url, max_file_size)
-        except CacheHit as e:
-            e.asset.increment_ref()
-            raise
+            HTMLCache._asset_check(asset, max_file_size, **kwargs)
         except CacheRefresh as e:
             return e.page
         except CacheMiss:
@@ -146,9 +152,18 @@ class HTMLCache:
             check_status=True,
             max_file_size=max_file_size,
             headers={"Accept": "*/*"},
+            **kwargs,
         )
         return page
 
+    @staticmethod
+    def download(url, max_file_size):
+        try:
+            return HTMLCache.fetch(url, HTMLCache.cached_asset(url), max_file_size)
+        except CacheHit as e:
+            e.asset.increment_ref()
+            raise
+
     @staticmethod
     def create_cache_entry(url, filename, page=None):
         asset, created = HTMLAsset.objects.get_or_create(url=url, filename=filename)
@@ -168,8 +183,18 @@ class HTMLCache:
         if not isinstance(content, bytes):
             raise ValueError("content must be bytes")
 
+        _hash = md5(content, usedforsecurity=False).hexdigest()
+        return HTMLCache._write(url, _hash, lambda fd: fd.write(content), page, extension, mimetype)
+
+    @staticmethod
+    def write_page_asset(url, page, extension=None, mimetype=None):
+        # Pages stored in a temporary file are copied without being loaded in memory
+        return HTMLCache._write(url, page.content_md5(), page.write_content, page, extension, mimetype)
+
+    @staticmethod
+    def _write(url, _hash, write_content, page, extension, mimetype):
         logger.debug(f"html_write_asset for {url}")
-        _hash = md5(content, usedforsecurity=False).hexdigest()[:HTML_SNAPSHOT_HASH_LEN]
+        _hash = _hash[:HTML_SNAPSHOT_HASH_LEN]
 
         # Build the extension using mimetypes, because the appropriate extension
         # is required by Nginx when the file is served statically
@@ -194,7 +219,7 @@ class HTMLCache:
         os.makedirs(dest_dir, 0o755, exist_ok=True)
 
         with open(dest, "wb") as fd:
-            fd.write(content)
+            write_content(fd)
 
         return HTMLCache.create_cache_entry(url, filename_url, page)
 
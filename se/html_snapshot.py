@@ -15,17 +15,23 @@
 
 import logging
 import re
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
 from traceback import format_exc
 
 import cssutils
 from bs4 import NavigableString
 from django.conf import settings
+from django.db import transaction
 from django.shortcuts import reverse
 from django.utils.html import format_html
 
 from .browser import SkipIndexing
+from .browser_request import BrowserRequest
+from .cookie import Cookie
+from .html_asset import HTMLAsset
 from .html_cache import CacheHit, HTMLCache
-from .url import absolutize_url, has_browsable_scheme
+from .url import absolutize_url, has_browsable_scheme, urlparse
 
 logger = logging.getLogger("html_snapshot")
 
@@ -186,14 +192,24 @@ class CSSUtilsParser:
 
 
 class HTMLSnapshot:
+    _pool = None
+    _pool_size = None
+    _pool_lock = Lock()
+
     def __init__(self, page, crawl_policy):
         self.page = page
         self.crawl_policy = crawl_policy
         self.assets = set()
-        self.assets = set()
         self.asset_urls = set()
         self.base_url = page.base_url()
 
+        # Urls found by a first walk of the page, downloaded by a thread pool
+        self.collecting = False
+        self.collected_urls = []
+        self.prefetched = {}
+        self.host_semaphores = {}
+        self.host_semaphores_lock = Lock()
+
     def _clear_assets(self):
         for asset in self.assets:
             asset.remove_ref()
@@ -205,6 +221,11 @@ class HTMLSnapshot:
         self.asset_urls.add(asset.url)
 
     def snapshot(self):
+        if self.prepare():
+            self.archive()
+
+    def prepare(self):
+        # Steps requiring the browser that loaded the page
         from .browser_chromium import BrowserChromium
         from .browser_firefox import BrowserFirefox
 
@@ -213,19 +234,53 @@ class HTMLSnapshot:
             if self.page.browser in (BrowserChromium, BrowserFirefox):
                 self.build_style()
             self.sanitize()
+        except Exception:  # noqa
+            if getattr(settings, "TEST_MODE", False) and not getattr(settings, "TEST_HTML_ERROR_HANDLING", False):
+                raise
+            self._write_error()
+            return False
+        return True
+
+    def archive(self, can_write=None):
+        # can_write is called in the transaction writing the snapshot, which is dropped when it returns False
+        error = None
+        try:
             self.handle_assets()
-            HTMLCache.write_asset(self.page.url, self.page.dump_html(), self.page, extension=".html")
-        except Exception as e:  # noqa
+        except Exception:  # noqa
             if getattr(settings, "TEST_MODE", False) and not getattr(settings, "TEST_HTML_ERROR_HANDLING", False):
                 raise
-            logger.error(f"html_snapshot of {self.page.url} failed:\n{format_exc()}")
-            content = f"An error occured while downloading {self.page.url}:\n{format_exc()}"
-            content = format_html("<pre>{}</pre>", content)
-            content = content.encode("utf-8")
-            HTMLCache.write_asset(self.page.url, content, self.page, extension=".html")
-            self._clear_assets()
+            error = format_exc()
+
+        with transaction.atomic():
+            if can_write is not None and not can_write():
+                logger.debug(f"html_snapshot of {self.page.url} is obsolete, dropping it")
+                self._clear_assets()
+                return False
+
+            if error is None:
+                try:
+                    HTMLCache.write_asset(self.page.url, self.page.dump_html(), self.page, extension=".html")
+                except Exception:  # noqa
+                    if getattr(settings, "TEST_MODE", False) and not getattr(
+                        settings, "TEST_HTML_ERROR_HANDLING", False
+                    ):
+                        raise
+                    error = format_exc()
+
+            if error is not None:
+                self._write_error(error)
 
         logger.debug(f"html_snapshot of {self.page.url} done")
+        return True
+
+    def _write_error(self, error=None):
+        error = error or format_exc()
+        logger.error(f"html_snapshot of {self.page.url} failed:\n{error}")
+        content = f"An error occured while downloading {self.page.url}:\n{error}"
+        content = format_html("<pre>{}</pre>", content)
+        content = content.encode("utf-8")
+        HTMLCache.write_asset(self.page.url, content, self.page, extension=".html")
+        self._clear_assets()
 
     def sanitize(self):
         logger.debug(f"html_sanitize of {self.page.url}")
@@ -276,6 +331,81 @@ class HTMLSnapshot:
     def handle_assets(self):
         logger.debug(f"html_handle_assets for {self.page.url}")
 
+        if settings.SOSSE_HTML_ASSET_WORKERS == 1:
+            self._walk_assets()
+            return
+
+        self.collecting = True
+        try:
+            self._walk_assets()
+        finally:
+            self.collecting = False
+
+        # The cached assets and the cookies are loaded here, the pool threads only download
+        cached = {
+            asset.url: asset
+            for asset in HTMLAsset.objects.filter(url__in=self.collected_urls).order_by("download_date")
+        }
+        pool = self._get_pool()
+        for url in self.collected_urls:
+            jar = BrowserRequest._get_cookies(url)
+            self.prefetched[url] = (pool.submit(self._prefetch, url, cached.get(url), jar), jar)
+
+        try:
+            self._walk_assets()
+        finally:
+            self._clear_prefetched()
+
+    @classmethod
+    def _get_pool(cls):
+        # A single pool is shared by the snapshots of the process
+        with cls._pool_lock:
+            if cls._pool_size != settings.SOSSE_HTML_ASSET_WORKERS:
+                if cls._pool is not None:
+                    cls._pool.shutdown(wait=False)
+                cls._pool = ThreadPoolExecutor(settings.SOSSE_HTML_ASSET_WORKERS)
+                cls._pool_size = settings.SOSSE_HTML_ASSET_WORKERS
+            return cls._pool
+
+    def _host_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self.host_semaphores_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = BoundedSemaphore(settings.SOSSE_HTML_ASSET_HOST_WORKERS)
+            return self.host_semaphores[host]
+
+    def _prefetch(self, url, asset, jar):
+        # Runs in the pool, the database must not be used here
+        with self._host_semaphore(url):
+            return HTMLCache.fetch(url, asset, settings.SOSSE_MAX_HTML_ASSET_SIZE, cookie_jar=jar)
+
+    def _clear_prefetched(self):
+        # Wait for the downloads that were not used
+        for url, (future, _) in self.prefetched.items():
+            try:
+                future.result()
+            except CacheHit:
+                pass
+            except Exception as e:
+                logger.debug(f"unused asset {url} failed to download: {e}")
+        self.prefetched = {}
+
+    def _download(self, url):
+        prefetched = self.prefetched.pop(url, None)
+        if prefetched is None:
+            return HTMLCache.download(url, settings.SOSSE_MAX_HTML_ASSET_SIZE)
+
+        future, jar = prefetched
+        try:
+            page = future.result()
+        except CacheHit as e:
+            e.asset.increment_ref()
+            raise
+        Cookie.set_from_jar(url, jar)
+        return page
+
+    def _walk_assets(self):
+        # When collecting urls, the DOM is not modified
         for elem in self.page.get_soup().find_all(True):
             if elem.name == "base":
                 continue
@@ -283,11 +413,15 @@ class HTMLSnapshot:
             if elem.name == "style":
                 logger.debug(f"handle_css of {self.page.url} (<style>)")
                 if elem.string:
-                    elem.string = css_parser().handle_css(self, self.base_url, elem.string, False)
+                    css = css_parser().handle_css(self, self.base_url, elem.string, False)
+                    if not self.collecting:
+                        elem.string = css
 
             if elem.attrs.get("style"):
                 logger.debug(f"handle_css of {self.page.url} (style={elem.attrs['style']})")
-                elem.attrs["style"] = css_parser().handle_css(self, self.base_url, elem.attrs["style"], True)
+                css = css_parser().handle_css(self, self.base_url, elem.attrs["style"], True)
+                if not self.collecting:
+                    elem.attrs["style"] = css
 
             if "srcset" in elem.attrs:
                 urls = elem.attrs["srcset"].strip()
@@ -324,8 +458,8 @@ class HTMLSnapshot:
                             url = url.replace(",", "%2C")
 
                     _urls.append(url + params)
-                urls = ", ".join(_urls)
-                elem["srcset"] = urls
+                if not self.collecting:
+                    elem["srcset"] = ", ".join(_urls)
 
             for attr in ("src", "href"):
                 if attr not in elem.attrs:
@@ -341,7 +475,8 @@ class HTMLSnapshot:
                 url = absolutize_url(self.base_url, url)
 
                 if elem.name in ("a", "frame", "iframe"):
-                    elem.attrs[attr] = "/html/" + url
+                    if not self.collecting:
+                        elem.attrs[attr] = "/html/" + url
                     break
                 else:
                     if url == self.page.url:
@@ -361,10 +496,13 @@ class HTMLSnapshot:
 
                         logger.debug(f"downloading asset from {attr} attribute / {elem.name}")
                         filename_url = self.download_asset(url, force_mime)
-                    elem.attrs[attr] = filename_url
+                    if not self.collecting:
+                        elem.attrs[attr] = filename_url
 
     def download_asset(self, url, force_mime=None):
         if getattr(settings, "TEST_HTML_ERROR_HANDLING", False) and url == "http://127.0.0.1/test-exception":
+            if self.collecting:
+                return url
             raise Exception("html_error_handling test")
 
         if self.crawl_policy.snapshot_exclude_url_re and re.match(self.crawl_policy.snapshot_exclude_url_re, url):
@@ -377,14 +515,19 @@ class HTMLSnapshot:
                     return settings.SOSSE_HTML_SNAPSHOT_URL + asset.filename
             raise Exception("asset not found")
 
+        if self.collecting:
+            if url not in self.collected_urls:
+                self.collected_urls.append(url)
+            return url
+
         logger.debug(f"download_asset {url} (forced mime {force_mime})")
         mimetype = None
         extension = None
         page = None
+        content = None
 
         try:
-            page = HTMLCache.download(url, settings.SOSSE_MAX_HTML_ASSET_SIZE)
-            content = page.content
+            page = self._download(url)
             mimetype = force_mime or page.mimetype
 
             if mimetype == "text/html":
@@ -400,7 +543,7 @@ class HTMLSnapshot:
 
             if mimetype == "text/css":
                 logger.debug(f"handle_css of {url} due to mimetype")
-                content = css_parser().handle_css(self, url, content, False).encode("utf-8")
+                content = css_parser().handle_css(self, url, page.content, False).encode("utf-8")
 
         except CacheHit as e:
             logger.debug(f"CACHE HIT {url}")
@@ -417,9 +560,12 @@ class HTMLSnapshot:
             if getattr(settings, "TEST_MODE", False):
                 raise
 
-        if not isinstance(content, bytes):
-            raise ValueError(f"content is not bytes: {content.__class__.__name__}")
-        asset = HTMLCache.write_asset(url, content, page, extension=extension, mimetype=mimetype)
+        if content is None:
+            asset = HTMLCache.write_page_asset(url, page, extension=extension, mimetype=mimetype)
+        else:
+            if not isinstance(content, bytes):
+                raise ValueError(f"content is not bytes: {content.__class__.__name__}")
+            asset = HTMLCache.write_asset(url, content, page, extension=extension, mimetype=mimetype)
         if extension == ".html":
             return settings.SOSSE_HTML_SNAPSHOT_URL + asset
 
@@ -0,0 +1,85 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from langdetect import DetectorFactory, detect
+from langdetect.detector_factory import init_factory
+from langdetect.lang_detect_exception import LangDetectException
+
+crawl_logger = logging.getLogger("crawler")
+
+DetectorFactory.seed = 0
+
+# Number of parts of the text the sample is made of
+SAMPLE_CHUNKS = 4
+
+
+def lang_sample(text, size):
+    # langdetect preprocesses the whole text before analyzing its beginning,
+    # the sample is made of chunks spread over the text instead
+    if len(text) <= size:
+        return text
+
+    chunk_size = size // SAMPLE_CHUNKS
+    step = (len(text) - chunk_size) // (SAMPLE_CHUNKS - 1)
+    return "\n".join(text[i * step : i * step + chunk_size] for i in range(SAMPLE_CHUNKS))
+
+
+def detect_lang(text):
+    try:
+        return detect(text)
+    except LangDetectException:
+        return None
+
+
+class LangDetector:
+    # Detection runs in worker processes, while the crawler keeps processing the page
+    _pool = None
+
+    @classmethod
+    def submit(cls, text):
+        sample = lang_sample(text, settings.SOSSE_LANG_DETECT_SAMPLE_SIZE)
+
+        if settings.SOSSE_LANG_DETECT_WORKERS == 0:
+            future = Future()
+            future.set_result(detect_lang(sample))
+            return future
+
+        if cls._pool is None:
+            # The language profiles are loaded once per worker process
+            cls._pool = ProcessPoolExecutor(settings.SOSSE_LANG_DETECT_WORKERS, initializer=init_factory)
+        future = cls._pool.submit(detect_lang, sample)
+        future.sample = sample
+        return future
+
+    @classmethod
+    def result(cls, future):
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            # A detector process died, the pool is recreated on the next submit
+            crawl_logger.warning("Language detection process crashed, detecting in the crawler process")
+            cls.shutdown()
+            return detect_lang(future.sample)
+
+    @classmethod
+    def shutdown(cls):
+        if cls._pool is not None:
+            cls._pool.shutdown(cancel_futures=True)
+            cls._pool = None
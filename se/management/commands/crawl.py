@@ -15,6 +15,8 @@
 
 import logging
 import os
+import signal
+import sys
 from datetime import timedelta
 from multiprocessing import Process, cpu_count
 from time import sleep
@@ -27,9 +29,14 @@ from django.utils.timezone import now
 
 from ...browser_chromium import BrowserChromium
 from ...browser_firefox import BrowserFirefox
+from ...browser_request import BrowserRequest
 from ...crawl_policy import CrawlPolicy
 from ...document import Document
+from ...domain_setting import DomainSetting
+from ...lang_detect import LangDetector
 from ...models import MINUTELY, CrawlerStats, WorkerStats
+from ...screenshot_encoder import ScreenshotEncoder
+from ...snapshot_queue import SnapshotTask
 
 crawl_logger = logging.getLogger("crawler")
 
@@ -54,6 +61,8 @@ class Command(BaseCommand):
     def process(worker_no, options):
         try:
             crawl_logger.info(f"Crawler {worker_no} initializing")
+            # Exit through the finally clause, so that claimed documents are released
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
             connection.close()
             connection.connect()
 
@@ -85,6 +94,9 @@ class Command(BaseCommand):
 
                 worker_stats = WorkerStats.get_worker(worker_no)
 
+                if worker_stats.state == "paused":
+                    Document.release_claims(worker_no)
+
                 if worker_stats.state == "paused" or not Document.crawl(worker_no):
                     if worker_stats.state == "running":
                         worker_stats.update_state("idle")
@@ -92,8 +104,10 @@ class Command(BaseCommand):
                         crawl_logger.debug(f"{worker_no} {worker_stats.state.title()}...")
                     sleep_count += 1
                     if sleep_count > settings.SOSSE_BROWSER_IDLE_EXIT_TIME:
-                        BrowserChromium.destroy()
-                        BrowserFirefox.destroy()
+                        # The spare browsers are kept, so that crawling restarts without waiting for a browser
+                        BrowserChromium.recycle()
+                        BrowserFirefox.recycle()
+                        BrowserRequest.close_sessions()
                     sleep(1)
                 else:
                     sleep_count = 0
@@ -101,9 +115,34 @@ class Command(BaseCommand):
         except Exception:
             crawl_logger.error(format_exc())
             raise
+        finally:
+            Document.release_claims(worker_no)
+            LangDetector.shutdown()
+            ScreenshotEncoder.shutdown()
+            Document.reset_failed_screenshots()
+
+    @staticmethod
+    def snapshot_process(worker_no):
+        try:
+            crawl_logger.info(f"Snapshot worker {worker_no} starting")
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            connection.close()
+            connection.connect()
+
+            while True:
+                # Snapshot workers are paused with the crawlers
+                if WorkerStats.objects.filter(state="paused").exists() or not SnapshotTask.process_next(worker_no):
+                    sleep(1)
+        except Exception:
+            crawl_logger.error(format_exc())
+            raise
+        finally:
+            SnapshotTask.release(worker_no)
 
     def handle(self, *args, **options):
         Document.objects.exclude(worker_no=None).update(worker_no=None)
+        SnapshotTask.objects.exclude(worker_no=None).update(worker_no=None)
+        DomainSetting.objects.exclude(active_crawlers=0).update(active_crawlers=0)
         CrawlPolicy.create_default()
 
         for url in options["urls"]:
@@ -123,6 +162,13 @@ class Command(BaseCommand):
             workers.append(p)
             sleep(5)
 
+        if settings.SOSSE_SNAPSHOT_WORKERS:
+            crawl_logger.info(f"Starting {settings.SOSSE_SNAPSHOT_WORKERS} snapshot workers")
+        for snapshot_no in range(settings.SOSSE_SNAPSHOT_WORKERS):
+            p = Process(target=self.snapshot_process, args=(snapshot_no,))
+            p.start()
+            workers.append(p)
+
         crawl_logger.info("Crawlers started")
         for worker in workers:
             worker.join()
@@ -0,0 +1,473 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# Generated by Django 3.2.25 on 2026-10-18 17:17
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.search
+import django.core.validators
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+import se.domain_setting
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("se", "0014_sosse_1_12_0"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="anchor_vector",
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="normalized_content_offsets",
+            field=django.contrib.postgres.fields.ArrayField(
+                base_field=models.IntegerField(), blank=True, default=list, size=None
+            ),
+        ),
+        migrations.AddField(
+            model_name="domainsetting",
+            name="active_crawlers",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="domainsetting",
+            name="max_concurrency",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="Maximum number of crawlers fetching pages from this domain at the same time, leave empty for no limit",
+                null=True,
+                validators=[django.core.validators.MinValueValidator(1)],
+                verbose_name="Max. concurrent crawlers",
+            ),
+        ),
+        migrations.AddField(
+            model_name="domainsetting",
+            name="next_request",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="domainsetting",
+            name="requests_per_sec",
+            field=models.FloatField(
+                blank=True,
+                help_text="Maximum number of pages fetched per second from this domain by all crawlers, leave empty for no limit",
+                null=True,
+                validators=[se.domain_setting.validate_requests_per_sec],
+                verbose_name="Max. requests per second",
+            ),
+        ),
+        migrations.AddField(
+            model_name="workerstats",
+            name="current_doc",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="+",
+                to="se.document",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                condition=models.Q(("crawl_last__isnull", True)), fields=["id"], name="se_document_queue_new"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="document",
+            index=models.Index(
+                condition=models.Q(("crawl_last__isnull", False)),
+                fields=["crawl_next", "id"],
+                name="se_document_queue_recrawl",
+            ),
+        ),
+        migrations.CreateModel(
+            name="SnapshotTask",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("url", models.TextField()),
+                ("content", models.BinaryField()),
+                ("headers", models.JSONField(default=dict)),
+                ("created", models.DateTimeField(default=django.utils.timezone.now)),
+                ("worker_no", models.PositiveIntegerField(blank=True, null=True)),
+                ("superseded", models.BooleanField(default=False)),
+                (
+                    "crawl_policy",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="se.crawlpolicy"),
+                ),
+                (
+                    "document",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="se.document"),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            sql="""
+              -- Links are inserted in bulk, the vectors of the target documents are refreshed
+              -- once per statement, with rows locked in id order to prevent deadlocks between crawlers
+
+              DROP TRIGGER link_row_trigger ON se_link;
+
+              CREATE FUNCTION link_weight_vector_bulk() RETURNS trigger AS $$
+              BEGIN
+                PERFORM 1 FROM se_document
+                  WHERE id IN (SELECT doc_to_id FROM new_links)
+                  ORDER BY id
+                  FOR UPDATE;
+
+                UPDATE se_document SET
+                    vector = setweight(to_tsvector(vector_lang, se_document.normalized_title), 'A') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_url), 'A') ||
+                             setweight(to_tsvector(vector_lang, COALESCE('', (SELECT STRING_AGG(se_link.text, ' ') FROM se_link WHERE se_link.doc_to_id=se_document.id))), 'B') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_content), 'C')
+                WHERE id IN (SELECT doc_to_id FROM new_links);
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER link_insert_trigger
+              AFTER INSERT
+              ON se_link
+              REFERENCING NEW TABLE AS new_links
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE link_weight_vector_bulk();
+
+              -- Updating the position of a link on the screenshot does not change the vector
+              CREATE TRIGGER link_row_trigger
+              BEFORE UPDATE OF doc_to_id, text
+              ON se_link
+              FOR EACH ROW
+              WHEN (new.doc_to_id IS NOT NULL)
+              EXECUTE PROCEDURE link_weight_vector();
+            """,
+            reverse_sql="""
+              DROP TRIGGER link_row_trigger ON se_link;
+              DROP TRIGGER link_insert_trigger ON se_link;
+              DROP FUNCTION link_weight_vector_bulk;
+
+              CREATE TRIGGER link_row_trigger
+              BEFORE INSERT OR UPDATE
+              ON se_link
+              FOR EACH ROW
+              WHEN (new.doc_to_id IS NOT NULL)
+              EXECUTE PROCEDURE link_weight_vector();
+            """,
+        ),
+        migrations.RunSQL(
+            sql="""
+              -- Versions of the tables cached by the processes, bumped on any change of the tables
+
+              CREATE TABLE se_table_version (name text PRIMARY KEY, version bigint NOT NULL);
+              INSERT INTO se_table_version VALUES ('se_crawlpolicy', 0), ('se_excludedurl', 0);
+
+              CREATE FUNCTION table_version() RETURNS trigger AS $$
+              BEGIN
+                UPDATE se_table_version SET version = version + 1 WHERE name = TG_TABLE_NAME;
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER crawl_policy_version_trigger
+              AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+              ON se_crawlpolicy
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE table_version();
+
+              CREATE TRIGGER excluded_url_version_trigger
+              AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE
+              ON se_excludedurl
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE table_version();
+            """,
+            reverse_sql="""
+              DROP TRIGGER excluded_url_version_trigger ON se_excludedurl;
+              DROP TRIGGER crawl_policy_version_trigger ON se_crawlpolicy;
+              DROP FUNCTION table_version;
+              DROP TABLE se_table_version;
+            """,
+        ),
+        migrations.RunSQL(
+            sql="""
+              -- The text of the links pointing to a document is stored in anchor_vector with the B weight,
+              -- it is refreshed on link changes without tokenizing the title and the content of the document
+
+              CREATE FUNCTION doc_anchor_update(doc_ids integer[]) RETURNS void AS $$
+              BEGIN
+                PERFORM 1 FROM se_document
+                  WHERE id = ANY(doc_ids)
+                  ORDER BY id
+                  FOR UPDATE;
+
+                UPDATE se_document SET
+                    anchor_vector = anchor.vector,
+                    vector = ts_filter(COALESCE(se_document.vector, ''), '{a,c}') || anchor.vector
+                FROM (
+                  SELECT se_document.id,
+                         setweight(to_tsvector(se_document.vector_lang, COALESCE(STRING_AGG(se_link.text, ' '), '')), 'B') AS vector
+                  FROM se_document
+                  LEFT JOIN se_link ON se_link.doc_to_id = se_document.id
+                  WHERE se_document.id = ANY(doc_ids)
+                  GROUP BY se_document.id
+                ) AS anchor
+                WHERE se_document.id = anchor.id;
+              END
+              $$ LANGUAGE plpgsql;
+
+              -- Anchor text was never part of the vectors, since COALESCE('', ...) always returned ''
+              SELECT doc_anchor_update(ARRAY(SELECT DISTINCT doc_to_id FROM se_link WHERE doc_to_id IS NOT NULL));
+
+              CREATE OR REPLACE FUNCTION doc_weight_vector() RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                  IF pg_trigger_depth() > 1 THEN
+                    -- anchor_vector refreshed by doc_anchor_update()
+                    RETURN new;
+                  END IF;
+
+                  -- The vectors are only written by triggers, values sent by the application may be outdated
+                  new.vector = old.vector;
+                  new.anchor_vector = old.anchor_vector;
+
+                  IF new.normalized_title IS NOT DISTINCT FROM old.normalized_title
+                     AND new.normalized_url IS NOT DISTINCT FROM old.normalized_url
+                     AND new.normalized_content IS NOT DISTINCT FROM old.normalized_content
+                     AND new.vector_lang IS NOT DISTINCT FROM old.vector_lang THEN
+                    RETURN new;
+                  END IF;
+                END IF;
+
+                IF TG_OP = 'INSERT' OR new.vector_lang IS DISTINCT FROM old.vector_lang THEN
+                  new.anchor_vector = (
+                    SELECT setweight(to_tsvector(new.vector_lang, COALESCE(STRING_AGG(text, ' '), '')), 'B')
+                    FROM se_link
+                    WHERE doc_to_id = new.id
+                  );
+                END IF;
+
+                new.vector = setweight(to_tsvector(new.vector_lang, new.normalized_title), 'A') ||
+                             setweight(to_tsvector(new.vector_lang, new.normalized_url), 'A') ||
+                             setweight(to_tsvector(new.vector_lang, new.normalized_content), 'C') ||
+                             COALESCE(new.anchor_vector, '');
+                RETURN new;
+              END
+              $$ LANGUAGE plpgsql;
+
+              DROP TRIGGER vector_column_trigger ON se_document;
+              CREATE TRIGGER vector_column_trigger
+              BEFORE INSERT OR UPDATE
+              ON se_document
+              FOR EACH ROW EXECUTE PROCEDURE doc_weight_vector();
+
+              CREATE OR REPLACE FUNCTION link_weight_vector_bulk() RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'INSERT' THEN
+                  PERFORM doc_anchor_update(ARRAY(SELECT DISTINCT doc_to_id FROM new_links WHERE doc_to_id IS NOT NULL));
+                ELSE
+                  PERFORM doc_anchor_update(ARRAY(SELECT DISTINCT doc_to_id FROM old_links WHERE doc_to_id IS NOT NULL));
+                END IF;
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER link_delete_trigger
+              AFTER DELETE
+              ON se_link
+              REFERENCING OLD TABLE AS old_links
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE link_weight_vector_bulk();
+
+              CREATE OR REPLACE FUNCTION link_weight_vector() RETURNS trigger AS $$
+              BEGIN
+                PERFORM doc_anchor_update(ARRAY_REMOVE(ARRAY[old.doc_to_id, new.doc_to_id], NULL));
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              -- The trigger runs after the update, so that the new text of the link is aggregated
+              DROP TRIGGER link_row_trigger ON se_link;
+              CREATE TRIGGER link_row_trigger
+              AFTER UPDATE OF doc_to_id, text
+              ON se_link
+              FOR EACH ROW
+              WHEN (old.doc_to_id IS DISTINCT FROM new.doc_to_id OR old.text IS DISTINCT FROM new.text)
+              EXECUTE PROCEDURE link_weight_vector();
+            """,
+            reverse_sql="""
+              DROP TRIGGER link_row_trigger ON se_link;
+              DROP TRIGGER link_delete_trigger ON se_link;
+              DROP TRIGGER vector_column_trigger ON se_document;
+
+              CREATE OR REPLACE FUNCTION link_weight_vector() RETURNS trigger AS $$
+              BEGIN
+                UPDATE se_document SET
+                    vector = setweight(to_tsvector(vector_lang, se_document.normalized_title), 'A') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_url), 'A') ||
+                             setweight(to_tsvector(vector_lang, COALESCE('', (SELECT STRING_AGG(se_link.text, ' ') FROM se_link WHERE se_link.doc_to_id=se_document.id))), 'B') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_content), 'C')
+                WHERE id = new.doc_to_id;
+                RETURN new;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER link_row_trigger
+              BEFORE UPDATE OF doc_to_id, text
+              ON se_link
+              FOR EACH ROW
+              WHEN (new.doc_to_id IS NOT NULL)
+              EXECUTE PROCEDURE link_weight_vector();
+
+              CREATE OR REPLACE FUNCTION link_weight_vector_bulk() RETURNS trigger AS $$
+              BEGIN
+                PERFORM 1 FROM se_document
+                  WHERE id IN (SELECT doc_to_id FROM new_links)
+                  ORDER BY id
+                  FOR UPDATE;
+
+                UPDATE se_document SET
+                    vector = setweight(to_tsvector(vector_lang, se_document.normalized_title), 'A') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_url), 'A') ||
+                             setweight(to_tsvector(vector_lang, COALESCE('', (SELECT STRING_AGG(se_link.text, ' ') FROM se_link WHERE se_link.doc_to_id=se_document.id))), 'B') ||
+                             setweight(to_tsvector(vector_lang, se_document.normalized_content), 'C')
+                WHERE id IN (SELECT doc_to_id FROM new_links);
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE OR REPLACE FUNCTION doc_weight_vector() RETURNS trigger AS $$
+              BEGIN
+                new.vector = setweight(to_tsvector(new.vector_lang, new.normalized_title), 'A') ||
+                             setweight(to_tsvector(new.vector_lang, new.normalized_url), 'A') ||
+                             setweight(to_tsvector(new.vector_lang, COALESCE('', (SELECT STRING_AGG(text, ' ') FROM se_link WHERE doc_to_id=new.id))), 'B') ||
+                             setweight(to_tsvector(new.vector_lang, new.normalized_content), 'C');
+                return new;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER vector_column_trigger
+              BEFORE INSERT OR UPDATE OF normalized_title, normalized_content, normalized_url, vector_lang
+              ON se_document
+              FOR EACH ROW EXECUTE PROCEDURE doc_weight_vector();
+
+              DROP FUNCTION doc_anchor_update;
+            """,
+        ),
+        migrations.CreateModel(
+            name="Facet",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("facet", models.CharField(choices=[("lang", "Language"), ("mime", "Mimetype")], max_length=4)),
+                ("value", models.CharField(max_length=64)),
+                ("doc_count", models.BigIntegerField(default=0)),
+            ],
+            options={
+                "unique_together": {("facet", "value")},
+            },
+        ),
+        migrations.RunSQL(
+            sql="""
+              -- Documents counts per language and mimetype. Inserts and deletes are counted once per statement,
+              -- updates only when the language or the mimetype changed. Counters are upserted in (facet, value)
+              -- order to prevent deadlocks between crawlers. Queued documents have neither, they are not counted
+
+              CREATE FUNCTION facet_count_update() RETURNS trigger AS $$
+              BEGIN
+                IF TG_OP = 'INSERT' THEN
+                  INSERT INTO se_facet (facet, value, doc_count)
+                    SELECT facet, value, SUM(delta) FROM (
+                      SELECT 'lang' AS facet, lang_iso_639_1 AS value, 1 AS delta FROM new_docs
+                      UNION ALL SELECT 'mime', mimetype, 1 FROM new_docs
+                    ) AS deltas
+                    WHERE value IS NOT NULL
+                    GROUP BY facet, value
+                    ORDER BY facet, value
+                  ON CONFLICT (facet, value) DO UPDATE SET doc_count = se_facet.doc_count + EXCLUDED.doc_count;
+                ELSE
+                  INSERT INTO se_facet (facet, value, doc_count)
+                    SELECT facet, value, SUM(delta) FROM (
+                      SELECT 'lang' AS facet, lang_iso_639_1 AS value, -1 AS delta FROM old_docs
+                      UNION ALL SELECT 'mime', mimetype, -1 FROM old_docs
+                    ) AS deltas
+                    WHERE value IS NOT NULL
+                    GROUP BY facet, value
+                    ORDER BY facet, value
+                  ON CONFLICT (facet, value) DO UPDATE SET doc_count = se_facet.doc_count + EXCLUDED.doc_count;
+                END IF;
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE FUNCTION facet_count_row_update() RETURNS trigger AS $$
+              BEGIN
+                INSERT INTO se_facet (facet, value, doc_count)
+                  SELECT facet, value, SUM(delta) FROM (
+                    SELECT 'lang' AS facet, NEW.lang_iso_639_1 AS value, 1 AS delta
+                    UNION ALL SELECT 'mime', NEW.mimetype, 1
+                    UNION ALL SELECT 'lang', OLD.lang_iso_639_1, -1
+                    UNION ALL SELECT 'mime', OLD.mimetype, -1
+                  ) AS deltas
+                  WHERE value IS NOT NULL
+                  GROUP BY facet, value
+                  HAVING SUM(delta) <> 0
+                  ORDER BY facet, value
+                ON CONFLICT (facet, value) DO UPDATE SET doc_count = se_facet.doc_count + EXCLUDED.doc_count;
+                RETURN NULL;
+              END
+              $$ LANGUAGE plpgsql;
+
+              CREATE TRIGGER facet_insert_trigger
+              AFTER INSERT
+              ON se_document
+              REFERENCING NEW TABLE AS new_docs
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE facet_count_update();
+
+              CREATE TRIGGER facet_delete_trigger
+              AFTER DELETE
+              ON se_document
+              REFERENCING OLD TABLE AS old_docs
+              FOR EACH STATEMENT
+              EXECUTE PROCEDURE facet_count_update();
+
+              -- Transition tables cannot be used with a column list, a row trigger skips the bookkeeping updates
+              CREATE TRIGGER facet_update_trigger
+              AFTER UPDATE OF lang_iso_639_1, mimetype
+              ON se_document
+              FOR EACH ROW
+              WHEN (OLD.lang_iso_639_1 IS DISTINCT FROM NEW.lang_iso_639_1 OR OLD.mimetype IS DISTINCT FROM NEW.mimetype)
+              EXECUTE PROCEDURE facet_count_row_update();
+
+              INSERT INTO se_facet (facet, value, doc_count)
+                SELECT 'lang', lang_iso_639_1, COUNT(*) FROM se_document
+                WHERE lang_iso_639_1 IS NOT NULL GROUP BY 2;
+              INSERT INTO se_facet (facet, value, doc_count)
+                SELECT 'mime', mimetype, COUNT(*) FROM se_document
+                WHERE mimetype IS NOT NULL GROUP BY 2;
+            """,
+            reverse_sql="""
+              DROP TRIGGER facet_update_trigger ON se_document;
+              DROP TRIGGER facet_delete_trigger ON se_document;
+              DROP TRIGGER facet_insert_trigger ON se_document;
+              DROP FUNCTION facet_count_row_update;
+              DROP FUNCTION facet_count_update;
+            """,
+        ),
+    ]
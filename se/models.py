@@ -19,6 +19,8 @@ import re
 import urllib.parse
 from base64 import b64decode, b64encode
 from datetime import timedelta
+from threading import Lock
+from time import monotonic
 
 from defusedxml import ElementTree
 from django.conf import settings
@@ -32,6 +34,7 @@ from .browser_request import BrowserRequest
 from .document import Document
 from .online import online_status
 from .url import absolutize_url, url_remove_fragment, url_remove_query_string
+from .utils import table_version
 
 crawl_logger = logging.getLogger("crawler")
 
@@ -119,6 +122,8 @@ class WorkerStats(models.Model):
     worker_no = models.IntegerField()
     pid = models.PositiveIntegerField()
     state = models.CharField(max_length=8, choices=STATE, default="idle")
+    # Document being crawled, other documents with a worker_no are only claimed
+    current_doc = models.ForeignKey(Document, null=True, blank=True, on_delete=models.SET_NULL, related_name="+")
 
     @classmethod
     def get_worker(cls, worker_no):
@@ -150,7 +155,7 @@ class WorkerStats(models.Model):
                 w.state = "exited"
 
             if w.state != "exited":
-                w.doc = Document.objects.filter(worker_no=w.worker_no).first()
+                w.doc = w.current_doc
         return workers
 
 
@@ -383,10 +388,8 @@ class FavIcon(models.Model):
 
     @classmethod
     def _get_url(cls, page):
-        parsed = page.get_soup()
-        links = parsed.find_all("link", rel=re.compile("shortcut icon", re.IGNORECASE))
-        if links == []:
-            links = parsed.find_all("link", rel=re.compile("icon", re.IGNORECASE))
+        analysis = page.analysis()
+        links = analysis.shortcut_icons or analysis.icons
 
         if len(links) == 0:
             return None
@@ -447,6 +450,74 @@ class SearchHistory(models.Model):
             SearchHistory.objects.create(querystring=qs, query=q, user=request.user)
 
 
+class ExcludedUrlIndex:
+    # In-process copy of the excluded urls, prefixes are stored in a trie so that checking
+    # a url does not depend on the number of prefixes
+    CHECK_INTERVAL = 1.0
+    END = ""
+
+    def __init__(self):
+        self.version = None
+        self.checked = 0
+        # (urls, prefixes trie), replaced as a whole so that readers never see a partially loaded index
+        self.state = (set(), {})
+        self.lock = Lock()
+
+    def invalidate(self):
+        self.version = None
+
+    def _reload(self):
+        if self.version is not None and monotonic() - self.checked < self.CHECK_INTERVAL:
+            return
+
+        with self.lock:
+            n = monotonic()
+            if self.version is not None and n - self.checked < self.CHECK_INTERVAL:
+                # Reloaded by another thread meanwhile
+                return
+
+            version = table_version("se_excludedurl")
+            if version != self.version:
+                urls = set()
+                prefixes = {}
+                for url, starting_with in ExcludedUrl.objects.values_list("url", "starting_with"):
+                    if not starting_with:
+                        urls.add(url)
+                        continue
+
+                    node = prefixes
+                    for c in url:
+                        node = node.setdefault(c, {})
+                    node[self.END] = True
+                self.state = (urls, prefixes)
+                self.version = version
+            self.checked = n
+
+    def _is_excluded(self, url, state):
+        urls, prefixes = state
+        if url in urls:
+            return True
+
+        node = prefixes
+        for c in url:
+            if self.END in node:
+                return True
+            node = node.get(c)
+            if node is None:
+                return False
+        return self.END in node
+
+    def is_excluded(self, url):
+        self._reload()
+        return self._is_excluded(url, self.state)
+
+    def filter_urls(self, urls):
+        # Returns the urls that are not excluded
+        self._reload()
+        state = self.state
+        return [url for url in urls if not self._is_excluded(url, state)]
+
+
 class ExcludedUrl(models.Model):
     url = models.TextField(unique=True)
     starting_with = models.BooleanField(default=False, help_text="Exclude all urls starting with the url pattern")
@@ -454,3 +525,42 @@ class ExcludedUrl(models.Model):
 
     class Meta:
         verbose_name = "Excluded URL"
+
+    def save(self, *args, **kwargs):
+        ret = super().save(*args, **kwargs)
+        EXCLUDED_URL_INDEX.invalidate()
+        return ret
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        EXCLUDED_URL_INDEX.invalidate()
+        return ret
+
+    @staticmethod
+    def is_excluded(url):
+        return EXCLUDED_URL_INDEX.is_excluded(url)
+
+    @staticmethod
+    def filter_urls(urls):
+        return EXCLUDED_URL_INDEX.filter_urls(urls)
+
+
+EXCLUDED_URL_INDEX = ExcludedUrlIndex()
+
+
+class Facet(models.Model):
+    # Number of documents per language and mimetype, maintained by triggers on se_document
+    LANG = "lang"
+    MIME = "mime"
+    FACET_CHOICES = ((LANG, "Language"), (MIME, "Mimetype"))
+
+    facet = models.CharField(max_length=4, choices=FACET_CHOICES)
+    value = models.CharField(max_length=64)
+    doc_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = (("facet", "value"),)
+
+    @staticmethod
+    def counts(facet):
+        return Facet.objects.filter(facet=facet, doc_count__gt=0).order_by("-doc_count", "value")
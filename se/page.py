@@ -13,6 +13,10 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import re
+import shutil
+from hashlib import md5
+
 from bs4 import BeautifulSoup, Comment, Doctype, Tag
 from magic import from_buffer as magic_from_buffer
 
@@ -25,23 +29,73 @@ from .url import (
 )
 
 NAV_ELEMENTS = ["nav", "header", "footer"]
+BLOCK_ELEMENTS = ("div", "p", "li", "h1", "h2", "h3", "h4", "h5", "h6")
+SKIPPED_ELEMENTS = ("title", "script", "style")
+
+# Amount of data libmagic reads to identify a file
+MAGIC_HEAD_SIZE = 1024 * 1024
+
+SHORTCUT_ICON_RE = re.compile("shortcut icon", re.IGNORECASE)
+ICON_RE = re.compile("icon", re.IGNORECASE)
+
+
+class PageAnalysis:
+    # Elements of the page used by the crawler, collected in a single pass over the DOM
+    def __init__(self, page):
+        self.title = None
+        self.base_url = page.url
+        self.shortcut_icons = []
+        self.icons = []
+        self.meta_refresh = []
+
+        has_title = False
+        has_base = False
+        for elem in page.get_soup().find_all(("title", "base", "link", "meta")):
+            if elem.name == "title":
+                if not has_title:
+                    self.title = elem.string
+                    has_title = True
+            elif elem.name == "base":
+                # Only the first <base> of the <head> is used
+                if not has_base and elem.find_parent("head"):
+                    has_base = True
+                    if elem.get("href"):
+                        self.base_url = url_remove_fragment(absolutize_url(page.url, elem.get("href")))
+            elif elem.name == "link":
+                rel = elem.get("rel")
+                if rel:
+                    if isinstance(rel, str):
+                        rel = [rel]
+                    rel = rel + [" ".join(rel)]
+                    if any(SHORTCUT_ICON_RE.search(r) for r in rel):
+                        self.shortcut_icons.append(elem)
+                    if any(ICON_RE.search(r) for r in rel):
+                        self.icons.append(elem)
+            elif elem.get("http-equiv", "").lower() == "refresh" and elem.get("content", ""):
+                self.meta_refresh.append(elem.get("content"))
 
 
 class Page:
-    def __init__(self, url, content, browser, headers=None, status_code=None):
-        if not isinstance(content, bytes):
+    def __init__(self, url, content, browser, headers=None, status_code=None, content_file=None, content_md5=None):
+        if content_file is None and not isinstance(content, bytes):
             raise ValueError("content must be bytes")
         self.url = sanitize_url(url)
-        self.content = content
+        self._content = content
+        # Large downloads are kept in a temporary file, the content is only loaded when accessed
+        self.content_file = content_file
+        self._content_md5 = content_md5
         self.redirect_count = 0
         self.title = None
         self.soup = None
+        self._analysis = None
         self.browser = browser
         self.headers = headers or {}
         self.status_code = status_code
 
+        head = self._content_head()
+
         # dirty hack to avoid some errors (as triggered since bookworm during tests)
-        magic_head = self.content[:20].strip().lower()
+        magic_head = head[:20].strip().lower()
         is_html = False
         for header in ("<html", "<!doctype html"):
             is_html |= isinstance(magic_head, str) and magic_head.startswith(header)
@@ -50,7 +104,47 @@ class Page:
         if is_html:
             self.mimetype = "text/html"
         else:
-            self.mimetype = magic_from_buffer(self.content, mime=True)
+            self.mimetype = magic_from_buffer(head, mime=True)
+
+    def _content_head(self):
+        if self._content is not None:
+            return self._content
+        self.content_file.seek(0)
+        return self.content_file.read(MAGIC_HEAD_SIZE)
+
+    @property
+    def content(self):
+        if self._content is None:
+            self.content_file.seek(0)
+            self._content = self.content_file.read()
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        self.content_file = None
+        self._content_md5 = None
+        self.soup = None
+        self._analysis = None
+
+    def content_md5(self):
+        if self._content_md5 is None:
+            if self._content is not None:
+                self._content_md5 = md5(self._content, usedforsecurity=False).hexdigest()
+            else:
+                content_md5 = md5(usedforsecurity=False)
+                self.content_file.seek(0)
+                for chunk in iter(lambda: self.content_file.read(1024 * 1024), b""):
+                    content_md5.update(chunk)
+                self._content_md5 = content_md5.hexdigest()
+        return self._content_md5
+
+    def write_content(self, fd):
+        if self._content is not None:
+            fd.write(self._content)
+        else:
+            self.content_file.seek(0)
+            shutil.copyfileobj(self.content_file, fd)
 
     def get_soup(self):
         if self.soup:
@@ -76,144 +170,180 @@ class Page:
 
     def update_soup(self, soup):
         self.soup = soup
+        self._analysis = None
+
+    def analysis(self):
+        if self._analysis is None:
+            self._analysis = PageAnalysis(self)
+        return self._analysis
 
     def dump_html(self):
         return self.get_soup().encode()
 
     def base_url(self):
-        soup = self.get_soup()
-
-        base_url = self.url
-        if soup.head.base and soup.head.base.get("href"):
-            base_url = absolutize_url(self.url, soup.head.base.get("href"))
-            base_url = url_remove_fragment(base_url)
-        return base_url
+        return self.analysis().base_url
 
     def remove_nav_elements(self):
         soup = self.get_soup()
         for elem_type in NAV_ELEMENTS:
             for elem in soup.find_all(elem_type):
                 elem.extract()
-
-    def _get_elem_text(self, elem, recurse=False):
-        s = ""
-        if elem.name is None:
-            s = getattr(elem, "string", "") or ""
-            s = s.strip(" \t\n\r")
-
-        if (elem.name == "a" or recurse) and hasattr(elem, "children"):
-            for child in elem.children:
-                _s = self._get_elem_text(child, True)
-                if _s:
-                    if s:
-                        s += " "
-                    s += _s
-        return s
-
-    def _build_selector(self, elem):
-        no = 1
-        for sibling in elem.previous_siblings:
-            if isinstance(elem, Tag) and sibling.name == elem.name:
-                no += 1
-
-        selector = f"/{elem.name}[{no}]"
-
-        if elem.name != "html":
-            selector = self._build_selector(elem.parent) + selector
-        return selector
-
-    def _dom_walk(self, elem, crawl_policy, links, queue_links, document, in_nav=False):
+        self._analysis = None
+
+    @staticmethod
+    def _link_text(elem):
+        texts = []
+        for child in elem.descendants:
+            if child.name is None:
+                text = child.strip(" \t\n\r")
+                if text:
+                    texts.append(text)
+        return " ".join(texts)
+
+    @staticmethod
+    def _children_selectors(elem, selector):
+        # XPath-like position of each child element, used to locate links on screenshots
+        counts = {}
+        selectors = []
+        for child in elem.contents:
+            if isinstance(child, Tag):
+                no = counts.get(child.name, 0) + 1
+                counts[child.name] = no
+                selectors.append(f"{selector}/{child.name}[{no}]")
+            else:
+                selectors.append(None)
+        return selectors
+
+    def _dom_walk(self, crawl_policy, queue_links, document):
         from .crawl_policy import CrawlPolicy
-        from .document import Document
         from .models import Link
 
         if queue_links != (document is not None):
             raise Exception(f"document parameter ({document}) is required to queue links ({queue_links})")
 
-        if isinstance(elem, (Doctype, Comment)):
-            return
-
-        if elem.name in ("[document]", "title", "script", "style"):
-            return
-
-        if crawl_policy.remove_nav_elements != CrawlPolicy.REMOVE_NAV_NO and elem.name in ("nav", "header", "footer"):
-            in_nav = True
-
-        s = self._get_elem_text(elem)
-
-        # Keep the link if it has text, or if we take screenshots
-        if elem.name in (None, "a"):
-            if links["text"] and links["text"][-1] not in (" ", "\n") and s and not in_nav:
-                links["text"] += " "
-
-            if elem.name == "a" and queue_links:
-                href = elem.get("href")
-                if href:
-                    link = None
-                    target_doc = None
-                    href = href.strip()
-
-                    if has_browsable_scheme(href):
-                        href_for_policy = absolutize_url(self.base_url(), href)
-                        child_policy = CrawlPolicy.get_from_url(href_for_policy)
-                        href = absolutize_url(self.base_url(), href)
-                        if not child_policy.keep_params:
-                            href = url_remove_query_string(href)
-                        href = url_remove_fragment(href)
-                        target_doc = Document.queue(href, crawl_policy, document)
-
-                        if target_doc != document:
-                            if target_doc:
-                                link = Link(
-                                    doc_from=document,
-                                    link_no=len(links["links"]),
-                                    doc_to=target_doc,
-                                    text=s,
-                                    pos=len(links["text"]),
-                                    in_nav=in_nav,
-                                )
-
-                    store_extern_link = not has_browsable_scheme(href) or target_doc is None
-                    if crawl_policy.store_extern_links and store_extern_link:
-                        href = elem.get("href").strip()
-                        try:
-                            href = absolutize_url(self.base_url(), href)
-                        except ValueError:
-                            # Store the url as is if it's invalid
-                            pass
+        remove_nav = crawl_policy.remove_nav_elements != CrawlPolicy.REMOVE_NAV_NO
+        build_selectors = queue_links and crawl_policy.take_screenshots
+
+        # The text is accumulated in chunks, separators are always appended as their own chunk
+        text = []
+        text_len = 0
+        links = []
+
+        # Iterative walk, a None element closes a block element
+        soup = self.get_soup()
+        selectors = self._children_selectors(soup, "") if build_selectors else [None] * len(soup.contents)
+        stack = list(zip(reversed(soup.contents), [False] * len(selectors), reversed(selectors)))
+
+        while stack:
+            elem, in_nav, selector = stack.pop()
+
+            if elem is None:
+                if text and not in_nav:
+                    if text[-1] == " ":
+                        text[-1] = "\n"
+                    elif text[-1] != "\n":
+                        text.append("\n")
+                        text_len += 1
+                continue
+
+            if isinstance(elem, (Doctype, Comment)):
+                continue
+
+            name = elem.name
+            if name in SKIPPED_ELEMENTS:
+                continue
+
+            if name is None or name == "a":
+                if name is None:
+                    s = elem.strip(" \t\n\r")
+                else:
+                    s = self._link_text(elem)
+
+                if s and not in_nav and text and text[-1] not in (" ", "\n"):
+                    text.append(" ")
+                    text_len += 1
+
+                if name == "a" and queue_links:
+                    href = elem.get("href")
+                    if href:
+                        # Target documents are resolved in bulk once the page has been walked
                         link = Link(
                             doc_from=document,
-                            link_no=len(links["links"]),
                             text=s,
-                            pos=len(links["text"]),
-                            extern_url=href,
+                            pos=text_len,
                             in_nav=in_nav,
                         )
+                        link.href = href.strip()
+                        if build_selectors:
+                            link.css_selector = selector
+                        links.append(link)
+
+                if s and not in_nav:
+                    text.append(s)
+                    text_len += len(s)
+                continue
+
+            if remove_nav and name in NAV_ELEMENTS:
+                in_nav = True
 
-                    if link:
-                        if crawl_policy.take_screenshots:
-                            link.css_selector = self._build_selector(elem)
-                        links["links"].append(link)
+            if name in BLOCK_ELEMENTS:
+                stack.append((None, in_nav, None))
 
-            if s and not in_nav:
-                links["text"] += s
+            children = elem.contents
+            if build_selectors:
+                selectors = self._children_selectors(elem, selector)
+            else:
+                selectors = [None] * len(children)
+            stack.extend(zip(reversed(children), [in_nav] * len(children), reversed(selectors)))
 
-            if elem.name == "a":
-                return
+        return {"links": links, "text": "".join(text)}
 
-        if hasattr(elem, "children"):
-            for child in elem.children:
-                self._dom_walk(child, crawl_policy, links, queue_links, document, in_nav)
+    def _queue_links(self, crawl_policy, links, document):
+        from .crawl_policy import CrawlPolicy
+        from .document import Document
 
-        if elem.name in ("div", "p", "li", "h1", "h2", "h3", "h4", "h5", "h6"):
-            if links["text"] and not in_nav:
-                if links["text"][-1] == " ":
-                    links["text"] = links["text"][:-1] + "\n"
-                elif links["text"][-1] != "\n":
-                    links["text"] += "\n"
+        base_url = self.base_url()
+        for link in links:
+            link.target_url = None
+            if has_browsable_scheme(link.href):
+                link.target_url = absolutize_url(base_url, link.href)
+
+        child_policies = CrawlPolicy.get_from_urls([link.target_url for link in links if link.target_url])
+        for link in links:
+            if link.target_url:
+                if not child_policies[link.target_url].keep_params:
+                    link.target_url = url_remove_query_string(link.target_url)
+                link.target_url = url_remove_fragment(link.target_url)
+
+        target_docs = Document.queue_bulk(
+            [link.target_url for link in links if link.target_url], crawl_policy, document
+        )
+
+        queued = []
+        for link in links:
+            target_doc = None
+            if link.target_url:
+                target_doc = target_docs.get(link.target_url)
+                if target_doc == document:
+                    continue
+
+            if target_doc:
+                link.doc_to = target_doc
+            elif crawl_policy.store_extern_links:
+                try:
+                    link.extern_url = absolutize_url(base_url, link.href)
+                except ValueError:
+                    # Store the url as is if it's invalid
+                    link.extern_url = link.href
+            else:
+                continue
+
+            link.link_no = len(queued)
+            queued.append(link)
+        return queued
 
     def dom_walk(self, crawl_policy, queue_links, document):
-        links = {"links": [], "text": ""}
-        for elem in self.get_soup().children:
-            self._dom_walk(elem, crawl_policy, links, queue_links, document, False)
+        links = self._dom_walk(crawl_policy, queue_links, document)
+        if queue_links:
+            links["links"] = self._queue_links(crawl_policy, links["links"], document)
         return links
@@ -16,7 +16,7 @@
 import os
 
 from django.conf import settings
-from django.db import connection, models
+from django.db import connection
 from drf_spectacular.utils import (
     OpenApiExample,
     OpenApiTypes,
@@ -29,9 +29,9 @@ from rest_framework.response import Response
 from rest_framework.settings import api_settings
 
 from .document import Document
-from .models import CrawlerStats
+from .models import CrawlerStats, Facet
 from .rest_permissions import IsSuperUserOrStaff
-from .search import get_documents
+from .search import facet_counts, get_documents
 from .search_form import FILTER_FIELDS, SORT, SearchForm
 from .utils import mimetype_icon
 
@@ -99,6 +99,14 @@ class HddStatsViewSet(viewsets.ViewSet):
         )
 
 
+def lang_title(lang_iso):
+    lang_desc = settings.SOSSE_LANGDETECT_TO_POSTGRES.get(lang_iso, {})
+    title = lang_iso.title()
+    if lang_desc.get("flag"):
+        title = title + " " + lang_desc["flag"]
+    return title
+
+
 class LangStatsSerializer(serializers.Serializer):
     doc_count = serializers.IntegerField(help_text="Document count")
     lang = serializers.CharField(help_text="Language")
@@ -115,23 +123,18 @@ class LangStatsViewSet(viewsets.ViewSet):
     )
     def list(self, request):
         langs = []
-        indexed_langs = (
-            Document.objects.exclude(lang_iso_639_1__isnull=True)
-            .values("lang_iso_639_1")
-            .annotate(count=models.Count("lang_iso_639_1"))
-            .order_by("-count")
-        )
-        if indexed_langs:
-            for lang in indexed_langs:
-                lang_iso = lang["lang_iso_639_1"]
-                lang_desc = settings.SOSSE_LANGDETECT_TO_POSTGRES.get(lang_iso, {})
-                title = lang_iso.title()
-                if lang_desc.get("flag"):
-                    title = title + " " + lang_desc["flag"]
-                langs.append({"lang": title, "doc_count": lang["count"]})
+        for facet in Facet.counts(Facet.LANG).exclude(value=""):
+            langs.append({"lang": lang_title(facet.value), "doc_count": facet.doc_count})
         return Response(langs)
 
 
+def mime_title(mimetype):
+    icon = mimetype_icon(mimetype)
+    if mimetype:
+        return f"{icon} {mimetype}"
+    return f"{icon} <None>"
+
+
 class MimeStatsSerializer(serializers.Serializer):
     doc_count = serializers.IntegerField(help_text="Document count")
     mime = serializers.CharField(help_text="Mimetype")
@@ -147,25 +150,16 @@ class MimeStatsViewSet(viewsets.ViewSet):
         },
     )
     def list(self, request):
-        indexed_mimes = (
-            Document.objects.values("mimetype")
-            .annotate(doc_count=models.Count("mimetype"))
-            .order_by("-doc_count", "mimetype")
-        )
-        for indexed_mime in indexed_mimes:
-            icon = mimetype_icon(indexed_mime["mimetype"])
-            if indexed_mime["mimetype"]:
-                indexed_mime["mimetype"] = f"{icon} {indexed_mime['mimetype']}"
-            else:
-                indexed_mime["mimetype"] = f"{icon} <None>"
-
+        indexed_mimes = []
+        for facet in Facet.counts(Facet.MIME):
+            indexed_mimes.append({"mimetype": mime_title(facet.value), "doc_count": facet.doc_count})
         return Response(indexed_mimes)
 
 
 class DocumentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Document
-        fields = "__all__"
+        exclude = ("anchor_vector", "normalized_content_offsets")
 
 
 class DocumentViewSet(viewsets.ReadOnlyModelViewSet):
@@ -244,6 +238,22 @@ class SearchQuery(serializers.Serializer):
             )
         return data
 
+    @staticmethod
+    def get_documents(request, stats_call):
+        query = SearchQuery(data=request.data)
+        query.is_valid(raise_exception=True)
+        f = SearchForm(
+            data={
+                "q": query.validated_data["query"],
+                "l": query.validated_data["lang"],
+                "s": query.validated_data["sort"],
+                "i": "on" if query.validated_data["include_hidden"] else "",
+            }
+        )
+        f.is_valid()
+        _, documents, _ = get_documents(request, query.validated_data["adv_params"], f, stats_call)
+        return documents
+
 
 class SearchResult(serializers.Serializer):
     doc_id = serializers.PrimaryKeyRelatedField(source="id", queryset=Document.objects.all(), help_text="Document id")
@@ -267,27 +277,42 @@ class SearchViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
         },
     )
     def create(self, request, *args, **kwargs):
-        query = SearchQuery(data=request.data)
-        query.is_valid(raise_exception=True)
-        # ×raise Exception(query.validated_data)
-        f = SearchForm(
-            data={
-                "q": query.validated_data["query"],
-                "l": query.validated_data["lang"],
-                "s": query.validated_data["sort"],
-                "i": "on" if query.validated_data["include_hidden"] else "",
-            }
-        )
-        f.is_valid()
-        _, documents, _ = get_documents(request, query.validated_data["adv_params"], f, False)
+        documents = SearchQuery.get_documents(request, False)
         page = self.paginate_queryset(documents)
         serializer = SearchResult(page, many=True)
         return self.get_paginated_response(serializer.data)
 
 
+class FacetCountSerializer(serializers.Serializer):
+    value = serializers.CharField(help_text="Language or mimetype, empty when unknown")
+    doc_count = serializers.IntegerField(help_text="Document count")
+
+
+class SearchFacetsResult(serializers.Serializer):
+    lang = FacetCountSerializer(many=True, help_text="Matching documents per language")
+    mime = FacetCountSerializer(many=True, help_text="Matching documents per mimetype")
+    capped = serializers.BooleanField(
+        help_text="The counts only include the first matching documents, as more documents than the search count limit matched"
+    )
+
+
+class SearchFacetsViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
+    @extend_schema(
+        request=SearchQuery,
+        description="Language and mimetype counts of the documents matching a search query",
+        responses={
+            200: SearchFacetsResult,
+        },
+    )
+    def create(self, request, *args, **kwargs):
+        documents = SearchQuery.get_documents(request, True)
+        return Response(SearchFacetsResult(facet_counts(documents)).data)
+
+
 router = routers.DefaultRouter()
 router.register("document", DocumentViewSet)
 router.register("search", SearchViewSet, basename="search")
+router.register("search_facets", SearchFacetsViewSet, basename="search_facets")
 router.register("stats", CrawlerStatsViewSet)
 router.register("hdd_stats", HddStatsViewSet, basename="hdd_stats")
 router.register("lang_stats", LangStatsViewSet, basename="lang_stats")
@@ -0,0 +1,126 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+
+crawl_logger = logging.getLogger("crawler")
+
+PIL_FORMATS = {
+    "png": "PNG",
+    "jpg": "JPEG",
+}
+
+
+def tile_count(captures, tile_height):
+    # Image.open only reads the header, the count is known before decoding
+    count = 0
+    for png, crop_top in captures:
+        with Image.open(BytesIO(png)) as img:
+            count += -(-(img.size[1] - crop_top) // tile_height)
+    return count
+
+
+def encode_screenshots(captures, base_name, img_format, tile_height):
+    # Each capture is decoded once, cropped, cut in tiles of the viewport height
+    # and saved straight to the target format
+    img_no = 0
+    try:
+        for png, crop_top in captures:
+            with Image.open(BytesIO(png)) as img:
+                if img_format == "jpg":
+                    img = img.convert("RGB")  # Remove alpha channel from the png
+                width, height = img.size
+                for top in range(crop_top, height, tile_height):
+                    tile = img.crop((0, top, width, min(top + tile_height, height)))
+                    tile.save(f"{base_name}_{img_no}.{img_format}", PIL_FORMATS[img_format])
+                    img_no += 1
+    except Exception:
+        # The screenshot count of the document is reset, the tiles written are removed
+        for i in range(img_no + 1):
+            filename = f"{base_name}_{i}.{img_format}"
+            if os.path.exists(filename):
+                os.unlink(filename)
+        raise
+    return img_no
+
+
+def _log_error(future):
+    if future.exception():
+        crawl_logger.error("Screenshot encoding failed", exc_info=future.exception())
+
+
+class ScreenshotEncoder:
+    # Encoding runs in threads, while the browser loads the next page
+    _pool = None
+    # Encodings not collected yet, in submission order
+    _pending = deque()
+    # Document keys of the pending encodings, and of the failed ones
+    _keys = {}
+    _failed = []
+
+    @classmethod
+    def submit(cls, captures, base_name, img_format, tile_height):
+        count = tile_count(captures, tile_height)
+
+        if settings.SOSSE_SCREENSHOT_WORKERS == 0:
+            future = Future()
+            future.set_result(encode_screenshots(captures, base_name, img_format, tile_height))
+            return count, future
+
+        if cls._pool is None:
+            cls._pool = ThreadPoolExecutor(settings.SOSSE_SCREENSHOT_WORKERS)
+
+        # Each job holds the captures of a whole page, the crawler waits for the oldest ones
+        # instead of queuing them faster than they are encoded
+        cls._collect(settings.SOSSE_SCREENSHOT_WORKERS * 2 - 1)
+        future = cls._pool.submit(encode_screenshots, captures, base_name, img_format, tile_height)
+        future.add_done_callback(_log_error)
+        cls._pending.append(future)
+        return count, future
+
+    @classmethod
+    def track(cls, future, key):
+        # The key is returned by failures() if the encoding fails
+        if future in cls._pending:
+            cls._keys[future] = key
+
+    @classmethod
+    def _collect(cls, limit=None):
+        while cls._pending and ((limit is not None and len(cls._pending) > limit) or cls._pending[0].done()):
+            future = cls._pending.popleft()
+            wait((future,))
+            key = cls._keys.pop(future, None)
+            if key is not None and future.exception():
+                cls._failed.append(key)
+
+    @classmethod
+    def failures(cls):
+        cls._collect()
+        failed, cls._failed = cls._failed, []
+        return failed
+
+    @classmethod
+    def shutdown(cls):
+        # Pending screenshots are written before exiting
+        if cls._pool is not None:
+            cls._pool.shutdown()
+            cls._pool = None
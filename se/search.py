@@ -13,24 +13,29 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import logging
 import re
 import uuid
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from collections import OrderedDict
 
 from django.conf import settings
 from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
 from django.core.paginator import Paginator
 from django.db import models
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Coalesce
+from django.utils.functional import cached_property
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
-from .document import Document, extern_link_flags, remove_accent
+from .document import Document, extern_link_flags, normalized_to_content_pos, remove_accent
 from .html_asset import HTMLAsset
-from .models import SearchEngine, SearchHistory
+from .models import Facet, SearchEngine, SearchHistory
 from .search_form import FILTER_FIELDS, SearchForm
 from .utils import human_nb
-from .views import RedirectException, UserView
+from .views import RedirectException, UserView, format_url
 
 logger = logging.getLogger("web")
 
@@ -69,10 +74,10 @@ def get_documents(request, params, form, stats_call):
         all_results = Document.objects.filter(vector=query).annotate(
             rank=SearchRank(models.F("vector"), query),
         )
-        results = all_results.exclude(rank__lte=0.01)
 
-        if results.count() == 0:
-            results = all_results
+        # Low ranked documents are returned only when there are no other results
+        relevant = all_results.filter(rank__gt=0.01)
+        results = all_results.filter(models.Q(rank__gt=0.01) | ~models.Exists(relevant))
 
     include_hidden = form.cleaned_data.get("i", False) and True
 
@@ -155,7 +160,7 @@ def get_documents(request, params, form, stats_call):
         results = results.filter(lang_iso_639_1=doc_lang)
 
     if not stats_call:
-        order_by = form.cleaned_data["order_by"]
+        order_by = form.cleaned_data["order_by"] + ("id",)
         results = results.order_by(*order_by).distinct()
 
     if not has_query:
@@ -164,6 +169,112 @@ def get_documents(request, params, form, stats_call):
     return has_query, results, query
 
 
+def facet_counts(results):
+    # Counts are computed on the first matching documents only, the same way the results count is capped
+    limit = settings.SOSSE_SEARCH_COUNT_LIMIT
+    doc_ids = results.order_by().values("id")[:limit]
+    docs = Document.objects.filter(id__in=doc_ids)
+    facets = {}
+    for facet, field in ((Facet.LANG, "lang_iso_639_1"), (Facet.MIME, "mimetype")):
+        counts = (
+            docs.annotate(value=Coalesce(field, models.Value("")))
+            .values("value")
+            .annotate(doc_count=models.Count("id"))
+            .order_by("-doc_count", "value")
+        )
+        facets[facet] = list(counts)
+    facets["capped"] = results.order_by().values("id")[limit : limit + 1].exists()
+    return facets
+
+
+class SearchPaginator(Paginator):
+    # Fields that are never null with the types of their cursor values, a cursor can be built when the results
+    # are sorted by them only
+    KEYSET_FIELDS = {"rank": (int, float), "title": (str,), "url": (str,), "id": (int,)}
+
+    def __init__(self, object_list, per_page, cursor=None):
+        super().__init__(object_list, per_page)
+        self.count_capped = False
+        self.cursor = None
+
+        if cursor and self._keyset_fields():
+            try:
+                cursor = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+            except (ValueError, TypeError):
+                return
+            if self._valid_cursor(cursor):
+                self.cursor = cursor
+
+    def _valid_cursor(self, cursor):
+        # The cursor comes from the user, its values must match the fields they are compared to
+        if not isinstance(cursor, dict) or not isinstance(cursor.get("p"), int) or isinstance(cursor["p"], bool):
+            return False
+        values = cursor.get("v")
+        fields = self._keyset_fields()
+        if not isinstance(values, list) or len(values) != len(fields):
+            return False
+        for field, value in zip(fields, values):
+            name = field.lstrip("-")
+            if isinstance(value, bool) or not isinstance(value, self.KEYSET_FIELDS[name]):
+                return False
+            if name == "rank" and not abs(value) < 1e38:
+                # Also rejects NaN and infinity, the rank is a real
+                return False
+            if name == "id" and not 0 <= value < 2**31:
+                return False
+            if isinstance(value, str) and "\x00" in value:
+                return False
+        return True
+
+    @cached_property
+    def count(self):
+        # Stop counting when the limit is reached, instead of processing all matching documents
+        limit = settings.SOSSE_SEARCH_COUNT_LIMIT
+        count = self.object_list.order_by()[: limit + 1].count()
+        if count > limit:
+            self.count_capped = True
+            return limit
+        return count
+
+    def _keyset_fields(self):
+        order_by = self.object_list.query.order_by
+        if not all(field.lstrip("-") in self.KEYSET_FIELDS for field in order_by):
+            return None
+        return order_by
+
+    def _keyset_filter(self, values):
+        # Build the condition matching documents sorted after the values of the cursor
+        qf = models.Q()
+        equal = {}
+        for field, value in zip(self._keyset_fields(), values):
+            name = field.lstrip("-")
+            op = "lt" if field.startswith("-") else "gt"
+            if name == "rank":
+                # The rank is a real, compare it with the same precision
+                value = RawSQL("%s::real", (value,))
+            qf |= models.Q(**equal, **{f"{name}__{op}": value})
+            equal[name] = value
+        return qf
+
+    def page(self, number):
+        if self.cursor and self.cursor.get("p") == number:
+            # Deep pages are retrieved using the last document of the previous page, instead of an offset
+            number = self.validate_number(number)
+            object_list = self.object_list.filter(self._keyset_filter(self.cursor["v"]))[: self.per_page]
+            return self._get_page(object_list, number, self)
+        return super().page(number)
+
+    def next_cursor(self, page):
+        fields = self._keyset_fields()
+        if not fields or not page.has_next() or len(page) == 0:
+            return None
+
+        last = page[len(page) - 1]
+        values = [getattr(last, field.lstrip("-")) for field in fields]
+        cursor = json.dumps({"p": page.number + 1, "v": values}).encode("utf-8")
+        return urlsafe_b64encode(cursor).decode("ascii").rstrip("=")
+
+
 def fallback_headline(doc):
     lines = doc.content.splitlines()
     if lines:
@@ -171,56 +282,69 @@ def fallback_headline(doc):
     return ""
 
 
+def headline_segments(headline, start_sel, stop_sel):
+    # Split the headline in (text, highlighted) segments
+    segments = []
+    for no, chunk in enumerate(headline.split(start_sel)):
+        if no == 0 or stop_sel not in chunk:
+            segments.append((chunk, False))
+            continue
+        match, txt = chunk.split(stop_sel, 1)
+        segments.append((match, True))
+        segments.append((txt, False))
+    return segments
+
+
 def add_headlines(paginated, query):
-    for res in paginated:
-        # rebuild the headline using non-normalized content
-        if query:
-            rnd = uuid.uuid1().hex
-            pg_headline = (
-                Document.objects.filter(id=res.id)
-                .annotate(
-                    headline=SearchHeadline(
-                        "normalized_content",
-                        query,
-                        start_sel="s" + rnd,
-                        stop_sel="e" + rnd,
-                    )
+    headlines = {}
+    if query:
+        # Headlines of the page are computed in a single query
+        rnd = uuid.uuid1().hex
+        start_sel = "s" + rnd
+        stop_sel = "e" + rnd
+        headlines = dict(
+            Document.objects.filter(id__in=[res.id for res in paginated])
+            .annotate(
+                headline=SearchHeadline(
+                    "normalized_content",
+                    query,
+                    start_sel=start_sel,
+                    stop_sel=stop_sel,
                 )
-                .first()
             )
+            .values_list("id", "headline")
+        )
 
-            # find the location of the headline in the normalized content
-            headline = pg_headline.headline.replace("s" + rnd, "")
-            headline = headline.replace("e" + rnd, "")
-
-            if (
-                headline not in res.normalized_content
-                or "s" + rnd not in pg_headline.headline
-                or "e" + rnd not in pg_headline.headline
-            ):
-                res.headline = fallback_headline(res)
-                continue
-
-            headline_idx = res.normalized_content.index(headline)
-            src = pg_headline.headline
-            dest = escape("")
-            while src:
-                txt, src = src.split("s" + rnd, 1)
-                dest += escape(res.content[headline_idx : headline_idx + len(txt)])
-                headline_idx += len(txt)
-
-                match, src = src.split("e" + rnd, 1)
-                dest += '<span class="res-highlight">'
-                dest += escape(res.content[headline_idx : headline_idx + len(match)])
-                headline_idx += len(match)
-                dest += "</span>"
-
-                if "s" + rnd not in src or "e" + rnd not in src:
-                    dest += res.content[headline_idx : len(src)]
-                    break
-            res.headline = mark_safe(dest)  # nosec B308, B703 untrusted content is escaped above
-        else:
+    for res in paginated:
+        pg_headline = headlines.get(res.id)
+        if not pg_headline:
             res.headline = fallback_headline(res)
+            continue
+
+        # rebuild the headline using non-normalized content
+        segments = headline_segments(pg_headline, start_sel, stop_sel)
+        headline = "".join(txt for txt, _ in segments)
+
+        # find the location of the headline in the normalized content
+        headline_idx = res.normalized_content.find(headline)
+        if headline_idx == -1 or not any(highlighted for _, highlighted in segments):
+            res.headline = fallback_headline(res)
+            continue
+
+        # map the positions of the segments to the original content
+        offsets = res.normalized_content_offsets
+        content_idx = normalized_to_content_pos(offsets, headline_idx)
+        dest = ""
+        for txt, highlighted in segments:
+            headline_idx += len(txt)
+            content_end = normalized_to_content_pos(offsets, headline_idx)
+            txt_content = escape(res.content[content_idx:content_end])
+            content_idx = content_end
+            if highlighted:
+                dest += f'<span class="res-highlight">{txt_content}</span>'
+            else:
+                dest += txt_content
+        res.headline = mark_safe(dest)  # nosec B308, B703 untrusted content is escaped above
     return paginated
 
 
@@ -230,6 +354,7 @@ class SearchView(UserView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         results = []
+        results_count = 0
         paginated = None
         q = None
         has_query = False
@@ -246,10 +371,11 @@ class SearchView(UserView):
                     raise RedirectException(redirect_url)
 
             has_query, results, query = get_documents_from_request(self.request, form)
-            paginator = Paginator(results, form.cleaned_data["ps"])
+            paginator = SearchPaginator(results, form.cleaned_data["ps"], self.request.GET.get("k"))
             page_number = self.request.GET.get("p")
             paginated = paginator.get_page(page_number)
             paginated = add_headlines(paginated, query)
+            results_count = paginator.count
         else:
             form = SearchForm({})
             form.is_valid()
@@ -294,11 +420,21 @@ class SearchView(UserView):
             home_entries = Document.objects.filter(show_on_homepage=True).order_by("title")
 
         context.update(self._get_pagination(paginated))
+        if paginated:
+            cursor = paginated.paginator.next_cursor(paginated)
+            if cursor:
+                context["page_next"] = format_url(self.request, f"p={paginated.next_page_number()}&k={cursor}")
+
+        results_count_str = human_nb(results_count)
+        if paginated and paginated.paginator.count_capped:
+            results_count_str += "+"
+
         return context | {
             "hide_title": True,
             "form": form,
             "results": results,
-            "results_count": human_nb(len(results)),
+            "results_count": results_count_str,
+            "results_count_nb": results_count,
             "paginated": paginated,
             "has_query": has_query,
             "home_entries": home_entries,
@@ -0,0 +1,99 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+
+from django.db import models, transaction
+from django.utils.timezone import now
+
+from .html_snapshot import HTMLSnapshot
+from .page import Page
+
+logger = logging.getLogger("html_snapshot")
+
+
+class SnapshotTask(models.Model):
+    # HTML snapshots prepared by the crawlers, the assets are downloaded by the snapshot workers
+    document = models.ForeignKey("Document", on_delete=models.CASCADE)
+    crawl_policy = models.ForeignKey("CrawlPolicy", on_delete=models.CASCADE)
+    url = models.TextField()
+    content = models.BinaryField()
+    headers = models.JSONField(default=dict)
+    created = models.DateTimeField(default=now)
+    worker_no = models.PositiveIntegerField(blank=True, null=True)
+    # Set when the document is recrawled while the snapshot is being archived
+    superseded = models.BooleanField(default=False)
+
+    @staticmethod
+    def supersede(document):
+        # Pending snapshots of a previous crawl are dropped, the ones being archived are only marked so that
+        # they are not written. The update waits for a snapshot being written, since its row is locked
+        deleted, _ = SnapshotTask.objects.filter(document=document, worker_no__isnull=True).delete()
+        updated = SnapshotTask.objects.filter(document=document, worker_no__isnull=False).update(superseded=True)
+        return bool(deleted or updated)
+
+    @staticmethod
+    def queue(document, page, crawl_policy):
+        SnapshotTask.objects.create(
+            document=document,
+            crawl_policy=crawl_policy,
+            url=page.url,
+            content=page.dump_html(),
+            headers=dict(page.headers),
+        )
+
+    @staticmethod
+    def pick(worker_no):
+        with transaction.atomic():
+            # The document must have been saved by the crawler, and not be archived by another worker
+            task = (
+                SnapshotTask.objects.select_for_update(skip_locked=True, of=("self",))
+                .filter(worker_no__isnull=True, document__worker_no__isnull=True)
+                .exclude(
+                    document__in=SnapshotTask.objects.filter(worker_no__isnull=False).values("document"),
+                )
+                .order_by("id")
+                .first()
+            )
+            if task:
+                task.worker_no = worker_no
+                task.save(update_fields=["worker_no"])
+        return task
+
+    @staticmethod
+    def release(worker_no):
+        SnapshotTask.objects.filter(worker_no=worker_no).update(worker_no=None)
+
+    def _can_write(self):
+        from .document import Document
+
+        # The row stays locked until the snapshot is written, so that a recrawl superseding it waits
+        if not SnapshotTask.objects.select_for_update().filter(id=self.id, superseded=False).exists():
+            return False
+        Document.objects.filter(id=self.document_id).update(has_html_snapshot=True)
+        return True
+
+    @staticmethod
+    def process_next(worker_no):
+        task = SnapshotTask.pick(worker_no)
+        if task is None:
+            return False
+
+        try:
+            page = Page(task.url, bytes(task.content), None, task.headers)
+            HTMLSnapshot(page, task.crawl_policy).archive(task._can_write)
+        finally:
+            task.delete()
+        return True
@@ -13,9 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import os
+import shutil
+import tempfile
 from unittest import mock
 
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
+from selenium.common.exceptions import WebDriverException
 
 from .browser_chromium import BrowserChromium
 from .test_mock import BrowserMock
@@ -53,3 +57,182 @@ class ChromiumTest(TransactionTestCase):
 
         content = BrowserChromium._escape_content_handler(self.IMG_CONTENT)
         self.assertEqual(content, b"Image content")
+
+    def _fake_driver(self):
+        driver = mock.Mock()
+        driver.current_url = "http://127.0.0.1/"
+        driver.execute_script.return_value = True
+        page_source = mock.PropertyMock(return_value="<html></html>")
+        type(driver).page_source = page_source
+        return driver, page_source
+
+    @override_settings(SOSSE_JS_STABLE_MODE="observer")
+    def test_js_stable_observer(self):
+        driver, page_source = self._fake_driver()
+        driver.execute_async_script.return_value = True
+        with mock.patch.object(BrowserChromium, "init"), mock.patch.object(BrowserChromium, "_driver", driver):
+            self.assertEqual(BrowserChromium._wait_for_ready("http://127.0.0.1/"), 0)
+        driver.execute_async_script.assert_called_once()
+        page_source.assert_not_called()
+
+    @override_settings(SOSSE_JS_STABLE_MODE="observer")
+    def test_js_stable_observer_fallback(self):
+        driver, page_source = self._fake_driver()
+        driver.execute_async_script.side_effect = WebDriverException("script failed")
+        with mock.patch.object(BrowserChromium, "init"), mock.patch.object(BrowserChromium, "_driver", driver):
+            self.assertEqual(BrowserChromium._wait_for_ready("http://127.0.0.1/"), 0)
+        self.assertEqual(page_source.call_count, 2)
+
+    @override_settings(SOSSE_JS_STABLE_MODE="poll")
+    def test_js_stable_poll(self):
+        driver, page_source = self._fake_driver()
+        with mock.patch.object(BrowserChromium, "init"), mock.patch.object(BrowserChromium, "_driver", driver):
+            self.assertEqual(BrowserChromium._wait_for_ready("http://127.0.0.1/"), 0)
+        driver.execute_async_script.assert_not_called()
+        self.assertEqual(page_source.call_count, 2)
+
+    @override_settings(SOSSE_BROWSER_SPARE=True, SOSSE_BROWSER_RECYCLE_PAGES=2)
+    @mock.patch("os.chdir")
+    def test_browser_spare(self, chdir):
+        drivers = [mock.Mock(name=f"driver{i}") for i in range(3)]
+        with mock.patch.object(BrowserChromium, "_new_driver", side_effect=drivers):
+            try:
+                BrowserChromium.init()
+                self.assertIs(BrowserChromium._driver, drivers[0])
+                BrowserChromium._spare_thread.join()
+                self.assertIs(BrowserChromium._spare, drivers[1])
+
+                BrowserChromium._page_count = 2
+                self.assertTrue(BrowserChromium._should_recycle())
+                BrowserChromium.recycle()
+                drivers[0].quit.assert_called_once()
+
+                # The spare replaces the browser, and a new spare is started
+                BrowserChromium.init()
+                self.assertIs(BrowserChromium._driver, drivers[1])
+                self.assertEqual(BrowserChromium._page_count, 0)
+                BrowserChromium._spare_thread.join()
+                self.assertIs(BrowserChromium._spare, drivers[2])
+            finally:
+                BrowserChromium.destroy()
+
+        drivers[1].quit.assert_called_once()
+        drivers[2].quit.assert_called_once()
+        self.assertIsNone(BrowserChromium._spare)
+
+    @override_settings(SOSSE_BROWSER_SPARE=True)
+    @mock.patch("os.chdir")
+    def test_browser_spare_idle(self, chdir):
+        drivers = [mock.Mock(name=f"driver{i}") for i in range(2)]
+        with mock.patch.object(BrowserChromium, "_new_driver", side_effect=drivers):
+            try:
+                BrowserChromium.init()
+                BrowserChromium._spare_thread.join()
+
+                # The idle crawler closes its browser, the spare is kept until the crawler exits
+                BrowserChromium.recycle()
+                drivers[0].quit.assert_called_once()
+                self.assertIs(BrowserChromium._spare, drivers[1])
+            finally:
+                BrowserChromium.destroy()
+        drivers[1].quit.assert_called_once()
+        self.assertIsNone(BrowserChromium._spare)
+
+    @override_settings(SOSSE_BROWSER_SPARE=False, SOSSE_BROWSER_RECYCLE_PAGES=2)
+    @mock.patch("os.chdir")
+    def test_browser_recycle_count(self, chdir):
+        drivers = [mock.Mock(name=f"driver{i}", current_url="about:blank") for i in range(3)]
+
+        def driver_get(url, force_reload=False):
+            BrowserChromium._driver.current_url = url
+
+        browser_patch = mock.patch.multiple(
+            BrowserChromium,
+            _new_driver=mock.DEFAULT,
+            _driver_get=mock.DEFAULT,
+            _get_page=mock.DEFAULT,
+            _load_cookies=mock.DEFAULT,
+            _save_cookies=mock.DEFAULT,
+        )
+        with browser_patch as patched:
+            patched["_new_driver"].side_effect = drivers
+            patched["_driver_get"].side_effect = driver_get
+            try:
+                for i in range(5):
+                    BrowserChromium.get(f"http://127.0.0.1/{i}")
+            finally:
+                BrowserChromium.destroy()
+
+        # Each browser loads 2 pages, including the first one after a recycle
+        self.assertEqual(patched["_new_driver"].call_count, 3)
+        drivers[0].quit.assert_called_once()
+        drivers[1].quit.assert_called_once()
+
+    @override_settings(SOSSE_BROWSER_TABS=3)
+    def test_browser_tabs(self):
+        driver, _ = self._fake_driver()
+        driver.current_window_handle = "main"
+        handles = iter(["tab1", "tab2", "tab3"])
+
+        def new_window(kind):
+            driver.current_window_handle = next(handles)
+
+        def switch_window(handle):
+            driver.current_window_handle = handle
+
+        driver.switch_to.new_window.side_effect = new_window
+        driver.switch_to.window.side_effect = switch_window
+
+        browser_patch = mock.patch.multiple(
+            BrowserChromium, init=mock.DEFAULT, _driver=driver, inited=True, _tabs={}, _get_page=mock.DEFAULT
+        )
+        with browser_patch as patched:
+            get_page = patched["_get_page"]
+            get_page.return_value = "page"
+            urls = ["http://127.0.0.1/1", "http://127.0.0.1/2", "http://127.0.0.1/3"]
+            BrowserChromium.preload(urls)
+            self.assertEqual(BrowserChromium._tabs, {urls[0]: "tab1", urls[1]: "tab2"})
+            self.assertEqual(driver.current_window_handle, "main")
+            driver.execute_script.assert_called_with("window.location.href = arguments[0];", urls[1])
+
+            # Tabs of urls that are not upcoming anymore are closed
+            BrowserChromium.preload(urls[:1])
+            self.assertEqual(BrowserChromium._tabs, {urls[0]: "tab1"})
+            self.assertEqual(driver.close.call_count, 1)
+
+            # The preloaded tab replaces the main one
+            self.assertEqual(BrowserChromium._get_preloaded(urls[0]), "page")
+            get_page.assert_called_once_with(urls[0])
+            self.assertEqual(driver.current_window_handle, "tab1")
+            self.assertEqual(driver.close.call_count, 2)
+            self.assertEqual(BrowserChromium._tabs, {})
+
+    @override_settings(SOSSE_DL_CHECK_RETRY=3, SOSSE_DL_CHECK_TIME=0)
+    def test_browser_close_preloads(self):
+        driver, _ = self._fake_driver()
+        driver.current_window_handle = "main"
+        dl_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dl_dir)
+
+        browser_patch = mock.patch.multiple(
+            BrowserChromium,
+            _driver=driver,
+            inited=True,
+            _tabs={"http://127.0.0.1/1": "tab1", "http://127.0.0.1/2": "tab2"},
+            _get_download_dir=mock.DEFAULT,
+        )
+        with browser_patch as patched:
+            patched["_get_download_dir"].return_value = dl_dir
+            with open(os.path.join(dl_dir, "file.pdf"), "w") as f:
+                f.write("pdf")
+
+            # The preloaded tabs are closed and their downloads removed without warning
+            self.assertTrue(BrowserChromium._close_preloads())
+            self.assertEqual(driver.close.call_count, 2)
+            self.assertEqual(BrowserChromium._tabs, {})
+            self.assertFalse(BrowserChromium._close_preloads())
+
+            with mock.patch("se.browser_selenium.crawl_logger.warning") as warning:
+                BrowserChromium._clear_download_dir(warn=False)
+            warning.assert_not_called()
+            self.assertEqual(os.listdir(dl_dir), [])
@@ -13,18 +13,24 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from collections import deque
 from datetime import datetime, timedelta, timezone
 from hashlib import md5
 from unittest import mock
 
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from .browser import AuthElemFailed, SkipIndexing
 from .crawl_policy import CrawlPolicy
 from .document import Document
 from .domain_setting import DomainSetting
-from .models import ExcludedUrl, Link
+from .html_snapshot import HTMLSnapshot
+from .models import EXCLUDED_URL_INDEX, ExcludedUrl, Link
 from .page import Page
+from .snapshot_queue import SnapshotTask
 from .test_mock import BrowserMock
 
 
@@ -713,3 +719,417 @@ class CrawlerTest(TransactionTestCase):
         self.assertEqual(doc.content, "Hello world change")
         self.assertEqual(doc.content_hash, md5(b"Hello world change").hexdigest())
         self.assertEqual(doc.modified_date, self.fake_now)
+
+    @mock.patch("se.document.now")
+    def test_220_claim_batch(self, now):
+        now.side_effect = lambda: self.fake_now
+        recrawl = Document.objects.create(url="http://127.0.0.1/recrawl", crawl_last=self.fake_yesterday)
+        recrawl.crawl_next = self.fake_yesterday
+        recrawl.save()
+        Document.objects.create(
+            url="http://127.0.0.1/not_due", crawl_last=self.fake_yesterday, crawl_next=self.fake_next
+        )
+        new_docs = [Document.objects.create(url=f"http://127.0.0.1/new{i}") for i in range(3)]
+
+        claimed = Document.claim_queued(0, 2)
+        self.assertEqual(claimed, [new_docs[0].id, new_docs[1].id])
+
+        claimed = Document.claim_queued(1, 5)
+        self.assertEqual(claimed, [new_docs[2].id, recrawl.id])
+        self.assertEqual(Document.claim_queued(2, 5), [])
+
+        self.assertEqual(
+            list(Document.objects.filter(worker_no=0).order_by("id").values_list("id", flat=True)),
+            [new_docs[0].id, new_docs[1].id],
+        )
+        self.assertEqual(Document.objects.filter(worker_no=1).count(), 2)
+
+    @override_settings(SOSSE_CRAWLER_BATCH_SIZE=3)
+    def test_230_release_claims(self):
+        docs = [Document.objects.create(url=f"http://127.0.0.1/page{i}") for i in range(4)]
+
+        doc = Document.pick_queued(0)
+        self.assertEqual(doc, docs[0])
+        self.assertEqual(Document.objects.filter(worker_no=0).count(), 3)
+
+        Document.release_claims(0)
+        self.assertEqual(
+            list(Document.objects.filter(worker_no=0).values_list("id", flat=True)),
+            [docs[0].id],
+        )
+
+        # Released documents can be claimed by another worker
+        doc = Document.pick_queued(1)
+        self.assertEqual(doc, docs[1])
+        Document.release_claims(1)
+
+    @override_settings(SOSSE_CRAWLER_BATCH_SIZE=3)
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    def test_240_crawl_batch(self, BrowserRequest):
+        BrowserRequest.side_effect = BrowserMock(
+            {
+                "http://127.0.0.1/": b'Root <a href="/page1/">Link1</a><a href="/page2/">Link2</a>',
+                "http://127.0.0.1/page1/": b"Page1",
+                "http://127.0.0.1/page2/": b"Page2",
+            }
+        )
+        self._crawl()
+        self.assertEqual(Document.objects.count(), 3)
+        self.assertEqual(Document.objects.filter(crawl_last__isnull=True).count(), 0)
+        self.assertEqual(Document.objects.filter(worker_no__isnull=False).count(), 0)
+
+    @override_settings(SOSSE_CRAWLER_BATCH_SIZE=1)
+    def test_250_domain_max_concurrency(self):
+        domain = DomainSetting.objects.create(domain="127.0.0.1", max_concurrency=1)
+        docs = [Document.objects.create(url=f"http://127.0.0.1/page{i}") for i in range(2)]
+        other = Document.objects.create(url="http://127.0.0.2/")
+
+        doc = Document.pick_queued(0)
+        self.assertEqual(doc, docs[0])
+        self.assertEqual(doc._domain_slot, domain)
+        domain.refresh_from_db()
+        self.assertEqual(domain.active_crawlers, 1)
+
+        # The domain is busy, the next document is from another domain
+        self.assertEqual(Document.pick_queued(1), other)
+        Document.release_claims(0)
+        Document.release_claims(1)
+
+        doc._domain_slot.release_slot()
+        domain.refresh_from_db()
+        self.assertEqual(domain.active_crawlers, 0)
+        self.assertEqual(Document.pick_queued(1), docs[1])
+
+    def test_260_domain_rate_limit(self):
+        domain = DomainSetting.objects.create(domain="127.0.0.1", requests_per_sec=0.001)
+        self.assertTrue(domain.acquire_slot())
+        domain.release_slot()
+        domain.refresh_from_db()
+        self.assertEqual(domain.active_crawlers, 0)
+        self.assertIsNotNone(domain.next_request)
+
+        # The next request is scheduled in 1000 seconds
+        self.assertFalse(domain.acquire_slot())
+        doc = Document.objects.create(url="http://127.0.0.1/")
+        self.assertIsNone(Document.pick_queued(0))
+        self.assertEqual(Document.objects.filter(worker_no__isnull=False).count(), 0)
+        Document.release_claims(0)
+
+        DomainSetting.objects.update(next_request=None)
+        self.assertEqual(Document.pick_queued(0), doc)
+        Document.release_claims(0)
+
+    @override_settings(SOSSE_CRAWLER_BATCH_SIZE=2)
+    def test_262_busy_domain_step_over(self):
+        domain = DomainSetting.objects.create(domain="127.0.0.1", requests_per_sec=0.001)
+        self.assertTrue(domain.acquire_slot())
+        domain.release_slot()
+        busy = [Document.objects.create(url=f"http://127.0.0.1/page{i}") for i in range(5)]
+        other = Document.objects.create(url="http://127.0.0.2/")
+
+        # The documents of the busy domain at the head of the queue are stepped over, then released
+        self.assertEqual(Document.pick_queued(0), other)
+        self.assertEqual(Document.objects.filter(id__in=[doc.id for doc in busy], worker_no__isnull=False).count(), 0)
+        Document.release_claims(0)
+
+    def test_265_domain_limits_validation(self):
+        for field, value in (("max_concurrency", 0), ("requests_per_sec", 0.0), ("requests_per_sec", -1.0)):
+            with self.assertRaises(ValidationError, msg=f"{field}={value}"):
+                DomainSetting(domain="127.0.0.1", **{field: value}).full_clean()
+        DomainSetting(domain="127.0.0.1", max_concurrency=1, requests_per_sec=0.5).full_clean()
+
+    def test_270_bulk_links_vector(self):
+        doc_from = Document.objects.create(url="http://127.0.0.1/")
+        docs = [
+            Document.objects.create(url=f"http://127.0.0.1/page{i}", normalized_title=f"page{i}", vector_lang="simple")
+            for i in range(3)
+        ]
+
+        Link.objects.bulk_create(
+            [Link(doc_from=doc_from, doc_to=doc, text=f"link{i}", pos=i, link_no=i) for i, doc in enumerate(docs)]
+        )
+        for i, doc in enumerate(docs):
+            doc.refresh_from_db()
+            self.assertEqual(doc.anchor_vector, f"'link{i}':1B")
+            self.assertIn(f"'link{i}':", doc.vector)
+            self.assertIn(f"'page{i}':1A", doc.vector)
+        doc_from.refresh_from_db()
+        self.assertNotIn("link", doc_from.vector)
+
+        # Updating the text of a link refreshes the anchor part of the vector
+        Link.objects.filter(doc_to=docs[0]).update(text="other")
+        docs[0].refresh_from_db()
+        self.assertEqual(docs[0].anchor_vector, "'other':1B")
+        self.assertNotIn("link0", docs[0].vector)
+        self.assertIn("'other':", docs[0].vector)
+
+        # Deleting a link removes its text
+        Link.objects.filter(doc_to=docs[1]).delete()
+        docs[1].refresh_from_db()
+        self.assertEqual(docs[1].anchor_vector, "")
+        self.assertNotIn("link1", docs[1].vector)
+
+    def test_275_vector_trigger(self):
+        doc = Document.objects.create(
+            url="http://127.0.0.1/", normalized_title="title", normalized_content="content", vector_lang="simple"
+        )
+        Link.objects.create(doc_from=doc, doc_to=doc, text="anchor", pos=0, link_no=0)
+        doc.refresh_from_db()
+        vector = doc.vector
+        self.assertEqual(vector, "'anchor':3B 'content':2C 'title':1A")
+
+        # Outdated vectors sent by the application are ignored
+        doc.vector = None
+        doc.anchor_vector = None
+        doc.worker_no = 1
+        doc.save()
+        doc.refresh_from_db()
+        self.assertEqual(doc.vector, vector)
+        self.assertEqual(doc.anchor_vector, "'anchor':1B")
+
+        # Indexed columns are tokenized again when they change
+        doc.normalized_content = "new content"
+        doc.save()
+        doc.refresh_from_db()
+        self.assertEqual(doc.vector, "'anchor':4B 'content':3C 'new':2C 'title':1A")
+
+    def test_280_queue_bulk(self):
+        ExcludedUrl.objects.create(url="http://127.0.0.1/excluded")
+        ExcludedUrl.objects.create(url="http://127.0.0.1/prefix/", starting_with=True)
+        existing = Document.objects.create(url="http://127.0.0.2/existing")
+        urls = [
+            "http://127.0.0.1/page",
+            "http://127.0.0.1/excluded",
+            "http://127.0.0.1/prefix/page",
+            "http://127.0.0.2/existing",
+            "http://127.0.0.2/new",
+        ]
+
+        docs = Document.queue_bulk(urls, self.crawl_policy, existing)
+        self.assertEqual(sorted(docs.keys()), ["http://127.0.0.1/page", "http://127.0.0.2/existing"])
+        self.assertEqual(docs["http://127.0.0.2/existing"], existing)
+        self.assertEqual(Document.objects.count(), 2)
+
+        # The number of queries does not depend on the number of urls
+        with CaptureQueriesContext(connection) as few:
+            Document.queue_bulk([f"http://127.0.0.1/few{i}" for i in range(2)], self.crawl_policy, existing)
+        with CaptureQueriesContext(connection) as many:
+            Document.queue_bulk([f"http://127.0.0.1/many{i}" for i in range(50)], self.crawl_policy, existing)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(Document.objects.count(), 54)
+
+    def test_290_queue_bulk_recursion(self):
+        self.crawl_policy.recursion = CrawlPolicy.CRAWL_ON_DEPTH
+        self.crawl_policy.save()
+        parent = Document.objects.create(url="http://127.0.0.1/", crawl_recurse=3)
+        deeper = Document.objects.create(url="http://127.0.0.1/deeper", crawl_recurse=5)
+
+        docs = Document.queue_bulk(["http://127.0.0.1/new", "http://127.0.0.1/deeper"], self.crawl_policy, parent)
+        self.assertEqual(docs["http://127.0.0.1/new"].crawl_recurse, 2)
+        self.assertEqual(docs["http://127.0.0.1/deeper"], deeper)
+        self.assertEqual(docs["http://127.0.0.1/deeper"].crawl_recurse, 5)
+
+        parent.crawl_recurse = 1
+        docs = Document.queue_bulk(["http://127.0.0.1/other"], self.crawl_policy, parent)
+        self.assertEqual(docs, {})
+
+    def test_300_excluded_url_index(self):
+        ExcludedUrl.objects.create(url="http://127.0.0.1/exact")
+        ExcludedUrl.objects.create(url="http://127.0.0.1/prefix/", starting_with=True)
+        ExcludedUrl.objects.create(url="http://127.0.0.1/prefix/sub/", starting_with=True)
+        ExcludedUrl.objects.create(url="http://127.0.0.2", starting_with=True)
+
+        self.assertTrue(ExcludedUrl.is_excluded("http://127.0.0.1/exact"))
+        with self.assertNumQueries(0):
+            self.assertFalse(ExcludedUrl.is_excluded("http://127.0.0.1/exact2"))
+            self.assertTrue(ExcludedUrl.is_excluded("http://127.0.0.1/prefix/"))
+            self.assertTrue(ExcludedUrl.is_excluded("http://127.0.0.1/prefix/sub/page"))
+            self.assertFalse(ExcludedUrl.is_excluded("http://127.0.0.1/prefix"))
+            self.assertTrue(ExcludedUrl.is_excluded("http://127.0.0.2:8000/"))
+
+            urls = ["http://127.0.0.1/", "http://127.0.0.1/prefix/page", "http://127.0.0.1/exact", "http://127.0.0.3/"]
+            self.assertEqual(ExcludedUrl.filter_urls(urls), ["http://127.0.0.1/", "http://127.0.0.3/"])
+
+        # Reloading replaces the index as a whole, a reader holding the previous state is unaffected
+        state = EXCLUDED_URL_INDEX.state
+        ExcludedUrl.objects.get(url="http://127.0.0.1/exact").delete()
+        self.assertFalse(ExcludedUrl.is_excluded("http://127.0.0.1/exact"))
+        self.assertIsNot(EXCLUDED_URL_INDEX.state, state)
+        self.assertIn("http://127.0.0.1/exact", state[0])
+        self.assertTrue(EXCLUDED_URL_INDEX._is_excluded("http://127.0.0.1/exact", state))
+
+    @override_settings(SOSSE_SNAPSHOT_WORKERS=1)
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    @mock.patch("os.makedirs")
+    @mock.patch("se.html_cache.open")
+    def test_310_snapshot_queue(self, cache_open, makedirs, BrowserRequest):
+        BrowserRequest.side_effect = BrowserMock({"http://127.0.0.1/": b"<html><body>Hello world</body></html>"})
+        makedirs.side_effect = None
+        cache_open.side_effect = lambda *args, **kwargs: open("/dev/null", *args[1:], **kwargs)
+        self.crawl_policy.snapshot_html = True
+        self.crawl_policy.save()
+
+        self._crawl()
+        doc = Document.objects.get()
+        # The snapshot is flagged once written by the snapshot worker
+        self.assertFalse(doc.has_html_snapshot)
+        cache_open.assert_not_called()
+
+        task = SnapshotTask.objects.get()
+        self.assertEqual(task.document, doc)
+        self.assertIn(b"Hello world", bytes(task.content))
+
+        # A recrawl replaces the pending snapshot
+        Document.objects.update(crawl_next=None)
+        self._crawl()
+        self.assertEqual(SnapshotTask.objects.count(), 1)
+
+        self.assertTrue(SnapshotTask.process_next(0))
+        self.assertFalse(SnapshotTask.process_next(0))
+        self.assertEqual(SnapshotTask.objects.count(), 0)
+        cache_open.assert_called_once()
+        self.assertTrue(cache_open.call_args[0][0].endswith(".html"))
+        self.assertTrue(Document.objects.get().has_html_snapshot)
+
+    @override_settings(SOSSE_SNAPSHOT_WORKERS=1)
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    @mock.patch("os.makedirs")
+    @mock.patch("se.html_cache.open")
+    def test_315_snapshot_superseded(self, cache_open, makedirs, BrowserRequest):
+        BrowserRequest.side_effect = BrowserMock({"http://127.0.0.1/": b"<html><body>Old content</body></html>"})
+        makedirs.side_effect = None
+        cache_open.side_effect = lambda *args, **kwargs: open("/dev/null", *args[1:], **kwargs)
+        self.crawl_policy.snapshot_html = True
+        self.crawl_policy.save()
+
+        self._crawl()
+        old_task = SnapshotTask.pick(0)
+        self.assertIsNotNone(old_task)
+
+        # The document is recrawled while its previous snapshot is being archived
+        BrowserRequest.side_effect = BrowserMock({"http://127.0.0.1/": b"<html><body>New content</body></html>"})
+        Document.objects.update(crawl_next=self.fake_yesterday)
+        self._crawl()
+        old_task.refresh_from_db()
+        self.assertTrue(old_task.superseded)
+        self.assertEqual(SnapshotTask.objects.count(), 2)
+
+        # The new snapshot waits for the previous one to be done
+        self.assertIsNone(SnapshotTask.pick(1))
+
+        page = Page(old_task.url, bytes(old_task.content), None, old_task.headers)
+        self.assertFalse(HTMLSnapshot(page, self.crawl_policy).archive(old_task._can_write))
+        old_task.delete()
+        cache_open.assert_not_called()
+        self.assertFalse(Document.objects.get().has_html_snapshot)
+
+        self.assertTrue(SnapshotTask.process_next(1))
+        cache_open.assert_called_once()
+        self.assertTrue(Document.objects.get().has_html_snapshot)
+
+    @override_settings(SOSSE_SNAPSHOT_WORKERS=1)
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    @mock.patch("os.makedirs")
+    @mock.patch("se.html_cache.open")
+    def test_317_snapshot_done_during_recrawl(self, cache_open, makedirs, BrowserRequest):
+        BrowserRequest.side_effect = BrowserMock({"http://127.0.0.1/": b"<html><body>Content</body></html>"})
+        makedirs.side_effect = None
+        cache_open.side_effect = lambda *args, **kwargs: open("/dev/null", *args[1:], **kwargs)
+        self.crawl_policy.snapshot_html = True
+        self.crawl_policy.save()
+        self._crawl()
+
+        # The snapshot is written, and its task deleted, after the crawler loaded the document
+        doc = Document.objects.get()
+        self.assertFalse(doc.has_html_snapshot)
+        self.assertTrue(SnapshotTask.process_next(1))
+        self.assertEqual(SnapshotTask.objects.count(), 0)
+
+        with mock.patch("se.document.HTMLAsset.html_delete_url") as html_delete_url:
+            doc._clear_dump_content()
+        html_delete_url.assert_called_once_with(doc.url)
+        self.assertFalse(doc.has_html_snapshot)
+
+    @override_settings(SOSSE_BROWSER_TABS=3)
+    @mock.patch("se.browser_chromium.BrowserChromium.preload")
+    def test_320_preload_next(self, preload):
+        self.crawl_policy.default_browse_mode = DomainSetting.BROWSE_CHROMIUM
+        self.crawl_policy.save()
+        DomainSetting.objects.create(domain="127.0.0.1", browse_mode=DomainSetting.BROWSE_CHROMIUM, ignore_robots=True)
+        DomainSetting.objects.create(domain="127.0.0.2", max_concurrency=2, ignore_robots=True)
+        for url in ("http://127.0.0.1/page0", "http://127.0.0.2/", "http://127.0.0.1/page1", "http://127.0.0.1/page2"):
+            Document.objects.create(url=url)
+
+        Document._claimed[0] = deque(Document.claim_queued(0, 4))
+        Document._claimed[0].popleft()
+
+        # Only the next 2 documents are preloaded, rate limited domains are skipped
+        Document._preload_next(0)
+        preload.assert_called_once_with(["http://127.0.0.1/page1"])
+        Document.release_claims(0)
+
+    @override_settings(SOSSE_BROWSER_TABS=5)
+    @mock.patch("se.domain_setting.DomainSetting._load_robotstxt")
+    @mock.patch("se.browser_chromium.BrowserChromium.preload")
+    def test_325_preload_skipped(self, preload, load_robotstxt):
+        self.crawl_policy.default_browse_mode = DomainSetting.BROWSE_CHROMIUM
+        self.crawl_policy.save()
+        DomainSetting.objects.create(domain="127.0.0.1", browse_mode=DomainSetting.BROWSE_CHROMIUM, ignore_robots=True)
+        DomainSetting.objects.create(domain="127.0.0.2", browse_mode=DomainSetting.BROWSE_CHROMIUM)
+        for url in (
+            "http://127.0.0.1/page0",
+            "http://127.0.0.2/page",
+            "http://127.0.0.1/file.pdf",
+            "http://127.0.0.1/page1",
+            "http://127.0.0.1/page2",
+        ):
+            Document.objects.create(url=url)
+        Document.objects.filter(url="http://127.0.0.1/page2").update(mimetype="image/png")
+
+        Document._claimed[0] = deque(Document.claim_queued(0, 5))
+        Document._claimed[0].popleft()
+
+        # Non-HTML documents and domains with an unknown robots.txt are skipped, robots.txt is not fetched
+        Document._preload_next(0)
+        preload.assert_called_once_with(["http://127.0.0.1/page1"])
+        load_robotstxt.assert_not_called()
+        Document.release_claims(0)
+
+    @mock.patch("se.browser_chromium.BrowserChromium.take_screenshots", return_value=(1, None))
+    @mock.patch("se.browser_chromium.BrowserChromium.scroll_to_page")
+    @mock.patch("se.browser_chromium.BrowserChromium.get_links_pos_abs")
+    def test_330_screenshot_links_pos(self, get_links_pos_abs, scroll_to_page, take_screenshots):
+        self.crawl_policy.default_browse_mode = DomainSetting.BROWSE_CHROMIUM
+        self.crawl_policy.save()
+        doc = Document.objects.create(url="http://127.0.0.1/")
+        links = [
+            Link(doc_from=doc, extern_url=f"http://127.0.0.2/{i}", link_no=i, pos=i, text=f"link{i}") for i in range(3)
+        ]
+        Link.objects.bulk_create(links)
+        for i, link in enumerate(links):
+            link.css_selector = f"/html[1]/body[1]/a[{i + 1}]"
+
+        get_links_pos_abs.return_value = [[10, 20, 110.5, 40], None, [0, 100, 50, 120]]
+        with CaptureQueriesContext(connection) as queries:
+            doc.screenshot_index(links, self.crawl_policy)
+
+        get_links_pos_abs.assert_called_once_with([link.css_selector for link in links])
+        self.assertEqual(len([q for q in queries if q["sql"].startswith("UPDATE")]), 1)
+        self.assertEqual(
+            list(Link.objects.order_by("link_no").values_list("screen_pos", flat=True)),
+            ["10,20,100,20", None, "0,100,50,20"],
+        )
+
+    @override_settings(TEST_MODE=False)
+    @mock.patch("se.models.FavIcon.extract", side_effect=Exception("favicon failed"))
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    def test_340_lang_on_index_error(self, BrowserRequest, extract):
+        text = "The quick brown fox jumps over the lazy dog, while the cat is sleeping in the garden. " * 10
+        BrowserRequest.side_effect = BrowserMock({"http://127.0.0.1/": text.encode("utf-8")})
+        self._crawl()
+
+        # The content saved by the error path is indexed with its own language
+        doc = Document.objects.get()
+        self.assertIn("favicon failed", doc.error)
+        self.assertEqual(doc.content, text.strip())
+        self.assertEqual(doc.lang_iso_639_1, "en")
@@ -16,7 +16,7 @@
 from django.core.exceptions import ValidationError
 from django.test import TransactionTestCase
 
-from .crawl_policy import CrawlPolicy
+from .crawl_policy import CRAWL_POLICY_MATCHER, CrawlPolicy
 
 
 class CrawlPolicyTest(TransactionTestCase):
@@ -73,3 +73,73 @@ class CrawlPolicyTest(TransactionTestCase):
         with self.assertRaises(ValidationError):
             policy = CrawlPolicy(url_regex="(")
             policy.full_clean()
+
+    def test_080_cached_match(self):
+        CrawlPolicy.get_from_url("http://127.0.0.1/")
+        with self.assertNumQueries(0):
+            policy = CrawlPolicy.get_from_url("http://127.0.0.1/")
+        self.assertEqual(policy, self.policy)
+
+        with self.assertNumQueries(0):
+            policy = CrawlPolicy.get_from_url("http://127.0.0.2/")
+        self.assertEqual(policy, self.default_policy)
+
+    def test_090_invalidation(self):
+        self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/"), self.policy)
+
+        # Update made by another process
+        CrawlPolicy.objects.filter(id=self.policy.id).update(enabled=False)
+        CRAWL_POLICY_MATCHER.checked = 0
+        self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/"), self.default_policy)
+
+        self.policy.enabled = True
+        self.policy.save()
+        self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/"), self.policy)
+
+    def test_100_leftmost_longest(self):
+        multi = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/a\n0.1/abcdef.*")
+        longer = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/abcde")
+
+        # Like REGEXP_SUBSTR, the leftmost match of a policy is used even if a later one is longer
+        policy = CrawlPolicy.get_from_url("http://127.0.0.1/abcdefghijklmnopqrstuvwxyz")
+        self.assertEqual(policy, longer)
+        self.assertNotEqual(policy, multi)
+
+    def test_110_pg_regex_fallback(self):
+        pg_policy = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/\\mabc\\M")
+        policy = CrawlPolicy.get_from_url("http://127.0.0.1/abc")
+        self.assertEqual(list(CRAWL_POLICY_MATCHER.pg_policies.keys()), [pg_policy.id])
+        self.assertEqual(policy, pg_policy)
+        self.assertEqual(CrawlPolicy.get_from_urls(["http://127.0.0.1/abc"]), {"http://127.0.0.1/abc": pg_policy})
+
+    def test_120_pg_only_syntax_fallback(self):
+        # These compile in Python but match differently, so they are matched by the database
+        for url_regex in ("http://127.0.0.1/[[:digit:]]+", "http://127.0.0.1/(a|ab)", "http://127.0.0.1/a+?"):
+            pg_policy = CrawlPolicy.objects.create(url_regex=url_regex)
+            CrawlPolicy.get_from_url("http://127.0.0.2/")
+            self.assertIn(pg_policy.id, CRAWL_POLICY_MATCHER.pg_policies, url_regex)
+            pg_policy.delete()
+
+        policy = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/[[:digit:]]+")
+        self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/123"), policy)
+
+    def test_130_pg_policy_next_to_compiled(self):
+        pg_policy = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/(a|ab)")
+        longer = CrawlPolicy.objects.create(url_regex="http://127.0.0.1/abc")
+        CrawlPolicy.get_from_url("http://127.0.0.2/")
+
+        # Only the Postgresql specific policy is matched by the database, the longest match wins across both sets
+        self.assertEqual(list(CRAWL_POLICY_MATCHER.pg_policies.keys()), [pg_policy.id])
+        with self.assertNumQueries(1):
+            self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/abc"), longer)
+        with self.assertNumQueries(1):
+            self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/ab"), pg_policy)
+        self.assertEqual(CrawlPolicy.get_from_url("http://127.0.0.1/x"), self.policy)
+        self.assertEqual(
+            CrawlPolicy.get_from_urls(["http://127.0.0.1/abc", "http://127.0.0.1/ab", "http://127.0.0.2/"]),
+            {
+                "http://127.0.0.1/abc": longer,
+                "http://127.0.0.1/ab": pg_policy,
+                "http://127.0.0.2/": self.default_policy,
+            },
+        )
@@ -0,0 +1,180 @@
+# Copyright 2022-2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+# This file compares the text and links extracted by Page.dom_walk with the recursive walker it replaced
+
+from bs4 import Comment, Doctype, Tag
+from django.test import TransactionTestCase
+
+from .crawl_policy import CrawlPolicy
+from .document import Document
+from .models import Link
+from .page import Page
+
+
+class LegacyDomWalk:
+    def __init__(self, page):
+        self.page = page
+
+    def _get_elem_text(self, elem, recurse=False):
+        s = ""
+        if elem.name is None:
+            s = getattr(elem, "string", "") or ""
+            s = s.strip(" \t\n\r")
+
+        if (elem.name == "a" or recurse) and hasattr(elem, "children"):
+            for child in elem.children:
+                _s = self._get_elem_text(child, True)
+                if _s:
+                    if s:
+                        s += " "
+                    s += _s
+        return s
+
+    def _build_selector(self, elem):
+        no = 1
+        for sibling in elem.previous_siblings:
+            if isinstance(elem, Tag) and sibling.name == elem.name:
+                no += 1
+
+        selector = f"/{elem.name}[{no}]"
+
+        if elem.name != "html":
+            selector = self._build_selector(elem.parent) + selector
+        return selector
+
+    def _dom_walk(self, elem, crawl_policy, links, queue_links, document, in_nav=False):
+        if isinstance(elem, (Doctype, Comment)):
+            return
+
+        if elem.name in ("[document]", "title", "script", "style"):
+            return
+
+        if crawl_policy.remove_nav_elements != CrawlPolicy.REMOVE_NAV_NO and elem.name in ("nav", "header", "footer"):
+            in_nav = True
+
+        s = self._get_elem_text(elem)
+
+        if elem.name in (None, "a"):
+            if links["text"] and links["text"][-1] not in (" ", "\n") and s and not in_nav:
+                links["text"] += " "
+
+            if elem.name == "a" and queue_links:
+                href = elem.get("href")
+                if href:
+                    link = Link(
+                        doc_from=document,
+                        text=s,
+                        pos=len(links["text"]),
+                        in_nav=in_nav,
+                    )
+                    link.href = href.strip()
+                    if crawl_policy.take_screenshots:
+                        link.css_selector = self._build_selector(elem)
+                    links["links"].append(link)
+
+            if s and not in_nav:
+                links["text"] += s
+
+            if elem.name == "a":
+                return
+
+        if hasattr(elem, "children"):
+            for child in elem.children:
+                self._dom_walk(child, crawl_policy, links, queue_links, document, in_nav)
+
+        if elem.name in ("div", "p", "li", "h1", "h2", "h3", "h4", "h5", "h6"):
+            if links["text"] and not in_nav:
+                if links["text"][-1] == " ":
+                    links["text"] = links["text"][:-1] + "\n"
+                elif links["text"][-1] != "\n":
+                    links["text"] += "\n"
+
+    def dom_walk(self, crawl_policy, queue_links, document):
+        links = {"links": [], "text": ""}
+        for elem in self.page.get_soup().children:
+            self._dom_walk(elem, crawl_policy, links, queue_links, document, False)
+        return links
+
+
+PAGES = (
+    b"<html><body>Hello world</body></html>",
+    b"<!DOCTYPE html><html><head><title>Title</title><style>p {}</style></head><body><p>para</p></body></html>",
+    b"<html><body><div>  one  </div><div>two<span> three </span></div>four<p></p><p>five</p></body></html>",
+    b"<html><body><h1>title</h1><ul><li>a</li><li> <b>b</b> </li><li></li></ul><h2>sub</h2>text</body></html>",
+    b'<html><body>before<a href="/link"> link <b>bold</b> <!-- comment --> </a>after</body></html>',
+    b'<html><body><a href="/1">one</a><a href="/2">two</a><a>no href</a><a href="">empty</a></body></html>',
+    b'<html><body><a href="  /spaces  "><script>var a;</script>script</a><a href="/img"><img src="i.png"></a></body></html>',
+    b'<html><body><header>header<a href="/h">h</a></header><nav><div>nav<a href="/n">n</a></div></nav>'
+    b"text<footer><p>footer</p></footer></body></html>",
+    b'<html><body><div><div><p>nested <a href="/a">a</a></p></div><div><a href="/b">b</a></div></div></body></html>',
+    b'<html><body><table><tr><td><a href="/t1">t1</a></td><td><a href="/t2">t2</a></td></tr></table></body></html>',
+    b"<html><body>no<!-- comment -->space<script>script</script> <style>style</style>text</body></html>",
+    b'<html><body><template>template</template><p>\xc3\xa9t\xc3\xa9 <a href="/\xc3\xa9">\xc3\xa9</a>\xc2\xa0</p></body></html>',
+    b"<html><body>\n\t<div>\n</div>\n<p>\r\n last \r\n</p>\n</body></html>",
+)
+
+
+def large_page():
+    body = []
+    for i in range(200):
+        body.append(
+            f'<div class="section"><h2>Section {i}</h2><p>Paragraph {i} with <b>bold</b> and <i>italic</i> text.</p>'
+            f'<ul><li><a href="/page{i}/1">first {i}</a></li><li><a href="/page{i}/2"><span>second</span> {i}</a></li>'
+            "</ul></div>"
+        )
+    return f"<html><body><header><a href='/'>home</a></header>{''.join(body)}<footer>footer</footer></body></html>".encode()
+
+
+class DomWalkTest(TransactionTestCase):
+    def _policies(self):
+        for remove_nav in (CrawlPolicy.REMOVE_NAV_NO, CrawlPolicy.REMOVE_NAV_FROM_INDEX):
+            for take_screenshots in (False, True):
+                yield CrawlPolicy(remove_nav_elements=remove_nav, take_screenshots=take_screenshots)
+
+    def _assert_same_walk(self, content):
+        document = Document(url="http://127.0.0.1/")
+        for crawl_policy in self._policies():
+            for queue_links, doc in ((False, None), (True, document)):
+                page = Page("http://127.0.0.1/", content, None)
+                expected = LegacyDomWalk(page).dom_walk(crawl_policy, queue_links, doc)
+                walked = page._dom_walk(crawl_policy, queue_links, doc)
+
+                msg = f"{content} {crawl_policy.remove_nav_elements} {crawl_policy.take_screenshots} {queue_links}"
+                self.assertEqual(walked["text"], expected["text"], msg)
+                self.assertEqual(
+                    [
+                        (link.text, link.pos, link.in_nav, link.href, getattr(link, "css_selector", None))
+                        for link in walked["links"]
+                    ],
+                    [
+                        (link.text, link.pos, link.in_nav, link.href, getattr(link, "css_selector", None))
+                        for link in expected["links"]
+                    ],
+                    msg,
+                )
+
+    def test_010_pages(self):
+        for content in PAGES:
+            self._assert_same_walk(content)
+
+    def test_020_large_page(self):
+        self._assert_same_walk(large_page())
+
+    def test_030_deep_page(self):
+        # The walk is not recursive, deeply nested pages don't hit the recursion limit
+        content = b"<html><body>" + b"<div>" * 2000 + b"deep" + b"</div>" * 2000 + b"</body></html>"
+        page = Page("http://127.0.0.1/", content, None)
+        self.assertEqual(page._dom_walk(CrawlPolicy(), False, None)["text"], "deep\n")
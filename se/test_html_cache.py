@@ -13,7 +13,9 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import os
 from datetime import timedelta
+from tempfile import TemporaryFile
 from unittest import mock
 
 from django.conf import settings
@@ -454,3 +456,19 @@ class HTMLCacheTest(TransactionTestCase):
             _max_age_check.call_args_list,
         )
         self.assertTrue(_heuristic_check.call_args_list == [], _heuristic_check.call_args_list)
+
+    def test_110_write_page_asset(self):
+        content = b"\x00\x01binary" * 1000
+        content_file = TemporaryFile()
+        content_file.write(content)
+        page = Page("http://127.0.0.1/file.bin", None, None, content_file=content_file)
+        self.assertEqual(page.mimetype, "application/octet-stream")
+
+        asset = HTMLCache.write_page_asset(page.url, page, mimetype=page.mimetype)
+        self.assertIsNone(page._content)
+
+        mem_page = Page("http://127.0.0.1/file.bin", content, None)
+        self.assertEqual(HTMLCache.write_asset(mem_page.url, content, mem_page, mimetype=page.mimetype), asset)
+
+        with open(os.path.join(settings.SOSSE_HTML_SNAPSHOT_DIR, asset.filename), "rb") as fd:
+            self.assertEqual(fd.read(), content)
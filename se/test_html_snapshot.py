@@ -13,10 +13,12 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from threading import Barrier, current_thread, main_thread
 from unittest import mock
 
 import cssutils
 from django.conf import settings
+from django.db.backends.postgresql.base import DatabaseWrapper
 from django.shortcuts import reverse
 from django.test import TransactionTestCase, override_settings
 from django.utils.html import format_html
@@ -1326,12 +1328,82 @@ class HTMLSnapshotTest:
             },
         )
 
+    @override_settings(SOSSE_HTML_ASSET_WORKERS=4)
+    @mock.patch("se.browser_request.BrowserRequest.get")
+    @mock.patch("os.makedirs")
+    @mock.patch("se.html_asset.open")
+    @mock.patch("se.html_cache.open")
+    def test_270_concurrent_assets(self, cache_open, asset_open, makedirs, BrowserRequest):
+        web = BrowserMock({})
+        barrier = Barrier(3, timeout=10)
+
+        def _get(url, **kwargs):
+            # Fails if the three images are not downloaded simultaneously
+            if url.endswith(".png"):
+                barrier.wait()
+            return web(url, **kwargs)
+
+        BrowserRequest.side_effect = _get
+        makedirs.side_effect = None
+        cache_open.side_effect = lambda *args, **kwargs: open("/dev/null", *args[1:], **kwargs)
+        asset_open.side_effect = cache_open.side_effect
+
+        HTML = b"""<html><head>
+            <link rel="stylesheet" href="/style.css"/>
+        </head><body>
+            <img src="/image.png"/>
+            <img srcset="/image2.png 200px, /image.png 300px" src="/image3.png"/>
+        </body></html>"""
+        page = Page("http://127.0.0.1/", HTML, None)
+        snap = HTMLSnapshot(page, self.policy)
+        connect_threads = []
+        get_new_connection = DatabaseWrapper.get_new_connection
+
+        def _new_connection(*args, **kwargs):
+            connect_threads.append(current_thread())
+            return get_new_connection(*args, **kwargs)
+
+        with mock.patch.object(DatabaseWrapper, "get_new_connection", _new_connection):
+            snap.handle_assets()
+
+        # The pool threads do not access the database
+        self.assertEqual([thread for thread in connect_threads if thread is not main_thread()], [])
+        self.assertEqual(BrowserRequest.call_count, 4)
+        self.assertTrue(all(c.kwargs["cookie_jar"] is not None for c in BrowserRequest.call_args_list))
+        self.assertEqual(
+            cache_open.call_args_list,
+            [
+                mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + "http,3A/127.0.0.1/style.css_72f0eee2c7.css", "wb"),
+                mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + "http,3A/127.0.0.1/image.png_62d75f74b8.png", "wb"),
+                mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + "http,3A/127.0.0.1/image2.png_d22a588d3b.png", "wb"),
+                mock.call(settings.SOSSE_HTML_SNAPSHOT_DIR + "http,3A/127.0.0.1/image3.png_c2e85796e4.png", "wb"),
+            ],
+        )
+
+        dump = page.dump_html()
+        OUTPUT = f"""<html><head>
+            <link href="{settings.SOSSE_HTML_SNAPSHOT_URL}http,3A/127.0.0.1/style.css_72f0eee2c7.css" rel="stylesheet"/>
+        </head><body>
+            <img src="{settings.SOSSE_HTML_SNAPSHOT_URL}http,3A/127.0.0.1/image.png_62d75f74b8.png"/>
+            <img src="{settings.SOSSE_HTML_SNAPSHOT_URL}http,3A/127.0.0.1/image3.png_c2e85796e4.png" srcset="{settings.SOSSE_HTML_SNAPSHOT_URL}http%2C3A/127.0.0.1/image2.png_d22a588d3b.png 200px, {settings.SOSSE_HTML_SNAPSHOT_URL}http%2C3A/127.0.0.1/image.png_62d75f74b8.png 300px"/>
+        </body></html>""".encode()
+        self.assertEqual(dump, OUTPUT)
+        self.assertEqual(snap.prefetched, {})
+
+        # The pool is kept for the next snapshots
+        pool = HTMLSnapshot._pool
+        HTMLSnapshot(Page("http://127.0.0.1/", HTML, None), self.policy).handle_assets()
+        self.assertIs(HTMLSnapshot._pool, pool)
+
 
+# Downloads are serialized to check the order of the requests
+@override_settings(SOSSE_HTML_ASSET_WORKERS=1)
 class HTMLSnapshotCSSUtilsParser(HTMLSnapshotTest, TransactionTestCase):
     @classmethod
     def setUpClass(cls):
         import se.html_snapshot
 
+        super().setUpClass()
         cls.InternalCSSParser = se.html_snapshot.InternalCSSParser
         se.html_snapshot.InternalCSSParser = se.html_snapshot.CSSUtilsParser
 
@@ -1340,8 +1412,10 @@ class HTMLSnapshotCSSUtilsParser(HTMLSnapshotTest, TransactionTestCase):
         import se.html_snapshot
 
         se.html_snapshot.InternalCSSParser = cls.InternalCSSParser
+        super().tearDownClass()
 
 
+@override_settings(SOSSE_HTML_ASSET_WORKERS=1)
 class HTMLSnapshotInternalCSSParser(HTMLSnapshotTest, TransactionTestCase):
     pass
 
@@ -0,0 +1,67 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from django.test import TestCase, override_settings
+
+from .lang_detect import LangDetector, detect_lang, lang_sample
+
+EN_TEXT = "The quick brown fox jumps over the lazy dog, while the cat is sleeping in the garden. "
+FR_TEXT = "Le renard brun rapide saute par-dessus le chien paresseux, pendant que le chat dort dans le jardin. "
+
+
+class LangDetectTest(TestCase):
+    def test_10_sample(self):
+        self.assertEqual(lang_sample("short text", 100), "short text")
+
+        text = "a" * 1000 + "b" * 1000 + "c" * 1000 + "d" * 1000
+        sample = lang_sample(text, 400)
+        self.assertEqual(sample, "\n".join(c * 100 for c in "abcd"))
+
+    def test_20_detect(self):
+        self.assertEqual(detect_lang(EN_TEXT * 1000), "en")
+        self.assertEqual(detect_lang(lang_sample(FR_TEXT * 1000, 4000)), "fr")
+        self.assertIsNone(detect_lang("1234"))
+
+    @override_settings(SOSSE_LANG_DETECT_WORKERS=0)
+    def test_30_inline(self):
+        future = LangDetector.submit(EN_TEXT * 10)
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), "en")
+
+    @override_settings(SOSSE_LANG_DETECT_WORKERS=2)
+    def test_40_process_pool(self):
+        try:
+            futures = [LangDetector.submit(text * 100) for text in (EN_TEXT, FR_TEXT)]
+            self.assertEqual([future.result() for future in futures], ["en", "fr"])
+        finally:
+            LangDetector.shutdown()
+
+    @override_settings(SOSSE_LANG_DETECT_WORKERS=1)
+    def test_50_broken_pool(self):
+        try:
+            LangDetector.submit(EN_TEXT).result()
+            # Future of a crashed detector process
+            future = Future()
+            future.set_exception(BrokenProcessPool())
+            future.sample = EN_TEXT * 10
+
+            self.assertEqual(LangDetector.result(future), "en")
+            self.assertIsNone(LangDetector._pool)
+            self.assertEqual(LangDetector.result(LangDetector.submit(FR_TEXT * 10)), "fr")
+        finally:
+            LangDetector.shutdown()
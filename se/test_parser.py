@@ -309,3 +309,27 @@ class PageTest(TransactionTestCase):
             self.assertEqual(links[2].doc_to.url, "http://192.168.120.5/entry-two")
 
             Document.objects.all().delete()
+
+    ANALYSIS_HTML = b"""<html><head><title>Title</title><base href="/base/#frag"><base href="/other/">
+        <link rel="icon" href="/icon.png"><link rel="shortcut icon" href="/favicon.ico" sizes="16x16">
+        <meta http-equiv="Refresh" content="0; url=/redirect"><meta http-equiv="refresh">
+        </head><body><svg><title>svg title</title></svg><a href="page">page</a></body></html>"""
+
+    def test_80_page_analysis(self):
+        page = Page("http://test/dir/", self.ANALYSIS_HTML, None)
+        analysis = page.analysis()
+        self.assertEqual(analysis.title, "Title")
+        self.assertEqual(analysis.base_url, "http://test/base/")
+        self.assertEqual([elem.get("href") for elem in analysis.shortcut_icons], ["/favicon.ico"])
+        self.assertEqual([elem.get("href") for elem in analysis.icons], ["/icon.png", "/favicon.ico"])
+        self.assertEqual(analysis.meta_refresh, ["0; url=/redirect"])
+        self.assertIs(page.analysis(), analysis)
+
+        doc = Document.objects.create(url=page.url)
+        doc.index(page, self.crawl_policy)
+        self.assertEqual(Link.objects.get().doc_to.url, "http://test/base/page")
+
+        # The analysis follows changes of the content
+        page.content = b"<html><head><title>Other</title></head><body></body></html>"
+        self.assertEqual(page.analysis().title, "Other")
+        self.assertEqual(page.analysis().base_url, "http://test/dir/")
@@ -13,10 +13,13 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+from hashlib import md5
+
 import requests
-from django.test import TransactionTestCase
+from django.test import TransactionTestCase, override_settings
 
 from .browser_request import BrowserRequest
+from .cookie import Cookie
 
 
 class RequestsTest(TransactionTestCase):
@@ -40,3 +43,40 @@ class RequestsTest(TransactionTestCase):
         self._get(s, "http://127.0.0.1:8000/cookies/delete?test_key")
         cookies = list(s.cookies)
         self.assertEqual(cookies, [])
+
+    def test_30_session_pool(self):
+        BrowserRequest.close_sessions()
+        BrowserRequest.get("http://127.0.0.1:8000/cookies/set?test_key=test_value")
+        BrowserRequest.get("http://127.0.0.1:8000/get")
+        self.assertEqual(len(BrowserRequest._sessions), 1)
+
+        session = BrowserRequest._get_session("http://127.0.0.1:8000/")
+        pools = session.get_adapter("http://127.0.0.1:8000/").poolmanager.pools
+        self.assertEqual(len(pools), 1)
+        pool = pools[list(pools.keys())[0]]
+        self.assertEqual(pool.num_connections, 1)
+        self.assertEqual(pool.num_requests, 3)
+
+        # Cookies are stored in the database only
+        self.assertEqual(list(session.cookies), [])
+        self.assertEqual(Cookie.objects.get().name, "test_key")
+
+        page = BrowserRequest.get("http://127.0.0.1:8000/cookies")
+        self.assertIn(b'"test_key": "test_value"', page.content)
+        BrowserRequest.close_sessions()
+
+    @override_settings(SOSSE_DOWNLOAD_MEMORY_SIZE=2)
+    def test_40_download_to_file(self):
+        page = BrowserRequest.get("http://127.0.0.1:8000/bytes/1000?seed=1")
+        self.assertIsNone(page.content_file)
+        self.assertEqual(len(page.content), 1000)
+        self.assertEqual(page.content_md5(), md5(page.content).hexdigest())
+
+        page = BrowserRequest.get("http://127.0.0.1:8000/bytes/5000?seed=1")
+        self.assertIsNotNone(page.content_file)
+        self.assertIsNone(page._content)
+        content_md5 = page.content_md5()
+
+        # The content is loaded on access only
+        self.assertEqual(len(page.content), 5000)
+        self.assertEqual(content_md5, md5(page.content).hexdigest())
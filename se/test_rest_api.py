@@ -23,7 +23,7 @@ from django.test.client import Client
 from django.utils import timezone
 
 from .document import Document
-from .models import CrawlerStats
+from .models import CrawlerStats, Facet
 
 now = timezone.now()
 now_str = now.isoformat().replace("+00:00", "Z")
@@ -259,6 +259,38 @@ class APIQueryTest(RestAPITest, TransactionTestCase):
             response.content,
         )
 
+    def test_facets_update(self):
+        # Counters follow the changes of the documents
+        self.doc2.mimetype = "text/html"
+        self.doc2.save()
+        Document.objects.create(url="http://127.0.0.1/test3", lang_iso_639_1="fr")
+        self.doc1.delete()
+
+        # Queued documents have no mimetype, they are not counted
+        Document.objects.update(worker_no=1)
+        self.assertEqual(
+            list(Facet.counts(Facet.MIME).values_list("value", "doc_count")),
+            [("text/html", 1)],
+        )
+        response = self.client.get("/api/lang_stats/")
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            json.loads(response.content),
+            [{"doc_count": 1, "lang": "En 🇬🇧"}, {"doc_count": 1, "lang": "Fr 🇫🇷"}],
+        )
+
+    def test_search_facets(self):
+        response = self.client.post("/api/search_facets/", {"query": "http"})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            json.loads(response.content),
+            {
+                "lang": [{"value": "en", "doc_count": 2}],
+                "mime": [{"value": "image/png", "doc_count": 1}, {"value": "text/html", "doc_count": 1}],
+                "capped": False,
+            },
+        )
+
     def test_search(self):
         response = self.client.post("/api/search/", {"query": "content"})
         self.assertEqual(response.status_code, 200, response.content)
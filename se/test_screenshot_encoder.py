@@ -0,0 +1,124 @@
+# Copyright 2025 Laurent Defert
+#
+#  This file is part of SOSSE.
+#
+# SOSSE is free software: you can redistribute it and/or modify it under the terms of the GNU Affero
+# General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# SOSSE is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even
+# the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License along with SOSSE.
+# If not, see <https://www.gnu.org/licenses/>.
+import os
+from datetime import datetime, timezone
+from io import BytesIO
+from tempfile import TemporaryDirectory
+from threading import Event, Timer
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from PIL import Image
+
+from .document import Document
+from .screenshot_encoder import ScreenshotEncoder, encode_screenshots, tile_count
+
+
+def png_image(width, height):
+    buf = BytesIO()
+    Image.new("RGBA", (width, height), (255, 0, 0, 255)).save(buf, "PNG")
+    return buf.getvalue()
+
+
+class ScreenshotEncoderTest(TestCase):
+    def _sizes(self, base_name, img_format, count):
+        sizes = []
+        for i in range(count):
+            with Image.open(f"{base_name}_{i}.{img_format}") as img:
+                sizes.append(img.size)
+        self.assertFalse(os.path.exists(f"{base_name}_{count}.{img_format}"))
+        return sizes
+
+    def test_10_full_page(self):
+        captures = [(png_image(100, 250), 0)]
+        self.assertEqual(tile_count(captures, 100), 3)
+
+        with TemporaryDirectory() as tmp_dir:
+            base_name = os.path.join(tmp_dir, "page")
+            self.assertEqual(encode_screenshots(captures, base_name, "jpg", 100), 3)
+            self.assertEqual(self._sizes(base_name, "jpg", 3), [(100, 100), (100, 100), (100, 50)])
+
+    def test_20_scrolled(self):
+        # The last screen is cropped since the page could not be scrolled past its bottom
+        captures = [(png_image(100, 100), 0), (png_image(100, 100), 40)]
+        self.assertEqual(tile_count(captures, 100), 2)
+
+        with TemporaryDirectory() as tmp_dir:
+            base_name = os.path.join(tmp_dir, "page")
+            self.assertEqual(encode_screenshots(captures, base_name, "png", 100), 2)
+            self.assertEqual(self._sizes(base_name, "png", 2), [(100, 100), (100, 60)])
+
+    @override_settings(SOSSE_SCREENSHOT_WORKERS=1)
+    def test_30_thread_pool(self):
+        with TemporaryDirectory() as tmp_dir:
+            base_name = os.path.join(tmp_dir, "page")
+            try:
+                count, future = ScreenshotEncoder.submit([(png_image(100, 150), 0)], base_name, "png", 100)
+                self.assertEqual(count, 2)
+                self.assertEqual(future.result(), 2)
+            finally:
+                ScreenshotEncoder.shutdown()
+            self.assertEqual(self._sizes(base_name, "png", 2), [(100, 100), (100, 50)])
+
+    @override_settings(SOSSE_SCREENSHOT_WORKERS=1)
+    def test_40_bounded_queue(self):
+        release = Event()
+
+        def encode(captures, base_name, img_format, tile_height):
+            release.wait(5)
+            if base_name == "fail":
+                raise Exception("encoding failed")
+            return 1
+
+        captures = [(png_image(100, 100), 0)]
+        with mock.patch("se.screenshot_encoder.encode_screenshots", side_effect=encode):
+            with mock.patch("se.screenshot_encoder.crawl_logger"):
+                try:
+                    futures = []
+                    for base_name in ("page", "fail"):
+                        _, future = ScreenshotEncoder.submit(captures, base_name, "png", 100)
+                        ScreenshotEncoder.track(future, base_name)
+                        futures.append(future)
+                    self.assertEqual(len(ScreenshotEncoder._pending), 2)
+
+                    # The queue is full, the next job waits for the oldest one
+                    Timer(0.1, release.set).start()
+                    _, future = ScreenshotEncoder.submit(captures, "next", "png", 100)
+                    self.assertTrue(futures[0].done())
+                    self.assertLessEqual(len(ScreenshotEncoder._pending), 2)
+
+                    future.result()
+                    self.assertEqual(ScreenshotEncoder.failures(), ["fail"])
+                    self.assertEqual(len(ScreenshotEncoder._pending), 0)
+                finally:
+                    release.set()
+                    ScreenshotEncoder.shutdown()
+
+    def test_50_encoding_failure(self):
+        with TemporaryDirectory() as tmp_dir:
+            base_name = os.path.join(tmp_dir, "page")
+            captures = [(png_image(100, 150), 0), (b"not a png", 0)]
+            with self.assertRaises(Exception):
+                encode_screenshots(captures, base_name, "png", 100)
+            # The tiles written before the failure are removed
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+        crawl_last = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        doc = Document.objects.create(url="http://127.0.0.1/", screenshot_count=2, crawl_last=crawl_last)
+        recrawled = Document.objects.create(url="http://127.0.0.2/", screenshot_count=2, crawl_last=crawl_last)
+        ScreenshotEncoder._failed = [(doc.id, crawl_last), (recrawled.id, datetime(1999, 1, 1, tzinfo=timezone.utc))]
+        Document.reset_failed_screenshots()
+        self.assertEqual(Document.objects.get(id=doc.id).screenshot_count, 0)
+        self.assertEqual(Document.objects.get(id=recrawled.id).screenshot_count, 2)
@@ -13,15 +13,21 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import json
+import unicodedata
+from base64 import urlsafe_b64encode
+from unittest import mock
+
 from django.contrib.auth.models import User
 from django.core.handlers.wsgi import WSGIRequest
 from django.test import TransactionTestCase, override_settings
 from django.utils import timezone
 
-from .document import Document
+from .document import Document, normalized_to_content_pos, remove_accent, remove_accent_offsets
 from .models import Link, SearchEngine
-from .search import add_headlines, get_documents_from_request
+from .search import SearchPaginator, add_headlines, get_documents_from_request
 from .search_form import SearchForm
+from .words_stats import word_stats
 
 
 class SearchTest(TransactionTestCase):
@@ -183,7 +189,57 @@ class SearchTest(TransactionTestCase):
         docs = add_headlines(docs, query)
         self.assertEqual(docs.count(), 1)
         self.assertEqual(docs[0], self.page)
-        self.assertEqual(docs[0].headline, 'Page1, World <span class="res-highlight">Télé</span>')
+        self.assertEqual(docs[0].headline, 'Page1, World <span class="res-highlight">Télé</span> one three')
+
+    def test_022_headline_single_query(self):
+        request = WSGIRequest({"REQUEST_METHOD": "GET", "QUERY_STRING": "q=world", "wsgi.input": ""})
+        request.user = self.admin
+        form = SearchForm(request.GET)
+        self.assertTrue(form.is_valid())
+        _, docs, query = get_documents_from_request(request, form)
+        docs = list(docs)
+
+        with self.assertNumQueries(1):
+            docs = add_headlines(docs, query)
+        self.assertEqual(
+            [doc.headline for doc in docs],
+            [
+                'Page1, <span class="res-highlight">World</span> Télé one three',
+                'Hello <span class="res-highlight">world</span> one two three',
+            ],
+        )
+
+    def test_023_headline_offsets(self):
+        content = "Cafe\u0301 e\u0301te\u0301 한국 world"
+        normalized_content, offsets = remove_accent_offsets(content)
+        self.assertEqual(normalized_content, unicodedata.normalize("NFD", "Cafe ete 한국 world"))
+        self.assertNotEqual(offsets, [])
+        self.page.content = content
+        self.page.normalized_content = normalized_content
+        self.page.normalized_content_offsets = offsets
+        self.page.save()
+
+        for q, headline in (
+            ("world", 'Cafe\u0301 e\u0301te\u0301 한국 <span class="res-highlight">world</span>'),
+            ("ete", 'Cafe\u0301 <span class="res-highlight">e\u0301te\u0301</span> 한국 world'),
+            ("cafe", '<span class="res-highlight">Cafe\u0301</span> e\u0301te\u0301 한국 world'),
+        ):
+            request = WSGIRequest({"REQUEST_METHOD": "GET", "QUERY_STRING": f"q={q}", "wsgi.input": ""})
+            request.user = self.admin
+            form = SearchForm(request.GET)
+            self.assertTrue(form.is_valid())
+            _, docs, query = get_documents_from_request(request, form)
+            docs = add_headlines(docs.filter(id=self.page.id), query)
+            self.assertEqual(docs[0].headline, headline)
+
+    def test_024_remove_accent(self):
+        self.assertEqual(remove_accent_offsets("ascii text"), ("ascii text", []))
+        for s in ("Télé", "e\u0301te\u0301", "한국어 text", "ǅ ﬁ"):
+            expected = "".join(c for c in unicodedata.normalize("NFD", s) if unicodedata.category(c) != "Mn")
+            self.assertEqual(remove_accent(s), expected)
+            normalized, offsets = remove_accent_offsets(s)
+            self.assertEqual(normalized, expected)
+            self.assertEqual(normalized_to_content_pos(offsets, len(normalized)), len(s))
 
     def test_030_hidden(self):
         self.root.hidden = True
@@ -207,6 +263,107 @@ class SearchTest(TransactionTestCase):
         self.assertEqual(docs.count(), 1)
         self.assertEqual(docs[0], self.page)
 
+    def _create_docs(self, count):
+        for i in range(count):
+            Document.objects.create(
+                url=f"http://127.0.0.1/doc{i}",
+                normalized_url=f"http://127.0.0.1/doc{i}",
+                content="Common words" + " words" * (i % 3),
+                normalized_content="Common words" + " words" * (i % 3),
+                title=f"Doc {i % 4}",
+                normalized_title=f"Doc {i % 4}",
+                crawl_last=timezone.now(),
+            )
+
+    @override_settings(SOSSE_SEARCH_COUNT_LIMIT=5)
+    def test_050_count_limit(self):
+        self._create_docs(8)
+        docs = self._search_docs("q=common")
+        paginator = SearchPaginator(docs, 3)
+        self.assertEqual(paginator.count, 5)
+        self.assertTrue(paginator.count_capped)
+        self.assertEqual(paginator.num_pages, 2)
+
+        docs = self._search_docs("q=hello")
+        paginator = SearchPaginator(docs, 3)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.count_capped)
+
+    def test_051_keyset_pagination(self):
+        self._create_docs(10)
+        for params in ("q=common", "q=common&s=title", "q=common&s=-url"):
+            docs = self._search_docs(params)
+            expected = list(docs)
+            self.assertEqual(len(expected), 10)
+
+            paginator = SearchPaginator(docs, 3)
+            page = paginator.get_page(1)
+            pages = list(page)
+            while page.has_next():
+                cursor = paginator.next_cursor(page)
+                self.assertIsNotNone(cursor)
+                paginator = SearchPaginator(docs, 3, cursor)
+                with mock.patch("django.core.paginator.Paginator.page") as offset_page:
+                    page = paginator.get_page(page.number + 1)
+                    pages += list(page)
+                self.assertFalse(offset_page.called)
+            self.assertEqual(pages, expected, params)
+
+        # Sorting on a nullable field falls back to offsets
+        docs = self._search_docs("q=common&s=crawl_first")
+        paginator = SearchPaginator(docs, 3)
+        self.assertIsNone(paginator.next_cursor(paginator.get_page(1)))
+
+    def test_053_invalid_cursor(self):
+        self._create_docs(10)
+        docs = self._search_docs("q=common")
+        self.assertEqual([field.lstrip("-") for field in docs.query.order_by], ["rank", "title", "id"])
+        expected = list(SearchPaginator(docs, 3).get_page(2))
+
+        # Cursors with values that do not match their fields are ignored
+        for values in (
+            [0, "Doc 1", {"a": 1}],
+            ["abc", "Doc 1", 1],
+            [True, "Doc 1", 1],
+            [1e300, "Doc 1", 1],
+            [0.5, 1, 1],
+            [0.5, "Doc\x00", 1],
+            [0.5, "Doc 1", 2**40],
+            [0.5, "Doc 1", -1],
+            [0.5, "Doc 1"],
+            None,
+        ):
+            cursor = json.dumps({"p": 2, "v": values}).encode("utf-8")
+            cursor = urlsafe_b64encode(cursor).decode("ascii").rstrip("=")
+            paginator = SearchPaginator(docs, 3, cursor)
+            self.assertIsNone(paginator.cursor, values)
+            self.assertEqual(list(paginator.get_page(2)), expected, values)
+
+        for cursor in ("W10", "!!", urlsafe_b64encode(b'{"p": "2", "v": [0.5, "Doc 1", 1]}').decode("ascii")):
+            self.assertIsNone(SearchPaginator(docs, 3, cursor).cursor, cursor)
+
+    def test_052_low_rank_fallback(self):
+        # Low ranked documents are excluded when higher ranked documents match
+        noise = " or ".join(f"noise{i}" for i in range(13))
+        docs = self._search_docs(f"q=hello or two or tele or {noise}")
+        self.assertEqual(list(docs), [self.root])
+
+        # Only low ranked documents match
+        docs = self._search_docs(f"q=tele or {noise}")
+        self.assertEqual(list(docs), [self.page])
+
+    def test_060_word_stats(self):
+        self.assertEqual(
+            word_stats(self._search_docs("q=world"), 4),
+            [("127.0.0.1", 2), ("one", 2), ("three", 2), ("world", 2)],
+        )
+
+    @override_settings(SOSSE_WORD_STATS_SAMPLE_SIZE=1)
+    def test_061_word_stats_sample(self):
+        stats = dict(word_stats(self._search_docs("q=world")))
+        self.assertEqual(stats["world"], 1)
+        self.assertEqual(sum(stats.values()), len(stats))
+
 
 class ShortcutTest(TransactionTestCase):
     def setUp(self):
@@ -13,17 +13,24 @@
 # You should have received a copy of the GNU Affero General Public License along with SOSSE.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import logging
+from time import perf_counter
+
 from django.test import TransactionTestCase
 
 from .url import (
+    _absolutize_url,
     absolutize_url,
     has_browsable_scheme,
     norm_url_path,
+    normalized_base,
     url_beautify,
     urlparse,
 )
 from .utils import reverse_no_escape
 
+logger = logging.getLogger("test")
+
 
 class UrlTest(TransactionTestCase):
     def test_browsable_scheme(self):
@@ -226,3 +233,33 @@ class UrlBeautifyTest(TransactionTestCase):
 
         for a, b in URLS:
             self.assertEqual(url_beautify(a), b)
+
+    def test_absolutize_5000_links(self):
+        # Link resolution of a large page, the fast path and the cache must match the uncached resolution.
+        # Timings are only logged, they depend on the load of the host
+        base = "http://127.0.0.1/dir/page.html"
+        links = []
+        for i in range(1000):
+            links += [f"page{i}.html", f"/section/{i}/", f"../up{i % 10}.html", f"?page={i}", f"sub/{i}#anchor"]
+
+        normalized_base.cache_clear()
+        _absolutize_url.cache_clear()
+        legacy = _absolutize_url.__wrapped__
+
+        start = perf_counter()
+        expected = [legacy(base, link) for link in links]
+        legacy_time = perf_counter() - start
+
+        start = perf_counter()
+        urls = [absolutize_url(base, link) for link in links]
+        cold_time = perf_counter() - start
+
+        start = perf_counter()
+        urls_cached = [absolutize_url(base, link) for link in links]
+        cached_time = perf_counter() - start
+
+        self.assertEqual(urls, expected)
+        self.assertEqual(urls_cached, expected)
+        logger.debug(
+            f"absolutize {len(links)} links: uncached {legacy_time:.4f}s, cold {cold_time:.4f}s, cached {cached_time:.4f}s"
+        )
@@ -37,7 +37,7 @@ from .domain_setting import DomainSetting
 from .download import DownloadView
 from .history import HistoryView
 from .html import HTMLExcludedView, HTMLView
-from .models import CrawlerStats
+from .models import CrawlerStats, WorkerStats
 from .online import OnlineCheckView
 from .opensearch import OpensearchView
 from .preferences import PreferencesView
@@ -264,6 +264,21 @@ class ViewsTest:
             self.assertEqual(response.status_code, 200, f"{action} with permission / {response}")
 
 
+class CrawlQueueViewTest(ViewsTestMixin, TransactionTestCase):
+    def test_claimed_documents(self):
+        crawling = Document.objects.create(url="http://127.0.0.1/crawling", worker_no=0)
+        Document.objects.create(url="http://127.0.0.1/claimed", worker_no=0)
+        WorkerStats.objects.create(worker_no=0, pid=1, state="running", current_doc=crawling)
+
+        response = self.admin_client.get("/admin/se/document/crawl_queue_content/")
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        self.assertEqual(content.count("In progress"), 1)
+        self.assertEqual(content.count("Reserved"), 1)
+        # The queue is displayed in reverse order, the document being crawled is just above the history
+        self.assertGreater(content.index("/crawling"), content.index("/claimed"))
+
+
 class ChromiumViewTest(ViewsTestMixin, ViewsTest, TransactionTestCase):
     BROWSER = DomainSetting.BROWSE_CHROMIUM
 
@@ -16,6 +16,7 @@
 import os
 import re
 from copy import copy
+from functools import lru_cache
 from urllib.parse import quote, quote_plus, unquote, unquote_plus
 from urllib.parse import urlparse as base_urlparse
 
@@ -113,10 +114,47 @@ def urlparse(url):
     return parsed
 
 
+# Relative links made of unreserved characters only, without dot segments nor empty segments
+SIMPLE_LINK_RE = re.compile(r"[a-zA-Z0-9_~/-][a-zA-Z0-9._~/-]*")
+
+
+def is_simple_link(link):
+    return SIMPLE_LINK_RE.fullmatch(link) is not None and "//" not in link and "/." not in link
+
+
+@lru_cache(maxsize=1024)
+def normalized_base(url):
+    # Returns the origin and the directory of an already normalized http url, or None
+    try:
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or not parsed.netloc or sanitize_url(url) != url:
+            return None
+    except Exception:
+        return None
+
+    directory = os.path.dirname(parsed.path)
+    if not directory.endswith("/"):
+        directory += "/"
+    return f"{parsed.scheme}://{parsed.netloc}", directory
+
+
 def absolutize_url(url, link):
     if link.startswith("data:"):
         return link
 
+    if is_simple_link(link):
+        base = normalized_base(url)
+        if base:
+            origin, directory = base
+            if link.startswith("/"):
+                return origin + link
+            return origin + directory + link
+
+    return _absolutize_url(url, link)
+
+
+@lru_cache(maxsize=16384)
+def _absolutize_url(url, link):
     # see https://datatracker.ietf.org/doc/html/rfc3986
     _url = urlparse(url)
     _link = urlparse(link)
@@ -18,11 +18,19 @@ import re
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
+from django.db import connection
 from django.shortcuts import reverse
 from django.utils.html import mark_safe
 from django.utils.timezone import now
 
 
+def table_version(table):
+    # Bumped by a trigger on any change of the table, to invalidate in-process caches
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT version FROM se_table_version WHERE name = %s", [table])
+        return cursor.fetchone()[0]
+
+
 def plural(n):
     if n > 1:
         return "s"
@@ -15,11 +15,12 @@
 
 import json
 
+from django.conf import settings
 from django.db import connection
 from django.http import HttpResponse
 from django.views.generic import View
 
-from .document import Document, remove_accent
+from .document import remove_accent
 from .login import LoginRequiredMixin
 from .search import get_documents_from_request
 from .search_form import SearchForm
@@ -27,6 +28,22 @@ from .utils import human_nb
 from .views import format_url
 
 
+def word_stats(doc_query, count=100):
+    # Number of documents containing each word, computed on a sample of the matching documents
+    sample = doc_query.order_by().values("vector")[: settings.SOSSE_WORD_STATS_SAMPLE_SIZE]
+    sql, params = sample.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""SELECT lexeme, COUNT(*) AS ndoc
+                FROM ({sql}) AS docs, unnest(docs.vector)
+                GROUP BY lexeme
+                ORDER BY ndoc DESC, lexeme ASC
+                LIMIT %s""",
+            params + (count,),
+        )
+        return cursor.fetchall()
+
+
 class WordStatsView(LoginRequiredMixin, View):
     def get(self, request):
         results = None
@@ -35,27 +52,13 @@ class WordStatsView(LoginRequiredMixin, View):
             q = form.cleaned_data["q"]
             q = remove_accent(q)
             _, doc_query, _ = get_documents_from_request(request, form, True)
-            doc_query = doc_query.values("vector")
-
-            # Hack to obtain final SQL query, as described there:
-            # https://code.djangoproject.com/ticket/17741#comment:4
-            sql, params = doc_query.query.sql_with_params()
-            cursor = connection.cursor()
-            cursor.execute("EXPLAIN " + sql, params)
-            raw_query = cursor.db.ops.last_executed_query(cursor, sql, params)
-            raw_query = raw_query[len("EXPLAIN ") :]
-
-            results = Document.objects.raw(
-                "SELECT 1 AS id, word, ndoc FROM ts_stat(%s) ORDER BY ndoc DESC, word ASC LIMIT 100",
-                (raw_query,),
-            )
             results = [
                 (
-                    e.word,
-                    human_nb(e.ndoc),
-                    format_url(request, f"q={q} {e.word}")[len("/word_stats") :],
+                    word,
+                    human_nb(ndoc),
+                    format_url(request, f"q={q} {word}")[len("/word_stats") :],
                 )
-                for e in list(results)
+                for word, ndoc in word_stats(doc_query)
             ]
             results = json.dumps(results)
 
@@ -197,6 +197,16 @@ DEFAULTS: dict[str, dict[str, ConfOption]] = {
             default=True,
             type=bool,
         ),
+        "search_count_limit": ConfOption(
+            comment="Maximum number of search results counted, results past this limit are not browsable.",
+            default=10000,
+            type=int,
+        ),
+        "word_stats_sample_size": ConfOption(
+            comment="Number of matching documents used to compute the words statistics of a search.",
+            default=1000,
+            type=int,
+        ),
         "archive_follows_redirect": ConfOption(
             comment="Accessing the archive page of a redirection url automatically follows the redirection.",
             default=True,
@@ -237,6 +247,11 @@ DEFAULTS: dict[str, dict[str, ConfOption]] = {
             comment="Number of crawlers running concurrently (defaults to the number of CPU available).",
             default="",
         ),
+        "crawler_batch_size": ConfOption(
+            comment="Number of documents each crawler claims at once from the crawl queue.\nHigher values reduce contention on the database when many crawlers are running.",
+            default=5,
+            type=int,
+        ),
         "proxy": ConfOption(
             comment="Url of the HTTP proxy server to use.\nExample: http://192.168.0.1:8080/",
             default="",
@@ -278,6 +293,21 @@ The UA will be selected among the provided platform, specified as a comma-separa
             comment="Language used to parse web pages when the original language could not be detected.",
             default="english",
         ),
+        "lang_detect_sample_size": ConfOption(
+            comment="Number of characters of a page used to detect its language.",
+            default=4000,
+            type=int,
+        ),
+        "lang_detect_workers": ConfOption(
+            comment="Number of processes detecting languages for each crawler, while the crawler processes the rest of the page.\n0 runs the detection in the crawler process.",
+            default=1,
+            type=int,
+        ),
+        "snapshot_workers": ConfOption(
+            comment="Number of processes downloading the assets of HTML snapshots, while the crawlers fetch the next pages.\n0 downloads the assets in the crawler processes.",
+            default=0,
+            type=int,
+        ),
         "hashing_algo": ConfOption(
             comment="Hashing algorithms used to define if the content of a page has changed.",
             default="md5",
@@ -286,6 +316,16 @@ The UA will be selected among the provided platform, specified as a comma-separa
             comment="Resolution of the browser used to take screenshots.",
             default="1920x1080",
         ),
+        "screenshots_full_page": ConfOption(
+            comment="Capture the whole page at once when the browser supports it, instead of scrolling and capturing each screen.\nPages taller than 16384 pixels are always captured by scrolling.",
+            default=True,
+            type=bool,
+        ),
+        "screenshot_workers": ConfOption(
+            comment="Number of threads encoding screenshots for each crawler, while the crawler fetches the next pages.\nAt most 2 pages per thread are queued, the crawler waits when encoding falls behind.\n0 encodes the screenshots in the crawler thread.",
+            default=1,
+            type=int,
+        ),
         "default_browser": ConfOption(
             comment='Defines which browser to use by default when browsing mode is auto-detected (can be either "firefox" or "chromium").',
             default="chromium",
@@ -298,13 +338,17 @@ The UA will be selected among the provided platform, specified as a comma-separa
             comment="Options passed to Firefox's command line.",
             default="--headless",
         ),
+        "js_stable_mode": ConfOption(
+            comment="How to detect the page content is stable when loading a page in a browser:\n``observer`` watches DOM mutations and network requests from the page,\n``poll`` compares the DOM every ``js_stable_time`` seconds.",
+            default="observer",
+        ),
         "js_stable_time": ConfOption(
-            comment="When loading a page in a browser, wait ``js_stable_time`` seconds before checking the DOM stays unchanged.",
+            comment="When loading a page in a browser, the DOM must stay unchanged for ``js_stable_time`` seconds to be considered stable.",
             default=0.1,
             type=float,
         ),
         "js_stable_retry": ConfOption(
-            comment="Check at most ``js_stable_retry`` times for the page to stay unchanged before processing.",
+            comment="Wait at most ``js_stable_retry`` times ``js_stable_time`` for the page to stay unchanged before processing.",
             default=100,
             type=int,
         ),
@@ -331,11 +375,26 @@ The UA will be selected among the provided platform, specified as a comma-separa
             default=5000,
             type=int,
         ),
+        "download_memory_size": ConfOption(
+            comment="Downloaded files bigger than this size are stored in a temporary file instead of memory (in kB).",
+            default=1000,
+            type=int,
+        ),
         "max_html_asset_size": ConfOption(
             comment="Maximum file size of html assets (css, images, etc.) to download (in kB).",
             default=50000,
             type=int,
         ),
+        "html_asset_workers": ConfOption(
+            comment="Number of html assets downloaded simultaneously when taking an HTML snapshot.",
+            default=8,
+            type=int,
+        ),
+        "html_asset_host_workers": ConfOption(
+            comment="Maximum number of html assets downloaded simultaneously from the same host.",
+            default=4,
+            type=int,
+        ),
         "max_redirects": ConfOption(
             comment="Maximum numbers of redirect before aborting.\n(this is accurate when using Requests only,\nsome redirects may be missed on Chromium)",
             default=5,
@@ -346,6 +405,26 @@ The UA will be selected among the provided platform, specified as a comma-separa
             default=5,
             type=int,
         ),
+        "browser_spare": ConfOption(
+            comment="Keep a spare browser started in the background for each crawler.\nIt replaces the browser without waiting when it crashes, is recycled or was closed after ``browser_idle_exit_time``, at the cost of the memory used by the additional browser.\nThe spare browser is kept running while the crawler is idle.",
+            default=False,
+            type=bool,
+        ),
+        "browser_recycle_pages": ConfOption(
+            comment="Restart the browser after it loaded ``browser_recycle_pages`` pages.\n0 never restarts it.",
+            default=0,
+            type=int,
+        ),
+        "browser_recycle_rss": ConfOption(
+            comment="Restart the browser when its processes use more than ``browser_recycle_rss`` MB of memory.\n0 never restarts it.",
+            default=0,
+            type=int,
+        ),
+        "browser_tabs": ConfOption(
+            comment="Number of tabs used by each crawler browser.\nWhen greater than 1, the next queued pages are loaded in background tabs while the current one is processed.\nPages of domains with cookies, rate limits, an undetected browse mode or a robots.txt not loaded yet are not preloaded, nor are non-HTML documents.\nThis increases memory usage: each crawler still runs its own browser, and each background tab adds the memory of a loaded page to it. Tabs are not shared between crawlers.",
+            default=1,
+            type=int,
+        ),
         "browser_crash_sleep": ConfOption(
             comment="Sleep ``browser_crash_sleep`` seconds before retrying after the browser crashed.",
             default=1.0,
@@ -501,6 +580,32 @@ class Conf:
                     % crawler_count
                 )
 
+        for opt in (
+            "crawler_batch_size",
+            "html_asset_workers",
+            "html_asset_host_workers",
+            "search_count_limit",
+            "word_stats_sample_size",
+            "lang_detect_sample_size",
+            "browser_tabs",
+        ):
+            if settings[f"SOSSE_{opt.upper()}"] < 1:
+                raise Exception(
+                    f'Configuration parsing error: invalid "{opt}", must be greater than 0: {settings[f"SOSSE_{opt.upper()}"]}'
+                )
+
+        for opt in (
+            "lang_detect_workers",
+            "snapshot_workers",
+            "screenshot_workers",
+            "browser_recycle_pages",
+            "browser_recycle_rss",
+        ):
+            if settings[f"SOSSE_{opt.upper()}"] < 0:
+                raise Exception(
+                    f'Configuration parsing error: invalid "{opt}", must be positive: {settings[f"SOSSE_{opt.upper()}"]}'
+                )
+
         if settings.get("SOSSE_DEFAULT_SEARCH_REDIRECT") and settings.get("SOSSE_ONLINE_SEARCH_REDIRECT"):
             raise Exception(
                 'Options "default_search_redirect" and "online_search_redirect" cannot be set at the same time.'
@@ -532,6 +637,9 @@ class Conf:
                 'Configuration parsing error: invalid default_browser, must be one of "firefox" or "chromium"'
             )
 
+        if settings["SOSSE_JS_STABLE_MODE"] not in ("observer", "poll"):
+            raise Exception('Configuration parsing error: invalid js_stable_mode, must be one of "observer" or "poll"')
+
         if settings["SOSSE_USER_AGENT"]:
             for var in (
                 "fake_user_agent_browser",